@@ -0,0 +1,107 @@
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+LAMBDA_DIR = os.path.join(HERE, '..', 'Lambda')
+
+# Minimal valid configuration; creating clients needs no credentials or network access
+BENCH_ENV = {
+    'S3_REGION': 'us-east-1',
+    'VECTOR_BUCKET': 'bench-vectors',
+    'VECTOR_INDEX': 'bench-index',
+    'BEDROCK_MODEL_ID': 'amazon.nova-2-multimodal-embeddings-v1:0',
+    'EMBEDDING_DIMENSION': '1024',
+    'AWS_ACCESS_KEY_ID': 'bench',
+    'AWS_SECRET_ACCESS_KEY': 'bench',
+}
+
+# Runs in a fresh interpreter: what a new Lambda container does before and during its first invocation
+CHILD = """
+import json, sys, time
+start = time.perf_counter()
+import vector_embed_lambda
+imported = time.perf_counter()
+vector_embed_lambda.validate_config()
+vector_embed_lambda.get_s3_client()
+vector_embed_lambda.get_bedrock_runtime()
+vector_embed_lambda.get_s3vectors_client()
+ready = time.perf_counter()
+print(json.dumps({
+    'import_ms': (imported - start) * 1000,
+    'first_use_ms': (ready - imported) * 1000,
+    'total_ms': (ready - start) * 1000,
+    'modules': len(sys.modules),
+}))
+"""
+
+def run_child(lazy, extra_args=(), code=CHILD):
+    """Runs code (by default the CHILD timing script) in a fresh interpreter. Returns its last line as JSON, and stderr."""
+    env = {**os.environ, **BENCH_ENV, 'LAZY_CLIENTS': 'true' if lazy else 'false', 'PYTHONPATH': LAMBDA_DIR}
+    completed = subprocess.run(
+        [sys.executable, *extra_args, '-c', code], env=env, capture_output=True, text=True, check=True
+    )
+    return json.loads(completed.stdout.strip().splitlines()[-1]), completed.stderr
+
+def measure(lazy, runs):
+    """Median timings over `runs` fresh interpreters."""
+    samples = [run_child(lazy)[0] for _ in range(runs)]
+    return {
+        'mode': 'lazy' if lazy else 'eager',
+        'runs': runs,
+        **{field: statistics.median(sample[field] for sample in samples)
+           for field in ('import_ms', 'first_use_ms', 'total_ms', 'modules')}
+    }
+
+def slowest_imports(count):
+    """The modules with the highest cumulative import time (us), from python -X importtime."""
+    _, stderr = run_child(True, ('-X', 'importtime'))
+    timings = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = (part.strip() for part in line[len('import time:'):].split('|'))
+        timings.append((int(cumulative), name))
+    return sorted(timings, reverse=True)[:count]
+
+def regressions(report, baseline, tolerance):
+    """Modes whose median time to a ready container grew more than `tolerance` (a fraction) over the baseline."""
+    previous = {result['mode']: result for result in baseline['results']}
+    slower = []
+    for result in report['results']:
+        before = previous.get(result['mode'])
+        if before and result['total_ms'] > before['total_ms'] * (1 + tolerance):
+            slower.append(f"{result['mode']}: {result['total_ms']:.1f} ms to ready, baseline {before['total_ms']:.1f} ms")
+    return slower
+
+# --- Main Execution ---
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Import and cold-start benchmark of vector_embed_lambda, each run in a fresh interpreter.")
+    parser.add_argument('--runs', type=int, default=15)
+    parser.add_argument('--top-imports', type=int, default=10, help="Show the slowest imports (0 to skip)")
+    parser.add_argument('--save', help="Write the report as JSON to this path")
+    parser.add_argument('--baseline', help="Compare against a report saved with --save; exit 1 on a regression")
+    parser.add_argument('--tolerance', type=float, default=0.25, help="Allowed increase of the time to ready against the baseline")
+    args = parser.parse_args()
+
+    report = {'results': [measure(lazy, args.runs) for lazy in (True, False)]}
+    for result in report['results']:
+        print(f"{result['mode']:5s}: import {result['import_ms']:7.1f} ms, first use {result['first_use_ms']:7.1f} ms, "
+              f"ready after {result['total_ms']:7.1f} ms, {result['modules']:.0f} modules (median of {result['runs']})")
+    if args.top_imports:
+        print("\nSlowest imports (cumulative):")
+        for microseconds, name in slowest_imports(args.top_imports):
+            print(f"  {microseconds / 1000:8.1f} ms  {name}")
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(report, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            slower = regressions(report, json.load(f), args.tolerance)
+        for line in slower:
+            print(f"REGRESSION {line}")
+        sys.exit(1 if slower else 0)
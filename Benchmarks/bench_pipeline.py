@@ -0,0 +1,281 @@
+import argparse
+import contextlib
+import json
+import math
+import os
+import random
+import resource
+import sys
+import time
+import tracemalloc
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path[:0] = [os.path.join(HERE, '..', 'Lambda'), os.path.join(HERE, '..', 'CodeBuilder')]
+
+# Both scripts read their configuration at import time; nothing here talks to AWS
+for name, value in {
+    'S3_REGION': 'us-east-1',
+    'VECTOR_BUCKET': 'bench-vectors',
+    'VECTOR_INDEX': 'bench-index',
+    'BEDROCK_MODEL_ID': 'amazon.nova-2-multimodal-embeddings-v1:0',
+    'EMBEDDING_DIMENSION': '1024',
+    'INPUT_BUCKET': 'bench-input',
+    'BATCH_ROLE_ARN': 'arn:aws:iam::000000000000:role/bench',
+    'LAMBDA_ARN': 'arn:aws:lambda:us-east-1:000000000000:function:bench',
+}.items():
+    os.environ.setdefault(name, value)
+
+import vector_embed_lambda
+import batch_processor
+from throttling import AdaptiveRateLimiter
+from fakes import Behaviour, CallRecorder, FakeS3, FakeBedrockRuntime, FakeS3Vectors
+
+INPUT_BUCKET = os.environ['INPUT_BUCKET']
+# Share of the task mix, content type and typical object size (bytes) per extension
+MEDIA_MIX = {
+    'jpg': (30, 'image/jpeg', 250 * 1024),
+    'png': (10, 'image/png', 600 * 1024),
+    'mp3': (8, 'audio/mpeg', 3 * 1024 * 1024),
+    'wav': (4, 'audio/wav', 8 * 1024 * 1024),
+    'mp4': (5, 'video/mp4', 12 * 1024 * 1024),
+    'pdf': (13, 'application/pdf', 400 * 1024),
+    'txt': (30, 'text/plain', 6 * 1024),
+}
+WORDS = ['roman', 'empire', 'river', 'harbour', 'senate', 'legion', 'trade', 'road', 'temple', 'coin']
+
+class BenchContext:
+    """Stands in for the Lambda context; the benchmark never runs into the time limit."""
+
+    def get_remaining_time_in_millis(self):
+        return 15 * 60 * 1000
+
+def object_body(extension, size, rng):
+    if extension == 'txt':
+        text = ' '.join(rng.choice(WORDS) for _ in range(max(1, size // 6)))
+        return text[:size].encode('utf-8')
+    return rng.randbytes(size)
+
+def populate_objects(s3, n_objects, size_scale, seed=0):
+    """Puts n_objects synthetic objects of the MEDIA_MIX into the fake input bucket. Returns their keys."""
+    rng = random.Random(seed)
+    extensions = list(MEDIA_MIX)
+    weights = [MEDIA_MIX[extension][0] for extension in extensions]
+    keys = []
+    for i, extension in enumerate(rng.choices(extensions, weights, k=n_objects)):
+        _, content_type, size = MEDIA_MIX[extension]
+        # Sizes vary around the typical size so the histograms have some spread
+        size = max(16, int(size * size_scale * rng.uniform(0.25, 1.75)))
+        key = f"{extension}/batch-{i % 50:02d}/object-{i:06d}.{extension}"
+        s3.put(INPUT_BUCKET, key, object_body(extension, size, rng), content_type)
+        keys.append(key)
+    return keys
+
+def batch_events(keys, tasks_per_invocation):
+    """S3 Batch Operations invocation events, tasks_per_invocation tasks each."""
+    for start in range(0, len(keys), tasks_per_invocation):
+        yield {
+            'invocationSchemaVersion': '1.0',
+            'invocationId': f'bench-invocation-{start // tasks_per_invocation}',
+            'job': {'id': 'bench-job'},
+            'tasks': [
+                {'taskId': f'task-{start + offset}', 's3BucketArn': f'arn:aws:s3:::{INPUT_BUCKET}', 's3Key': key}
+                for offset, key in enumerate(keys[start:start + tasks_per_invocation])
+            ]
+        }
+
+def latency_summary(durations, errors=0):
+    """Count, error count, percentiles (ms) and a log2 histogram of one operation's call durations."""
+    ordered = sorted(durations)
+    def percentile(p):
+        return ordered[min(len(ordered) - 1, int(math.ceil(p / 100 * len(ordered))) - 1)] * 1000 if ordered else 0.0
+    histogram = {}
+    for seconds in ordered:
+        # Buckets: <1ms, 1-2ms, 2-4ms, ...
+        upper = 1
+        while seconds * 1000 >= upper:
+            upper *= 2
+        label = f"<{upper}ms"
+        histogram[label] = histogram.get(label, 0) + 1
+    return {
+        'count': len(ordered),
+        'errors': errors,
+        'p50_ms': percentile(50),
+        'p90_ms': percentile(90),
+        'p99_ms': percentile(99),
+        'max_ms': ordered[-1] * 1000 if ordered else 0.0,
+        'histogram': histogram
+    }
+
+def stage_report(recorder):
+    return {
+        operation: latency_summary(durations, recorder.errors.get(operation, 0))
+        for operation, durations in sorted(recorder.durations.items())
+    }
+
+@contextlib.contextmanager
+def measured(verbose=False, trace_memory=False):
+    """Times the block and tracks its peak memory; the scripts' print logging is discarded unless verbose."""
+    measurement = {}
+    if trace_memory:
+        tracemalloc.start()
+    start = time.perf_counter()
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(sys.stdout if verbose else devnull):
+        yield measurement
+    measurement['seconds'] = time.perf_counter() - start
+    if trace_memory:
+        measurement['peak_traced_mb'] = tracemalloc.get_traced_memory()[1] / 1024 / 1024
+        tracemalloc.stop()
+    # ru_maxrss is in KiB on Linux; it only ever grows, so it's the process peak so far
+    measurement['max_rss_mb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def install_fakes(recorder, args):
+    """Points the Lambda's module-level clients at the fakes and returns them."""
+    s3 = FakeS3(recorder, Behaviour(args.s3_latency_ms, args.s3_latency_ms / 2, args.s3_error_rate,
+                                    bytes_per_ms=args.s3_bytes_per_ms, seed=1))
+    bedrock = FakeBedrockRuntime(recorder, vector_embed_lambda.EMBEDDING_DIMENSION,
+                                 Behaviour(args.bedrock_latency_ms, args.bedrock_latency_ms / 2, args.bedrock_error_rate,
+                                           args.bedrock_throttle_rate, seed=2))
+    s3vectors = FakeS3Vectors(recorder, Behaviour(args.vectors_latency_ms, args.vectors_latency_ms / 2,
+                                                  args.vectors_error_rate, seed=3))
+    vector_embed_lambda.s3_client = s3
+    vector_embed_lambda.bedrock_runtime = bedrock
+    vector_embed_lambda.s3vectors_client = s3vectors
+    vector_embed_lambda.bedrock_limiter = AdaptiveRateLimiter(args.bedrock_rps, max_attempts=vector_embed_lambda.BEDROCK_MAX_ATTEMPTS,
+                                                              base_delay=0.01, max_delay=0.1)
+    vector_embed_lambda.MAX_CONCURRENCY = args.concurrency
+    return s3, bedrock, s3vectors
+
+def timed_process_task(process_task, recorder):
+    """Wraps process_task so each task's end-to-end time shows up as its own stage."""
+    def wrapper(*args):
+        start = time.perf_counter()
+        result = process_task(*args)
+        recorder.record('lambda.task', time.perf_counter() - start, failed=result['resultCode'] != 'Succeeded')
+        return result
+    return wrapper
+
+def run_lambda(keys, args, recorder, label):
+    """Runs every task through lambda_handler. Returns the throughput/memory report of the run."""
+    results = {}
+    context = BenchContext()
+    with measured(args.verbose, args.trace_memory) as measurement:
+        for event in batch_events(keys, args.tasks_per_invocation):
+            start = time.perf_counter()
+            response = vector_embed_lambda.lambda_handler(event, context)
+            recorder.record('lambda.invocation', time.perf_counter() - start)
+            for result in response['results']:
+                results[result['resultCode']] = results.get(result['resultCode'], 0) + 1
+    return {
+        'run': label,
+        'objects': len(keys),
+        'objects_per_sec': len(keys) / measurement['seconds'],
+        'result_codes': results,
+        **measurement
+    }
+
+def run_manifest(args, recorder):
+    """Builds a manifest over a fake bucket of args.manifest_objects keys spread across 64 prefixes."""
+    s3 = FakeS3(recorder, Behaviour(args.list_latency_ms, args.list_latency_ms / 4, seed=4))
+    for i in range(args.manifest_objects):
+        s3.put(INPUT_BUCKET, f"prefix-{i % 64:02d}/object-{i:07d}.jpg", b'x', 'image/jpeg')
+    with measured(args.verbose, args.trace_memory) as measurement:
+        count, _ = batch_processor.create_manifest_file(s3, INPUT_BUCKET, 'batch-job-manifests/bench.csv')
+    return {
+        'run': 'create_manifest_file',
+        'objects': count,
+        'objects_per_sec': count / measurement['seconds'],
+        **measurement
+    }
+
+def run_benchmark(args):
+    """Runs the Lambda (cold, then re-run against the populated cache) and the manifest build.
+
+    Returns the full report: one entry per run plus per-stage latency summaries.
+    """
+    recorder = CallRecorder()
+    fakes = install_fakes(recorder, args)
+    keys = populate_objects(fakes[0], args.objects, args.size_scale, args.seed)
+    process_task = vector_embed_lambda.process_task
+    runs, stages = [], {}
+    try:
+        vector_embed_lambda.process_task = timed_process_task(process_task, recorder)
+        runs.append(run_lambda(keys, args, recorder, 'lambda_handler'))
+        stages['lambda_handler'] = stage_report(recorder)
+        if args.rerun:
+            # Every object is unchanged, so this measures the ETag cache skip path
+            recorder = CallRecorder()
+            for fake in fakes:
+                fake.recorder = recorder
+            vector_embed_lambda.process_task = timed_process_task(process_task, recorder)
+            runs.append(run_lambda(keys, args, recorder, 'lambda_handler (cached)'))
+            stages['lambda_handler (cached)'] = stage_report(recorder)
+    finally:
+        vector_embed_lambda.process_task = process_task
+
+    manifest_recorder = CallRecorder()
+    runs.append(run_manifest(args, manifest_recorder))
+    stages['create_manifest_file'] = stage_report(manifest_recorder)
+    return {'runs': runs, 'stages': stages}
+
+def regressions(report, baseline, tolerance):
+    """Runs whose throughput fell more than `tolerance` (a fraction) below the baseline report."""
+    previous = {run['run']: run for run in baseline['runs']}
+    slower = []
+    for run in report['runs']:
+        before = previous.get(run['run'])
+        if before and run['objects_per_sec'] < before['objects_per_sec'] * (1 - tolerance):
+            slower.append(f"{run['run']}: {run['objects_per_sec']:.1f} objects/sec, baseline {before['objects_per_sec']:.1f}")
+    return slower
+
+def print_report(report):
+    for run in report['runs']:
+        memory = f", peak traced {run['peak_traced_mb']:.1f} MB" if 'peak_traced_mb' in run else ''
+        codes = f", results {run['result_codes']}" if 'result_codes' in run else ''
+        print(f"{run['run']}: {run['objects']} objects in {run['seconds']:.2f}s = {run['objects_per_sec']:.1f} objects/sec, "
+              f"max RSS {run['max_rss_mb']:.1f} MB{memory}{codes}")
+    for name, stages in report['stages'].items():
+        print(f"\n{name} stages:")
+        for operation, summary in stages.items():
+            print(f"  {operation:32s} n={summary['count']:<7d} errors={summary['errors']:<5d} "
+                  f"p50={summary['p50_ms']:8.2f}ms p90={summary['p90_ms']:8.2f}ms "
+                  f"p99={summary['p99_ms']:8.2f}ms max={summary['max_ms']:8.2f}ms")
+            print(f"  {'':32s} {' '.join(f'{bucket}:{count}' for bucket, count in summary['histogram'].items())}")
+
+# --- Main Execution ---
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Offline throughput benchmark of lambda_handler and create_manifest_file against local fakes.")
+    parser.add_argument('--objects', type=int, default=2000, help="Mixed-media tasks sent through lambda_handler")
+    parser.add_argument('--tasks-per-invocation', type=int, default=100)
+    parser.add_argument('--concurrency', type=int, default=vector_embed_lambda.MAX_CONCURRENCY)
+    parser.add_argument('--size-scale', type=float, default=0.05, help="Multiplier on the typical object sizes in MEDIA_MIX")
+    parser.add_argument('--manifest-objects', type=int, default=100000)
+    parser.add_argument('--s3-latency-ms', type=float, default=15)
+    parser.add_argument('--s3-error-rate', type=float, default=0.0)
+    parser.add_argument('--s3-bytes-per-ms', type=float, default=50000, help="Simulated download bandwidth")
+    parser.add_argument('--list-latency-ms', type=float, default=30)
+    parser.add_argument('--bedrock-latency-ms', type=float, default=120)
+    parser.add_argument('--bedrock-error-rate', type=float, default=0.0)
+    parser.add_argument('--bedrock-throttle-rate', type=float, default=0.02)
+    parser.add_argument('--bedrock-rps', type=float, default=1000, help="Starting rate of the Lambda's adaptive limiter")
+    parser.add_argument('--vectors-latency-ms', type=float, default=40)
+    parser.add_argument('--vectors-error-rate', type=float, default=0.0)
+    parser.add_argument('--rerun', action='store_true', help="Run the tasks a second time to measure the cache skip path")
+    parser.add_argument('--trace-memory', action='store_true', help="Also report tracemalloc peaks (slows the run)")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--verbose', action='store_true', help="Keep the scripts' own log output")
+    parser.add_argument('--save', help="Write the report as JSON to this path")
+    parser.add_argument('--baseline', help="Compare against a report saved with --save; exit 1 on a throughput regression")
+    parser.add_argument('--tolerance', type=float, default=0.2, help="Allowed throughput drop against the baseline")
+    args = parser.parse_args()
+
+    report = run_benchmark(args)
+    print_report(report)
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(report, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            slower = regressions(report, json.load(f), args.tolerance)
+        for line in slower:
+            print(f"REGRESSION {line}")
+        sys.exit(1 if slower else 0)
@@ -0,0 +1,247 @@
+import hashlib
+import json
+import random
+import threading
+import time
+from collections import defaultdict
+from datetime import datetime, timezone
+from io import BytesIO
+from botocore.exceptions import ClientError
+
+class Behaviour:
+    """Latency and failure profile of a local stand-in for an AWS service.
+
+    latency_ms is the mean of an exponential-ish delay (base + jitter), error_rate the
+    fraction of calls failing with a 5xx-style error and throttle_rate the fraction
+    failing with ThrottlingException. bytes_per_ms adds transfer time for payloads.
+    """
+
+    def __init__(self, latency_ms=0.0, jitter_ms=0.0, error_rate=0.0, throttle_rate=0.0, bytes_per_ms=None, seed=0):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.bytes_per_ms = bytes_per_ms
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def delay(self, payload_bytes=0):
+        with self._lock:
+            jitter = self._random.expovariate(1 / self.jitter_ms) if self.jitter_ms else 0.0
+            roll = self._random.random()
+        seconds = (self.latency_ms + jitter) / 1000
+        if self.bytes_per_ms and payload_bytes:
+            seconds += payload_bytes / self.bytes_per_ms / 1000
+        if seconds:
+            time.sleep(seconds)
+        if roll < self.throttle_rate:
+            raise ClientError({'Error': {'Code': 'ThrottlingException', 'Message': 'Rate exceeded'},
+                               'ResponseMetadata': {'HTTPStatusCode': 429}}, 'Fake')
+        if roll < self.throttle_rate + self.error_rate:
+            raise ClientError({'Error': {'Code': 'ServiceUnavailableException', 'Message': 'Try again'},
+                               'ResponseMetadata': {'HTTPStatusCode': 503}}, 'Fake')
+
+class CallRecorder:
+    """Collects per-operation call durations and outcomes, shared by all fakes of one run.
+
+    The fakes below implement just the S3, Bedrock Runtime and S3 Vectors calls the Lambda
+    and batch_processor make, so every call they see is timed here.
+    """
+
+    def __init__(self):
+        self.durations = defaultdict(list)
+        self.errors = defaultdict(int)
+        self._lock = threading.Lock()
+
+    def record(self, operation, seconds, failed=False):
+        with self._lock:
+            self.durations[operation].append(seconds)
+            if failed:
+                self.errors[operation] += 1
+
+    def timed(self, operation, behaviour, fn, payload_bytes=0):
+        start = time.perf_counter()
+        try:
+            behaviour.delay(payload_bytes)
+            result = fn()
+        except Exception:
+            self.record(operation, time.perf_counter() - start, failed=True)
+            raise
+        self.record(operation, time.perf_counter() - start)
+        return result
+
+def fake_etag(data):
+    return f'"{hashlib.md5(data).hexdigest()}"'
+
+class FakeS3:
+    """In-memory bucket(s) supporting the object, listing and multipart calls the pipeline uses."""
+
+    def __init__(self, recorder, behaviour=None, page_size=1000):
+        self.recorder = recorder
+        self.behaviour = behaviour or Behaviour()
+        self.page_size = page_size
+        self.objects = {}
+        self._uploads = {}
+        self._lock = threading.Lock()
+
+    def put(self, bucket, key, data, content_type=None):
+        self.objects[(bucket, key)] = {
+            'Body': data,
+            'ContentType': content_type or 'binary/octet-stream',
+            'ETag': fake_etag(data),
+            'LastModified': datetime.now(timezone.utc),
+        }
+
+    def _object(self, bucket, key):
+        try:
+            return self.objects[(bucket, key)]
+        except KeyError:
+            raise ClientError({'Error': {'Code': 'NoSuchKey', 'Message': 'Not found'},
+                               'ResponseMetadata': {'HTTPStatusCode': 404}}, 'GetObject')
+
+    def get_object(self, Bucket, Key, IfNoneMatch=None):
+        def call():
+            obj = self._object(Bucket, Key)
+            if IfNoneMatch and IfNoneMatch == obj['ETag']:
+                raise ClientError({'Error': {'Code': '304', 'Message': 'Not Modified'},
+                                   'ResponseMetadata': {'HTTPStatusCode': 304}}, 'GetObject')
+            return {
+                'Body': BytesIO(obj['Body']),
+                'ContentLength': len(obj['Body']),
+                'ContentType': obj['ContentType'],
+                'ETag': obj['ETag'],
+            }
+        size = len(self.objects.get((Bucket, Key), {}).get('Body', b''))
+        return self.recorder.timed('s3.get_object', self.behaviour, call, size)
+
+    def head_object(self, Bucket, Key):
+        def call():
+            obj = self._object(Bucket, Key)
+            return {'ContentLength': len(obj['Body']), 'ContentType': obj['ContentType'], 'ETag': obj['ETag']}
+        return self.recorder.timed('s3.head_object', self.behaviour, call)
+
+    def put_object(self, Bucket, Key, Body):
+        data = Body if isinstance(Body, bytes) else bytes(Body)
+        def call():
+            self.put(Bucket, Key, data)
+            return {'ETag': self.objects[(Bucket, Key)]['ETag']}
+        return self.recorder.timed('s3.put_object', self.behaviour, call, len(data))
+
+    def create_multipart_upload(self, Bucket, Key):
+        def call():
+            with self._lock:
+                upload_id = f"upload-{len(self._uploads) + 1}"
+                self._uploads[upload_id] = {}
+            return {'UploadId': upload_id}
+        return self.recorder.timed('s3.create_multipart_upload', self.behaviour, call)
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body):
+        def call():
+            self._uploads[UploadId][PartNumber] = Body
+            return {'ETag': fake_etag(Body)}
+        return self.recorder.timed('s3.upload_part', self.behaviour, call, len(Body))
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload):
+        def call():
+            parts = self._uploads.pop(UploadId)
+            data = b''.join(parts[part['PartNumber']] for part in MultipartUpload['Parts'])
+            self.put(Bucket, Key, data)
+            return {'ETag': f'"{hashlib.md5(data).hexdigest()}-{len(parts)}"'}
+        return self.recorder.timed('s3.complete_multipart_upload', self.behaviour, call)
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId):
+        self._uploads.pop(UploadId, None)
+
+    def get_paginator(self, operation_name):
+        assert operation_name == 'list_objects_v2'
+        return FakeListObjectsPaginator(self)
+
+class FakeListObjectsPaginator:
+
+    def __init__(self, s3):
+        self.s3 = s3
+
+    def paginate(self, Bucket, Prefix='', Delimiter=None):
+        keys = sorted(key for bucket, key in self.s3.objects if bucket == Bucket and key.startswith(Prefix))
+        contents, prefixes = [], []
+        for key in keys:
+            rest = key[len(Prefix):]
+            if Delimiter and Delimiter in rest:
+                prefix = Prefix + rest.split(Delimiter, 1)[0] + Delimiter
+                if not prefixes or prefixes[-1] != prefix:
+                    prefixes.append(prefix)
+                continue
+            obj = self.s3.objects[(Bucket, key)]
+            contents.append({'Key': key, 'ETag': obj['ETag'], 'Size': len(obj['Body']), 'LastModified': obj['LastModified']})
+
+        entries = [('Contents', item) for item in contents] + [('CommonPrefixes', {'Prefix': p}) for p in prefixes]
+        for start in range(0, max(len(entries), 1), self.s3.page_size):
+            page = {}
+            for field, item in entries[start:start + self.s3.page_size]:
+                page.setdefault(field, []).append(item)
+            yield self.s3.recorder.timed('s3.list_objects_v2', self.s3.behaviour, lambda: page)
+
+class FakeBedrockRuntime:
+    """Returns deterministic pseudo-random embeddings of the configured dimension."""
+
+    def __init__(self, recorder, dimension, behaviour=None):
+        self.recorder = recorder
+        self.dimension = dimension
+        self.behaviour = behaviour or Behaviour()
+        self.async_invocations = []
+
+    def _embedding(self, body):
+        seed = int.from_bytes(hashlib.md5(bytes(body[:4096])).digest()[:4], 'little')
+        rng = random.Random(seed)
+        return [rng.uniform(-1, 1) for _ in range(self.dimension)]
+
+    def invoke_model(self, modelId, body, contentType, accept):
+        def call():
+            response = json.dumps({'embeddings': [{'embedding': self._embedding(body)}]}).encode('utf-8')
+            return {'body': BytesIO(response)}
+        return self.recorder.timed('bedrock.invoke_model', self.behaviour, call, len(body))
+
+    def start_async_invoke(self, clientRequestToken, modelId, modelInput, outputDataConfig):
+        def call():
+            self.async_invocations.append(modelInput)
+            return {'invocationArn': f"arn:aws:bedrock:us-east-1:000000000000:async-invoke/{clientRequestToken[:12]}"}
+        return self.recorder.timed('bedrock.start_async_invoke', self.behaviour, call)
+
+class FakeS3Vectors:
+    """In-memory vector index enforcing the service's per-request limits."""
+
+    def __init__(self, recorder, behaviour=None):
+        self.recorder = recorder
+        self.behaviour = behaviour or Behaviour()
+        self.vectors = {}
+        self._lock = threading.Lock()
+
+    def put_vectors(self, vectorBucketName, indexName, vectors):
+        def call():
+            if len(vectors) > 500:
+                raise ClientError({'Error': {'Code': 'ValidationException', 'Message': 'Too many vectors'}}, 'PutVectors')
+            with self._lock:
+                for vector in vectors:
+                    self.vectors[vector['key']] = vector
+            return {}
+        return self.recorder.timed('s3vectors.put_vectors', self.behaviour, call)
+
+    def get_vectors(self, vectorBucketName, indexName, keys, returnData=False, returnMetadata=False):
+        def call():
+            if len(keys) > 100:
+                raise ClientError({'Error': {'Code': 'ValidationException', 'Message': 'Too many keys'}}, 'GetVectors')
+            found = [self.vectors[key] for key in keys if key in self.vectors]
+            return {'vectors': [
+                {'key': v['key'], **({'metadata': v['metadata']} if returnMetadata else {}),
+                 **({'data': v['data']} if returnData else {})}
+                for v in found
+            ]}
+        return self.recorder.timed('s3vectors.get_vectors', self.behaviour, call)
+
+    def delete_vectors(self, vectorBucketName, indexName, keys):
+        def call():
+            with self._lock:
+                for key in keys:
+                    self.vectors.pop(key, None)
+            return {}
+        return self.recorder.timed('s3vectors.delete_vectors', self.behaviour, call)
@@ -0,0 +1,26 @@
+import unittest
+
+from bench_cold_start import measure, regressions, run_child
+
+# Which of the Lambda's clients exist right after a fresh import
+CLIENTS_AFTER_IMPORT = """
+import json, vector_embed_lambda
+print(json.dumps([name for name in ('s3_client', 'bedrock_runtime', 's3vectors_client')
+                  if getattr(vector_embed_lambda, name) is not None]))
+"""
+
+class TestBenchColdStart(unittest.TestCase):
+
+    def test_lazy_import_defers_client_creation(self):
+
+        # Timings are left to the benchmark itself; here only what the import does is checked
+        self.assertEqual(run_child(True, code=CLIENTS_AFTER_IMPORT)[0], [])
+        self.assertEqual(run_child(False, code=CLIENTS_AFTER_IMPORT)[0], ['s3_client', 'bedrock_runtime', 's3vectors_client'])
+
+        lazy = measure(True, 1)
+        baseline = {'results': [{'mode': 'lazy', 'total_ms': lazy['total_ms']}]}
+        self.assertEqual(regressions({'results': [lazy]}, baseline, 0.25), [])
+        self.assertEqual(len(regressions({'results': [{**lazy, 'total_ms': lazy['total_ms'] * 2}]}, baseline, 0.25)), 1)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,60 @@
+import unittest
+from argparse import Namespace
+
+import bench_pipeline
+from bench_pipeline import run_benchmark, regressions, latency_summary
+
+class TestBenchPipeline(unittest.TestCase):
+
+    def bench_args(self, **overrides):
+        args = dict(
+            objects=60, tasks_per_invocation=25, concurrency=4, size_scale=0.01, manifest_objects=500,
+            s3_latency_ms=0, s3_error_rate=0, s3_bytes_per_ms=None, list_latency_ms=0,
+            bedrock_latency_ms=0, bedrock_error_rate=0, bedrock_throttle_rate=0, bedrock_rps=10000,
+            vectors_latency_ms=0, vectors_error_rate=0, rerun=True, trace_memory=False, seed=0, verbose=False
+        )
+        args.update(overrides)
+        return Namespace(**args)
+
+    def test_runs_every_task_through_the_fakes(self):
+
+        report = run_benchmark(self.bench_args())
+
+        lambda_run, cached_run, manifest_run = report['runs']
+        self.assertEqual(lambda_run['result_codes'], {'Succeeded': 60})
+        self.assertEqual(cached_run['result_codes'], {'Succeeded': 60})
+        self.assertEqual(manifest_run['objects'], 500)
+        self.assertEqual(len(bench_pipeline.vector_embed_lambda.s3vectors_client.vectors), 60)
+
+        stages = report['stages']
+        self.assertEqual(stages['lambda_handler']['bedrock.invoke_model']['count'], 60)
+        # 60 vectors in batches of up to 500, one flush per invocation
+        self.assertEqual(stages['lambda_handler']['s3vectors.put_vectors']['count'], 3)
+        # Unchanged objects are skipped before Bedrock on the second run
+        self.assertNotIn('bedrock.invoke_model', stages['lambda_handler (cached)'])
+        self.assertIn('s3.list_objects_v2', stages['create_manifest_file'])
+
+    def test_throttling_is_absorbed_by_retries(self):
+
+        report = run_benchmark(self.bench_args(bedrock_throttle_rate=0.2, rerun=False))
+
+        codes = report['runs'][0]['result_codes']
+        self.assertEqual(sum(codes.values()), 60)
+        # Throttled calls are retried through the limiter, only a task that is throttled on every attempt is handed back
+        self.assertGreaterEqual(codes.get('Succeeded', 0), 55)
+        self.assertGreater(report['stages']['lambda_handler']['bedrock.invoke_model']['errors'], 0)
+
+    def test_latency_summary_and_regressions(self):
+
+        summary = latency_summary([0.0005, 0.003, 0.003, 0.010], errors=1)
+        self.assertEqual(summary['count'], 4)
+        self.assertEqual(summary['p50_ms'], 3.0)
+        self.assertEqual(summary['max_ms'], 10.0)
+        self.assertEqual(summary['histogram'], {'<1ms': 1, '<4ms': 2, '<16ms': 1})
+
+        baseline = {'runs': [{'run': 'lambda_handler', 'objects_per_sec': 100.0}]}
+        self.assertEqual(regressions({'runs': [{'run': 'lambda_handler', 'objects_per_sec': 85.0}]}, baseline, 0.2), [])
+        self.assertEqual(len(regressions({'runs': [{'run': 'lambda_handler', 'objects_per_sec': 70.0}]}, baseline, 0.2)), 1)
+
+if __name__ == '__main__':
+    unittest.main()
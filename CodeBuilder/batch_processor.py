@@ -1,8 +1,20 @@
 
 import boto3
 from botocore.exceptions import ClientError
+import csv
+import gzip
+import io
+import json
+import mimetypes
 import os
+import queue
+import threading
+import time
 import uuid
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
+from urllib.parse import unquote
 
 # Environment variables from buildspec.yml
 INPUT_BUCKET = os.environ['INPUT_BUCKET']
@@ -11,43 +23,411 @@ BATCH_ROLE_ARN = os.environ['BATCH_ROLE_ARN']
 LAMBDA_ARN = os.environ['LAMBDA_ARN']
 # Not pretty, but used to exclude the source files from processing
 SOURCE_ZIP_KEY = 'source.zip'
+# Prefix of everything the build writes to the bucket (manifests, state snapshot, deleted keys, alias map)
+BOOKKEEPING_PREFIX = 'batch-job-manifests/'
 # The VECTOR_BUCKET and VECTOR_INDEX are used inside Lambda fn, but defined here for context
+VECTOR_BUCKET = os.environ.get('VECTOR_BUCKET')
+VECTOR_INDEX = os.environ.get('VECTOR_INDEX')
+# Incremental mode: only objects that are new or changed since the last build go into the manifest
+INCREMENTAL = os.environ.get('INCREMENTAL', 'false').lower() == 'true'
+# In incremental mode, also remove the vectors of objects deleted from the bucket
+DELETE_REMOVED_VECTORS = os.environ.get('DELETE_REMOVED_VECTORS', 'false').lower() == 'true'
+# DeleteVectors accepts at most 500 keys per request, GetVectors at most 100
+MAX_VECTORS_PER_DELETE = 500
+MAX_VECTORS_PER_GET = 100
+# Number of top-level prefixes listed at the same time
+LISTING_CONCURRENCY = int(os.environ.get('LISTING_CONCURRENCY', '16'))
+# Marks the end of one prefix's listing on the page queue
+_PREFIX_DONE = object()
+# Size of each manifest multipart upload part (S3 requires at least 5 MiB for all but the last part)
+MANIFEST_PART_SIZE = int(os.environ.get('MANIFEST_PART_SIZE', str(8 * 1024 * 1024)))
+# Split the manifest by media type and size class and run one Batch job per shard
+SHARD_MANIFESTS = os.environ.get('SHARD_MANIFESTS', 'false').lower() == 'true'
+# Upper bounds (bytes) of the 'small' and 'medium' size classes; anything bigger is 'large'
+SIZE_CLASS_BOUNDS = [int(bound) for bound in os.environ.get('SIZE_CLASS_BOUNDS', f'{1024 * 1024},{16 * 1024 * 1024}').split(',')]
+# Lambda (alias) ARN per shard, e.g. {"video-large": "...:function:NovaEmbeddingProcessor:large", "small": "..."}.
+# Looked up by shard name, then media type, then size class; anything else goes to LAMBDA_ARN.
+SHARD_LAMBDA_ARNS = json.loads(os.environ.get('SHARD_LAMBDA_ARNS', '{}'))
+# Larger objects take longest per task, so their jobs get the highest priority and start first
+SIZE_CLASS_PRIORITY = {'large': 30, 'medium': 20, 'small': 10}
+# Block until all launched jobs finish, printing their combined progress
+WAIT_FOR_JOBS = os.environ.get('WAIT_FOR_JOBS', 'false').lower() == 'true'
+JOB_POLL_SECONDS = int(os.environ.get('JOB_POLL_SECONDS', '30'))
+TERMINAL_JOB_STATUSES = {'Complete', 'Failed', 'Cancelled'}
+# Where the Batch jobs write their completion reports, below job-<job id>/
+REPORT_PREFIX = 'batch-job-reports/'
+# Build output is never embedded itself
+EXCLUDED_PREFIXES = (BOOKKEEPING_PREFIX, REPORT_PREFIX)
+# Embed each distinct content once: objects with the same ETag and size as an earlier one are left
+# out of the manifest and get a copy of its vector through the alias map passed to the Lambda.
+# In incremental mode only new or changed objects are grouped, so a new copy of unchanged content
+# is embedded again.
+DEDUPLICATE = os.environ.get('DEDUPLICATE', 'false').lower() == 'true'
 
-def create_manifest_file(s3_client, bucket_name, manifest_key):
-    """Lists objects in the source bucket and creates the CSV manifest file."""
-    print(f"Listing objects in s3://{bucket_name}...")
-    
-    # Use paginator for large numbers of objects
+class ManifestState:
+    """Snapshot of key -> [ETag, LastModified] for every object the previous build listed.
+
+    Stored in the bucket as gzipped JSON. observe() is called for every listed object and
+    reports whether it is new or changed; whatever was in the previous snapshot but never
+    observed has been deleted. New and changed keys stay pending until confirm() is called
+    for them, so a key whose task failed is offered again by the next build. Keys still
+    pending when the state is saved are kept aside with the IDs of the jobs they were handed
+    to (and the ETag of the alias map those jobs used), and confirm_previous() promotes them
+    once those jobs report them as embedded.
+    """
+
+    def __init__(self, previous=None, unconfirmed=None, job_ids=(), alias_map_etag=None):
+        self.previous = previous or {}
+        self.unconfirmed = unconfirmed or {}
+        self.job_ids = list(job_ids)
+        self.alias_map_etag = alias_map_etag
+        self.current = {}
+        self.pending = set()
+
+    @classmethod
+    def load(cls, s3_client, bucket_name, state_key):
+        try:
+            response = s3_client.get_object(Bucket=bucket_name, Key=state_key)
+        except ClientError as e:
+            if e.response.get('Error', {}).get('Code') not in ('NoSuchKey', '404'):
+                raise
+            print(f"No previous manifest state at s3://{bucket_name}/{state_key}, listing everything as new")
+            return cls()
+        state = json.loads(gzip.decompress(response['Body'].read()))
+        # Snapshots written before unconfirmed keys were tracked are the plain key map
+        if 'objects' not in state:
+            return cls(state)
+        return cls(state['objects'], state.get('unconfirmed'), state.get('jobs', []), state.get('alias_map_etag'))
+
+    def confirm_previous(self, keys):
+        """Records keys the previous build's jobs embedded as part of the previous snapshot."""
+        for key in keys:
+            if key in self.unconfirmed:
+                self.previous[key] = self.unconfirmed.pop(key)
+
+    def observe(self, obj):
+        """Records a listed object and returns True if it is new or changed since the previous build."""
+        entry = [obj['ETag'].strip('"'), int(obj['LastModified'].timestamp())]
+        self.current[obj['Key']] = entry
+        if self.previous.get(obj['Key']) == entry:
+            return False
+        self.pending.add(obj['Key'])
+        return True
+
+    def confirm(self, keys):
+        """Records pending keys as embedded, e.g. those the finished jobs report as succeeded."""
+        self.pending.difference_update(keys)
+
+    def deleted_keys(self):
+        return sorted((self.previous.keys() | self.unconfirmed.keys()) - self.current.keys())
+
+    def save(self, s3_client, bucket_name, state_key, job_ids=(), alias_map_etag=None):
+        """Saves the listing; keys still pending are stored apart with the jobs they were handed to."""
+        objects = {key: entry for key, entry in self.current.items() if key not in self.pending}
+        # A pending key keeps its previous entry, so it counts as changed until it is confirmed
+        objects.update((key, self.previous[key]) for key in self.pending if key in self.previous)
+        state = {
+            'objects': objects,
+            'unconfirmed': {key: self.current[key] for key in self.pending},
+            'jobs': list(job_ids) if self.pending else [],
+            'alias_map_etag': alias_map_etag if self.pending else None
+        }
+        body = gzip.compress(json.dumps(state, separators=(',', ':')).encode('utf-8'))
+        s3_client.put_object(Bucket=bucket_name, Key=state_key, Body=body)
+        print(f"Saved manifest state for {len(objects)} objects ({len(self.pending)} not yet confirmed as embedded) "
+              f"to s3://{bucket_name}/{state_key}")
+
+class DuplicateGroups:
+    """Groups listed objects with identical content, by ETag and size, under the first key seen.
+
+    Multipart ETags depend on the part size as well as the content, so copies uploaded with
+    different part sizes are not recognised; they are simply embedded separately.
+    """
+
+    def __init__(self):
+        self.canonical = {}
+        self.aliases = {}
+
+    def observe(self, obj):
+        """Records a listed object and returns False if it duplicates one already seen."""
+        content = (obj['ETag'].strip('"'), obj.get('Size'))
+        canonical_key = self.canonical.setdefault(content, obj['Key'])
+        if canonical_key == obj['Key']:
+            return True
+        self.aliases.setdefault(canonical_key, []).append(obj['Key'])
+        return False
+
+    def alias_count(self):
+        return sum(len(keys) for keys in self.aliases.values())
+
+    def save(self, s3_client, bucket_name, key):
+        """Uploads the alias map ({canonical key: [duplicate keys]}) and returns its ETag."""
+        body = json.dumps(self.aliases, separators=(',', ':')).encode('utf-8')
+        response = s3_client.put_object(Bucket=bucket_name, Key=key, Body=body)
+        print(f"Saved {self.alias_count()} duplicate keys of {len(self.aliases)} objects to s3://{bucket_name}/{key}")
+        return response['ETag'].strip('"')
+
+def list_objects(s3_client, bucket_name, max_workers=LISTING_CONCURRENCY):
+    """Yields every object in the bucket, listing the top-level prefixes concurrently.
+
+    A delimiter listing returns the objects at the bucket root plus the top-level prefixes.
+    Each prefix is then paged through on its own thread, and pages are yielded as soon as
+    they arrive, so objects come back in no particular order.
+    """
     paginator = s3_client.get_paginator('list_objects_v2')
-    pages = paginator.paginate(Bucket=bucket_name)
+    prefixes = []
+    for page in paginator.paginate(Bucket=bucket_name, Delimiter='/'):
+        yield from page.get('Contents', [])
+        prefixes.extend(common_prefix['Prefix'] for common_prefix in page.get('CommonPrefixes', []))
+    if not prefixes:
+        return
 
-    # Batch process S3 objects and write to manifest file
-    object_count = 0
-    with open("manifest.csv", "w") as f:
-        for page in pages:
-            if "Contents" in page:
-                for obj in page["Contents"]:
-                    # Skip folders, and the manifest file itself if it's in the same bucket
-                    # Also skip any key that ends with the SOURCE_ZIP_KEY (case-insensitive)
-                    key = obj["Key"]
-                    if (not key.endswith('/') and key != manifest_key and not key.lower().endswith(SOURCE_ZIP_KEY.lower())):
-                        # Format is: BucketName,KeyName
-                        f.write(f"{bucket_name},{key}\n")
-                        object_count += 1
+    # Bounded so fast listers wait for the manifest writer instead of piling pages up in memory
+    pages = queue.Queue(maxsize=max_workers * 4)
+    stop = threading.Event()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                pages.put(item, timeout=1)
+                return
+            except queue.Full:
+                continue
+
+    def list_prefix(prefix):
+        try:
+            for page in s3_client.get_paginator('list_objects_v2').paginate(Bucket=bucket_name, Prefix=prefix):
+                put(page.get('Contents', []))
+        except Exception as e:
+            put(e)
+        finally:
+            put(_PREFIX_DONE)
+
+    print(f"Listing {len(prefixes)} top-level prefixes with {min(max_workers, len(prefixes))} workers...")
+    executor = ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(prefixes))))
+    try:
+        for prefix in prefixes:
+            executor.submit(list_prefix, prefix)
+        remaining = len(prefixes)
+        while remaining:
+            item = pages.get()
+            if item is _PREFIX_DONE:
+                remaining -= 1
+            elif isinstance(item, Exception):
+                raise item
+            else:
+                yield from item
+    finally:
+        stop.set()
+        executor.shutdown(wait=False, cancel_futures=True)
+
+class S3ManifestWriter:
+    """Streams the manifest straight to S3 while it is being written.
+
+    Lines are buffered until a part is full, then sent with upload_part, so memory stays
+    around one part no matter how many keys the manifest holds. A manifest smaller than
+    one part is sent with a single put_object. close() returns the raw ETag of the
+    uploaded manifest, taken from the completion response.
+    """
+
+    def __init__(self, s3_client, bucket_name, key, part_size=MANIFEST_PART_SIZE):
+        self.s3_client = s3_client
+        self.bucket_name = bucket_name
+        self.key = key
+        self.part_size = max(part_size, 5 * 1024 * 1024)
+        self._buffer = bytearray()
+        self._upload_id = None
+        self._parts = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None:
+            self.abort()
+
+    def write(self, text):
+        self._buffer.extend(text.encode('utf-8'))
+        if len(self._buffer) >= self.part_size:
+            self._upload_part()
+
+    def _upload_part(self):
+        if self._upload_id is None:
+            response = self.s3_client.create_multipart_upload(Bucket=self.bucket_name, Key=self.key)
+            self._upload_id = response['UploadId']
+        part_number = len(self._parts) + 1
+        response = self.s3_client.upload_part(
+            Bucket=self.bucket_name,
+            Key=self.key,
+            UploadId=self._upload_id,
+            PartNumber=part_number,
+            Body=bytes(self._buffer)
+        )
+        self._parts.append({'ETag': response['ETag'], 'PartNumber': part_number})
+        self._buffer = bytearray()
+
+    def close(self):
+        """Finishes the upload and returns the manifest's ETag without quotes."""
+        if self._upload_id is None:
+            response = self.s3_client.put_object(Bucket=self.bucket_name, Key=self.key, Body=bytes(self._buffer))
+        else:
+            if self._buffer:
+                self._upload_part()
+            response = self.s3_client.complete_multipart_upload(
+                Bucket=self.bucket_name,
+                Key=self.key,
+                UploadId=self._upload_id,
+                MultipartUpload={'Parts': self._parts}
+            )
+            # The upload is finished, so a later error in the with block must not abort it
+            self._upload_id = None
+        # CreateJob API requires raw hash, so strip quotes.
+        return response['ETag'].strip('"')
+
+    def abort(self):
+        if self._upload_id is not None:
+            self.s3_client.abort_multipart_upload(Bucket=self.bucket_name, Key=self.key, UploadId=self._upload_id)
+            self._upload_id = None
+
+def manifest_objects(s3_client, bucket_name, is_excluded, state=None, duplicates=None):
+    """Yields the listed objects that belong in the manifest. is_excluded(key) marks manifests outside BOOKKEEPING_PREFIX to leave out.
+
+    With DuplicateGroups, only the first object of each distinct content is yielded.
+    """
+    for obj in list_objects(s3_client, bucket_name):
+        # Skip folders, the manifests and other build output if they're in the same bucket
+        # Also skip any key that ends with the SOURCE_ZIP_KEY (case-insensitive)
+        key = obj["Key"]
+        if (not key.endswith('/') and not key.startswith(EXCLUDED_PREFIXES) and not is_excluded(key)
+                and not key.lower().endswith(SOURCE_ZIP_KEY.lower())):
+            # Incremental mode: unchanged objects already have current vectors
+            if state is not None and not state.observe(obj):
+                continue
+            if duplicates is not None and not duplicates.observe(obj):
+                continue
+            yield obj
+
+def create_manifest_file(s3_client, bucket_name, manifest_key, state=None, duplicates=None):
+    """Lists objects in the source bucket and creates the CSV manifest file.
+
+    With a ManifestState, only objects that are new or changed since the previous build are written.
+    With DuplicateGroups, duplicate objects are recorded there instead of being written.
+    """
+    print(f"Listing objects in s3://{bucket_name}...")
     
-    # Upload manifest to S3
-    s3_client.upload_file("manifest.csv", bucket_name, manifest_key)
+    # Stream S3 objects from the prefix-sharded listing straight into the manifest upload
+    object_count = 0
+    with S3ManifestWriter(s3_client, bucket_name, manifest_key) as f:
+        for obj in manifest_objects(s3_client, bucket_name, lambda key: key == manifest_key, state, duplicates):
+            # Format is: BucketName,KeyName
+            f.write(f"{bucket_name},{obj['Key']}\n")
+            object_count += 1
 
-    # Store ETag of newly uploaded manifest file
-    head_object_response = s3_client.head_object(Bucket=bucket_name, Key=manifest_key)
-    # CreateJob API requires raw hash, so strip quotes.
-    etag = head_object_response['ETag'].strip('"')
+        # ETag of the newly uploaded manifest file comes from the upload itself
+        etag = f.close()
     
     print(f"Created manifest with {object_count} objects and uploaded to s3://{bucket_name}/{manifest_key}")
     return object_count, etag # Return both count and etag
 
-def create_s3_batch_job(s3control_client, account_id, manifest_key, manifest_etag):
-    """Creates the S3 Batch Operations job to process the manifest using Lambda."""
+def media_class(key):
+    """The Nova MME media type the Lambda will use for a key, guessed from its extension ('other' if unknown)."""
+    content_type, _ = mimetypes.guess_type(key)
+    if content_type is None:
+        return 'other'
+    if content_type == 'application/pdf':
+        return 'document'
+    media = content_type.split('/')[0]
+    return media if media in ('image', 'audio', 'video', 'text') else 'other'
+
+def size_class(size):
+    for name, bound in zip(('small', 'medium'), SIZE_CLASS_BOUNDS):
+        if size <= bound:
+            return name
+    return 'large'
+
+def shard_name(obj):
+    """Shard of a listed object, e.g. 'video-large', from its extension and the Size returned by the listing."""
+    return f"{media_class(obj['Key'])}-{size_class(obj.get('Size', 0))}"
+
+def shard_lambda_arn(shard):
+    media, size = shard.rsplit('-', 1)
+    return SHARD_LAMBDA_ARNS.get(shard) or SHARD_LAMBDA_ARNS.get(media) or SHARD_LAMBDA_ARNS.get(size) or LAMBDA_ARN
+
+def shard_priority(shard):
+    return SIZE_CLASS_PRIORITY[shard.rsplit('-', 1)[1]]
+
+def create_sharded_manifests(s3_client, bucket_name, manifest_prefix, state=None, duplicates=None):
+    """Lists the bucket once and writes one manifest per shard, named <manifest_prefix>-<shard>.csv.
+
+    Returns {shard: {'key', 'count', 'etag'}} for every shard that received objects. Every
+    key starting with manifest_prefix is treated as a manifest and left out.
+    """
+    print(f"Listing objects in s3://{bucket_name} into sharded manifests...")
+    writers = {}
+    counts = Counter()
+    with ExitStack() as stack:
+        for obj in manifest_objects(s3_client, bucket_name, lambda key: key.startswith(manifest_prefix), state, duplicates):
+            shard = shard_name(obj)
+            if shard not in writers:
+                writers[shard] = stack.enter_context(S3ManifestWriter(s3_client, bucket_name, f"{manifest_prefix}-{shard}.csv"))
+            writers[shard].write(f"{bucket_name},{obj['Key']}\n")
+            counts[shard] += 1
+
+        manifests = {
+            shard: {'key': writer.key, 'count': counts[shard], 'etag': writer.close()}
+            for shard, writer in writers.items()
+        }
+
+    for shard, manifest in sorted(manifests.items()):
+        print(f"Created {shard} manifest with {manifest['count']} objects at s3://{bucket_name}/{manifest['key']}")
+    return manifests
+
+def write_deleted_keys(s3_client, bucket_name, deleted_key, keys):
+    """Uploads the keys removed from the bucket since the previous build, in the manifest's CSV format."""
+    body = ''.join(f"{bucket_name},{key}\n" for key in keys)
+    s3_client.put_object(Bucket=bucket_name, Key=deleted_key, Body=body.encode('utf-8'))
+    print(f"Wrote {len(keys)} deleted keys to s3://{bucket_name}/{deleted_key}")
+
+def with_segment_keys(s3vectors_client, keys):
+    """Adds the <key>#seg-N vectors of objects that the Lambda embedded in segments.
+
+    Segmented objects have no vector under their plain key; the first segment records how
+    many segments there are.
+    """
+    all_keys = list(keys)
+    for start in range(0, len(keys), MAX_VECTORS_PER_GET):
+        response = s3vectors_client.get_vectors(
+            vectorBucketName=VECTOR_BUCKET,
+            indexName=VECTOR_INDEX,
+            keys=[f"{key}#seg-0" for key in keys[start:start + MAX_VECTORS_PER_GET]],
+            returnData=False,
+            returnMetadata=True
+        )
+        for vector in response.get('vectors', []):
+            metadata = vector.get('metadata') or {}
+            source_key = metadata.get('source_key', vector['key'].rsplit('#seg-', 1)[0])
+            all_keys.extend(f"{source_key}#seg-{index}" for index in range(int(metadata.get('segment_count', 1))))
+    return all_keys
+
+def delete_removed_vectors(s3vectors_client, keys):
+    """Removes the vectors (including segment vectors) of deleted objects from the vector index."""
+    keys = with_segment_keys(s3vectors_client, keys)
+    for start in range(0, len(keys), MAX_VECTORS_PER_DELETE):
+        s3vectors_client.delete_vectors(
+            vectorBucketName=VECTOR_BUCKET,
+            indexName=VECTOR_INDEX,
+            keys=keys[start:start + MAX_VECTORS_PER_DELETE]
+        )
+    print(f"Deleted {len(keys)} vectors from index {VECTOR_INDEX}")
+
+def create_s3_batch_job(s3control_client, account_id, manifest_key, manifest_etag, function_arn=None, priority=10, label=None,
+                        user_arguments=None):
+    """Creates the S3 Batch Operations job to process the manifest using Lambda.
+
+    function_arn (default LAMBDA_ARN) can point at a Lambda alias sized for the manifest's
+    objects; label names the shard in the job description. user_arguments are passed to
+    every invocation, which then uses invocation schema 2.0.
+    """
     
     job_id = str(uuid.uuid4())
     print(f"Creating S3 Batch Job with ID: {job_id}")
@@ -61,14 +441,14 @@ def create_s3_batch_job(s3control_client, account_id, manifest_key, manifest_eta
         'ClientRequestToken': job_id,
         'Operation': {
             'LambdaInvoke': {
-                'FunctionArn': LAMBDA_ARN
+                'FunctionArn': function_arn or LAMBDA_ARN
             }
         },
         'Report': {
             # The CreateJob API expects the report bucket as an S3 ARN when calling S3Control.
             # Use the bucket ARN in the payload for real AWS calls.
             'Bucket': f'arn:aws:s3:::{INPUT_BUCKET}',
-            'Prefix': 'batch-job-reports/',
+            'Prefix': REPORT_PREFIX,
             'Format': 'Report_CSV_20180820',
             'Enabled': True,
             'ReportScope': 'AllTasks',
@@ -84,12 +464,18 @@ def create_s3_batch_job(s3control_client, account_id, manifest_key, manifest_eta
                 'ETag': manifest_etag_for_request
             }
         },
-        'Priority': 10,
+        'Priority': priority,
         'RoleArn': BATCH_ROLE_ARN,
-        'Description': f'Nova-Embeddings-Batch-Job-{job_id[:8]}'
+        'Description': f'Nova-Embeddings-Batch-Job-{label}-{job_id[:8]}' if label else f'Nova-Embeddings-Batch-Job-{job_id[:8]}'
     }
 
     # Print payload for debugging (do not leak secrets in production logs)
+    if user_arguments:
+        job_request['Operation']['LambdaInvoke'].update({
+            'InvocationSchemaVersion': '2.0',
+            'UserArguments': user_arguments
+        })
+
     print("S3 Batch create_job payload:", job_request)
 
     try:
@@ -115,6 +501,65 @@ def create_s3_batch_job(s3control_client, account_id, manifest_key, manifest_eta
     print(f"S3 Batch Job created. Job ARN: {response.get('JobArn')}")
     return response.get('JobId')
 
+def jobs_progress(s3control_client, account_id, job_ids):
+    """Combined progress of several Batch jobs: task counts summed over the jobs, plus each job's status."""
+    progress = {'TotalNumberOfTasks': 0, 'NumberOfTasksSucceeded': 0, 'NumberOfTasksFailed': 0, 'statuses': {}}
+    for job_id in job_ids:
+        job = s3control_client.describe_job(AccountId=account_id, JobId=job_id)['Job']
+        progress['statuses'][job_id] = job['Status']
+        summary = job.get('ProgressSummary', {})
+        for field in ('TotalNumberOfTasks', 'NumberOfTasksSucceeded', 'NumberOfTasksFailed'):
+            progress[field] += summary.get(field, 0)
+    progress['done'] = all(status in TERMINAL_JOB_STATUSES for status in progress['statuses'].values())
+    return progress
+
+def wait_for_jobs(s3control_client, account_id, job_ids, poll_seconds=JOB_POLL_SECONDS):
+    """Polls the jobs until all of them reach a terminal status, printing their combined progress. Returns the final progress."""
+    while True:
+        progress = jobs_progress(s3control_client, account_id, job_ids)
+        finished = progress['NumberOfTasksSucceeded'] + progress['NumberOfTasksFailed']
+        statuses = ', '.join(f"{count} {status}" for status, count in sorted(Counter(progress['statuses'].values()).items()))
+        print(f"{finished}/{progress['TotalNumberOfTasks']} tasks done ({progress['NumberOfTasksFailed']} failed) "
+              f"across {len(job_ids)} jobs: {statuses}")
+        if progress['done']:
+            return progress
+        time.sleep(poll_seconds)
+
+def load_alias_map(s3_client, bucket_name, key, etag):
+    """The alias map a job was launched with, if it is still the one with that ETag ({} otherwise)."""
+    try:
+        response = s3_client.get_object(Bucket=bucket_name, Key=key, IfMatch=etag)
+    except ClientError as e:
+        if e.response.get('Error', {}).get('Code') not in ('NoSuchKey', '404', 'PreconditionFailed', '412'):
+            raise
+        print(f"Alias map s3://{bucket_name}/{key} has changed since the previous build, its duplicates are offered again")
+        return {}
+    return json.loads(response['Body'].read())
+
+def with_aliases(keys, alias_map):
+    """The keys plus the duplicates that got a copy of their vectors."""
+    return set(keys) | {alias for key in keys for alias in alias_map.get(key, [])}
+
+def embedded_task_keys(s3_client, bucket_name, job_ids):
+    """Keys whose tasks succeeded in the finished jobs, read from their completion reports.
+
+    Tasks that only started an asynchronous embedding ('Pending: ...') are left out, since
+    their vector may still fail to land.
+    """
+    keys = set()
+    for job_id in job_ids:
+        report_key = f"{REPORT_PREFIX.rstrip('/')}/job-{job_id}/manifest.json"
+        report = json.loads(s3_client.get_object(Bucket=bucket_name, Key=report_key)['Body'].read())
+        for result in report.get('Results', []):
+            if result.get('TaskExecutionStatus') != 'succeeded':
+                continue
+            body = s3_client.get_object(Bucket=result.get('Bucket', bucket_name).split(':::')[-1], Key=result['Key'])['Body'].read()
+            # Bucket, Key (URL-encoded), VersionId, TaskStatus, ErrorCode, HTTPStatusCode, ResultMessage
+            for row in csv.reader(io.StringIO(body.decode('utf-8'))):
+                if len(row) > 3 and row[3] == 'succeeded' and not row[-1].startswith('Pending:'):
+                    keys.add(unquote(row[1]))
+    return keys
+
 # --- Main Execution ---
 if __name__ == "__main__":
     
@@ -126,12 +571,87 @@ if __name__ == "__main__":
     account_id = sts_client.get_caller_identity()['Account']
     
     MANIFEST_KEY = 'batch-job-manifests/multimedia-manifest.csv'
+    # Sharded manifests are written as <prefix>-<shard>.csv
+    SHARD_MANIFEST_PREFIX = 'batch-job-manifests/multimedia-manifest'
+    STATE_KEY = 'batch-job-manifests/manifest-state.json.gz'
+    DELETED_KEYS_KEY = 'batch-job-manifests/deleted-keys.csv'
+    ALIAS_MAP_KEY = 'batch-job-manifests/aliases.json'
+
+    state = ManifestState.load(s3_client, INPUT_BUCKET, STATE_KEY) if INCREMENTAL else None
+    if state is not None and state.job_ids:
+        # Objects the previous build's finished jobs embedded need not be offered again
+        previous_jobs = jobs_progress(s3control_client, account_id, state.job_ids)['statuses']
+        embedded = embedded_task_keys(
+            s3_client, INPUT_BUCKET, [job_id for job_id, status in previous_jobs.items() if status == 'Complete']
+        )
+        # Duplicates are embedded together with the object they copy
+        alias_map = load_alias_map(s3_client, INPUT_BUCKET, ALIAS_MAP_KEY, state.alias_map_etag) if state.alias_map_etag else {}
+        state.confirm_previous(with_aliases(embedded, alias_map))
+    duplicates = DuplicateGroups() if DEDUPLICATE else None
     
-    # Receives both count and ETag now. woo
-    object_count, manifest_etag = create_manifest_file(s3_client, INPUT_BUCKET, MANIFEST_KEY)
+    jobs = {}
+    if SHARD_MANIFESTS:
+        shards = create_sharded_manifests(
+            s3_client, INPUT_BUCKET, SHARD_MANIFEST_PREFIX, state=state, duplicates=duplicates
+        )
+        object_count = sum(manifest['count'] for manifest in shards.values())
+    else:
+        # Receives both count and ETag now. woo
+        object_count, manifest_etag = create_manifest_file(
+            s3_client, INPUT_BUCKET, MANIFEST_KEY, state=state, duplicates=duplicates
+        )
+
+    if state is not None:
+        deleted_keys = state.deleted_keys()
+        if deleted_keys:
+            write_deleted_keys(s3_client, INPUT_BUCKET, DELETED_KEYS_KEY, deleted_keys)
+            if DELETE_REMOVED_VECTORS:
+                delete_removed_vectors(boto3.client('s3vectors', region_name=S3_REGION), deleted_keys)
+
+    # The Lambda stores a copy of each canonical object's vector under its duplicates
+    user_arguments = None
+    if duplicates is not None and duplicates.aliases and object_count > 0:
+        user_arguments = {
+            'AliasMapBucket': INPUT_BUCKET,
+            'AliasMapKey': ALIAS_MAP_KEY,
+            'AliasMapETag': duplicates.save(s3_client, INPUT_BUCKET, ALIAS_MAP_KEY)
+        }
     
-    if object_count > 0:
-        job_id = create_s3_batch_job(s3control_client, account_id, MANIFEST_KEY, manifest_etag)
+    if object_count > 0 and SHARD_MANIFESTS:
+        for shard, manifest in sorted(shards.items(), key=lambda item: -shard_priority(item[0])):
+            jobs[shard] = create_s3_batch_job(
+                s3control_client, account_id, manifest['key'], manifest['etag'],
+                function_arn=shard_lambda_arn(shard), priority=shard_priority(shard), label=shard,
+                user_arguments=user_arguments
+            )
+        print(f"Successfully launched {len(jobs)} S3 Batch Operations jobs: {jobs}")
+    elif object_count > 0:
+        job_id = create_s3_batch_job(s3control_client, account_id, MANIFEST_KEY, manifest_etag, user_arguments=user_arguments)
+        jobs['all'] = job_id
         print(f"Successfully launched S3 Batch Operations job: {job_id}")
     else:
-        print("No files found to process. Skipping S3 Batch Job creation.")
\ No newline at end of file
+        print("No files found to process. Skipping S3 Batch Job creation.")
+
+    # Build artifact listing what was launched
+    with open('job_details.txt', 'w') as f:
+        for shard, job_id in jobs.items():
+            f.write(f"{shard},{job_id}\n")
+
+    failed_jobs = []
+    if jobs and WAIT_FOR_JOBS:
+        progress = wait_for_jobs(s3control_client, account_id, list(jobs.values()))
+        failed_jobs = [job_id for job_id, status in progress['statuses'].items() if status != 'Complete']
+        if state is not None:
+            # Duplicates are embedded together with the object they copy
+            embedded = embedded_task_keys(s3_client, INPUT_BUCKET, [job_id for job_id in jobs.values() if job_id not in failed_jobs])
+            state.confirm(with_aliases(embedded, duplicates.aliases if duplicates else {}))
+
+    # Objects not confirmed as embedded yet are checked against the job reports by the next build
+    if state is not None:
+        state.save(
+            s3_client, INPUT_BUCKET, STATE_KEY, job_ids=jobs.values(),
+            alias_map_etag=user_arguments['AliasMapETag'] if user_arguments else None
+        )
+
+    if failed_jobs:
+        raise RuntimeError(f"S3 Batch jobs did not complete: {failed_jobs}")
\ No newline at end of file
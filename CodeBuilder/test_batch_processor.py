@@ -1,6 +1,9 @@
 import unittest
+import gzip
+import json
 import os
 from unittest.mock import patch, MagicMock
+from datetime import datetime, timezone
 
 # --- 1. Set Environment Variables BEFORE import ---
 # Use the values from your buildspec.yml for mock consistency
@@ -10,7 +13,9 @@ os.environ['BATCH_ROLE_ARN'] = "arn:aws:iam::123456789012:role/S3BatchOpsRole"
 os.environ['LAMBDA_ARN'] = "arn:aws:lambda:us-east-1:123456789012:function:NovaEmbeddingProcessor"
 
 # Now we can safely import the module
-from batch_processor import create_manifest_file, create_s3_batch_job
+from batch_processor import create_manifest_file, create_s3_batch_job, ManifestState, list_objects, S3ManifestWriter, delete_removed_vectors
+from batch_processor import create_sharded_manifests, shard_lambda_arn, shard_priority, jobs_progress, DuplicateGroups
+from batch_processor import embedded_task_keys, load_alias_map, with_aliases
 
 # Mock constants for test assertions
 MOCK_ACCOUNT_ID = '987654321098'
@@ -22,8 +27,7 @@ class TestBatchProcessor(unittest.TestCase):
 
     @patch('batch_processor.boto3')
     @patch('batch_processor.uuid')
-    @patch('batch_processor.open', new_callable=MagicMock)
-    def test_end_to_end_job_creation(self, mock_open, mock_uuid, mock_boto3):
+    def test_end_to_end_job_creation(self, mock_uuid, mock_boto3):
         
         # --- Mock Setup ---
         mock_uuid.uuid4.return_value = MagicMock(hex=MOCK_JOB_ID)
@@ -36,9 +40,9 @@ class TestBatchProcessor(unittest.TestCase):
         mock_s3control_client = MagicMock()
         mock_s3control_client.create_job.return_value = {'JobId': MOCK_JOB_ID}
         
-        # 3. Mock S3 Client: Listing, Uploading, and ETag fetching
+        # 3. Mock S3 Client: Listing and Uploading (the upload response carries the ETag)
         mock_s3_client = MagicMock()
-        mock_s3_client.head_object.return_value = {'ETag': f'"{MOCK_ETAG}"'} # ETag is returned with quotes
+        mock_s3_client.put_object.return_value = {'ETag': f'"{MOCK_ETAG}"'} # ETag is returned with quotes
         
         mock_s3_objects = [{'Key': 'image1.jpg'}, {'Key': 'audio/song.mp3'}]
         mock_paginator = MagicMock()
@@ -65,6 +69,7 @@ class TestBatchProcessor(unittest.TestCase):
         self.assertEqual(object_count, 2, "Should have counted 2 valid objects.")
         self.assertEqual(manifest_etag, MOCK_ETAG, "Should have returned the raw ETag.")
         self.assertEqual(job_id, MOCK_JOB_ID, "Should have returned the mocked job ID.")
+        mock_s3_client.head_object.assert_not_called()
 
         # 1. Assert S3 Control Job Parameters (Rigorously check the call)
         mock_s3control_client.create_job.assert_called_once()
@@ -87,5 +92,244 @@ class TestBatchProcessor(unittest.TestCase):
         self.assertEqual(job_call_kwargs['Manifest']['Location']['ObjectArn'], expected_manifest_arn, "Manifest ObjectArn must be in ARN format.")
         self.assertEqual(job_call_kwargs['Manifest']['Location']['ETag'], MOCK_ETAG, "Manifest ETag must be the raw hash.")
 
+    def test_incremental_manifest_only_lists_new_and_changed_objects(self):
+
+        modified = datetime(2025, 1, 1, tzinfo=timezone.utc)
+        ts = int(modified.timestamp())
+        state = ManifestState({
+            'same.jpg': ['etag-same', ts],
+            'changed.jpg': ['etag-old', ts],
+            'removed.mp4': ['etag-removed', ts],
+        })
+
+        mock_s3_client = MagicMock()
+        mock_s3_client.put_object.return_value = {'ETag': f'"{MOCK_ETAG}"'}
+        mock_paginator = MagicMock()
+        mock_paginator.paginate.return_value = [{'Contents': [
+            {'Key': 'same.jpg', 'ETag': '"etag-same"', 'LastModified': modified},
+            {'Key': 'changed.jpg', 'ETag': '"etag-new"', 'LastModified': modified},
+            {'Key': 'new.pdf', 'ETag': '"etag-pdf"', 'LastModified': modified},
+        ]}]
+        mock_s3_client.get_paginator.return_value = mock_paginator
+
+        object_count, _ = create_manifest_file(mock_s3_client, os.environ['INPUT_BUCKET'], MANIFEST_KEY, state=state)
+
+        written = mock_s3_client.put_object.call_args[1]['Body'].decode('utf-8')
+        self.assertEqual(object_count, 2)
+        self.assertNotIn('same.jpg', written)
+        self.assertIn('changed.jpg', written)
+        self.assertIn('new.pdf', written)
+        self.assertEqual(state.deleted_keys(), ['removed.mp4'])
+        self.assertEqual(sorted(state.current), ['changed.jpg', 'new.pdf', 'same.jpg'])
+
+    def test_objects_are_only_remembered_once_a_job_reports_them_embedded(self):
+
+        modified = datetime(2025, 1, 1, tzinfo=timezone.utc)
+        ts = int(modified.timestamp())
+        listing = [
+            {'Key': 'ok.jpg', 'ETag': '"etag-ok"', 'LastModified': modified},
+            {'Key': 'failed.jpg', 'ETag': '"etag-failed"', 'LastModified': modified},
+            {'Key': 'clip.mp4', 'ETag': '"etag-clip"', 'LastModified': modified},
+            # A duplicate of ok.jpg, left out of the manifest and given a copy of its vector
+            {'Key': 'copy-of-ok.jpg', 'ETag': '"etag-ok"', 'LastModified': modified},
+        ]
+        bucket = os.environ['INPUT_BUCKET']
+        report_rows = (f'{bucket},ok.jpg,,succeeded,200,,Successfully embedded ok.jpg\n'
+                       f'{bucket},clip.mp4,,succeeded,200,,"Pending: asynchronous embedding of clip.mp4 started"\n')
+        objects = {
+            'batch-job-reports/job-job-1/manifest.json': json.dumps({'Results': [
+                {'TaskExecutionStatus': 'succeeded', 'Bucket': bucket, 'Key': 'batch-job-reports/job-job-1/results/1.csv'},
+                {'TaskExecutionStatus': 'failed', 'Bucket': bucket, 'Key': 'batch-job-reports/job-job-1/results/2.csv'},
+            ]}).encode('utf-8'),
+            'batch-job-reports/job-job-1/results/1.csv': report_rows.encode('utf-8'),
+            'aliases.json': json.dumps({'ok.jpg': ['copy-of-ok.jpg']}).encode('utf-8'),
+        }
+        mock_s3_client = MagicMock()
+        mock_s3_client.get_object.side_effect = lambda Bucket, Key, **kwargs: {'Body': MagicMock(read=lambda: objects[Key])}
+
+        # The first build hands all objects to job-1 without waiting for it
+        state = ManifestState()
+        for obj in listing:
+            state.observe(obj)
+        state.save(mock_s3_client, bucket, 'state.json.gz', job_ids=['job-1'], alias_map_etag='etag-aliases')
+        saved = json.loads(gzip.decompress(mock_s3_client.put_object.call_args[1]['Body']))
+        self.assertEqual(saved['objects'], {})
+        self.assertEqual(saved['jobs'], ['job-1'])
+
+        # The next build confirms what job-1 embedded, with its duplicates; the failed and
+        # asynchronous tasks are offered again
+        state = ManifestState(saved['objects'], saved['unconfirmed'], saved['jobs'], saved['alias_map_etag'])
+        alias_map = load_alias_map(mock_s3_client, bucket, 'aliases.json', state.alias_map_etag)
+        self.assertEqual(mock_s3_client.get_object.call_args[1]['IfMatch'], 'etag-aliases')
+        state.confirm_previous(with_aliases(embedded_task_keys(mock_s3_client, bucket, state.job_ids), alias_map))
+        self.assertEqual([obj['Key'] for obj in listing if state.observe(obj)], ['failed.jpg', 'clip.mp4'])
+        self.assertEqual(state.deleted_keys(), [])
+
+    def test_listing_is_sharded_by_top_level_prefix(self):
+
+        # Root listing (with delimiter) returns root objects and the top-level prefixes
+        listings = {
+            None: [
+                {'Contents': [{'Key': 'root.jpg'}], 'CommonPrefixes': [{'Prefix': 'audio/'}]},
+                {'CommonPrefixes': [{'Prefix': 'video/'}, {'Prefix': 'docs/'}]},
+            ],
+            'audio/': [{'Contents': [{'Key': 'audio/a.mp3'}]}, {'Contents': [{'Key': 'audio/b.wav'}]}],
+            'video/': [{'Contents': [{'Key': 'video/'}, {'Key': 'video/globe.mp4'}]}],
+            'docs/': [{'Contents': [{'Key': 'docs/source.zip'}, {'Key': 'docs/sample.pdf'}]}],
+        }
+        mock_paginator = MagicMock()
+        mock_paginator.paginate.side_effect = lambda Bucket, Prefix=None, Delimiter=None: listings[Prefix]
+        mock_s3_client = MagicMock()
+        mock_s3_client.get_paginator.return_value = mock_paginator
+
+        keys = [obj['Key'] for obj in list_objects(mock_s3_client, os.environ['INPUT_BUCKET'], max_workers=2)]
+        self.assertEqual(sorted(keys), sorted([
+            'root.jpg', 'audio/a.mp3', 'audio/b.wav', 'video/', 'video/globe.mp4', 'docs/source.zip', 'docs/sample.pdf'
+        ]))
+
+        # The manifest keeps today's filtering: no folders, no source.zip
+        mock_s3_client.put_object.return_value = {'ETag': f'"{MOCK_ETAG}"'}
+        object_count, _ = create_manifest_file(mock_s3_client, os.environ['INPUT_BUCKET'], MANIFEST_KEY)
+        self.assertEqual(object_count, 5)
+
+    def test_large_manifest_is_streamed_as_multipart_upload(self):
+
+        mock_s3_client = MagicMock()
+        mock_s3_client.create_multipart_upload.return_value = {'UploadId': 'upload-1'}
+        mock_s3_client.upload_part.side_effect = lambda **kwargs: {'ETag': f'"part-{kwargs["PartNumber"]}"'}
+        mock_s3_client.complete_multipart_upload.return_value = {'ETag': '"multipart-etag-3"'}
+
+        part_size = 5 * 1024 * 1024
+        line = f"{os.environ['INPUT_BUCKET']},{'k' * 1000}\n"
+        with S3ManifestWriter(mock_s3_client, os.environ['INPUT_BUCKET'], MANIFEST_KEY, part_size=part_size) as writer:
+            for _ in range(2 * part_size // len(line) + 10):
+                writer.write(line)
+            etag = writer.close()
+
+        # Two full parts plus the remainder, each sent as soon as it filled up
+        self.assertEqual(etag, 'multipart-etag-3')
+        self.assertEqual(mock_s3_client.upload_part.call_count, 3)
+        parts = mock_s3_client.complete_multipart_upload.call_args[1]['MultipartUpload']['Parts']
+        self.assertEqual([p['PartNumber'] for p in parts], [1, 2, 3])
+        mock_s3_client.put_object.assert_not_called()
+        mock_s3_client.head_object.assert_not_called()
+
+        # An error after the upload completed (e.g. another shard failing) leaves the manifest alone
+        with self.assertRaises(RuntimeError):
+            with S3ManifestWriter(mock_s3_client, os.environ['INPUT_BUCKET'], MANIFEST_KEY, part_size=part_size) as writer:
+                for _ in range(part_size // len(line) + 10):
+                    writer.write(line)
+                writer.close()
+                raise RuntimeError('next shard failed')
+        mock_s3_client.abort_multipart_upload.assert_not_called()
+
+    def test_deleting_an_object_also_removes_its_segment_vectors(self):
+
+        mock_s3vectors_client = MagicMock()
+        mock_s3vectors_client.get_vectors.return_value = {'vectors': [
+            {'key': 'docs/long.pdf#seg-0', 'metadata': {'source_key': 'docs/long.pdf', 'segment_count': 3}}
+        ]}
+
+        delete_removed_vectors(mock_s3vectors_client, ['image1.jpg', 'docs/long.pdf'])
+
+        deleted = mock_s3vectors_client.delete_vectors.call_args[1]['keys']
+        self.assertEqual(deleted, [
+            'image1.jpg', 'docs/long.pdf', 'docs/long.pdf#seg-0', 'docs/long.pdf#seg-1', 'docs/long.pdf#seg-2'
+        ])
+
+    def test_manifest_is_sharded_by_media_type_and_size(self):
+
+        mock_s3_client = MagicMock()
+        mock_s3_client.put_object.side_effect = lambda Bucket, Key, Body: {'ETag': f'"etag-{Key}"'}
+        mock_paginator = MagicMock()
+        mock_paginator.paginate.return_value = [{'Contents': [
+            {'Key': 'a.jpg', 'Size': 200 * 1024},
+            {'Key': 'b.png', 'Size': 300 * 1024},
+            {'Key': 'notes.txt', 'Size': 2048},
+            {'Key': 'video/globe.mp4', 'Size': 900 * 1024 * 1024},
+            {'Key': 'audio/song.mp3', 'Size': 5 * 1024 * 1024},
+            # Manifests and reports from an earlier build are not objects to embed
+            {'Key': 'batch-job-manifests/multimedia-manifest-image-small.csv', 'Size': 100},
+            {'Key': 'batch-job-reports/job-1/results/report.csv', 'Size': 100},
+        ]}]
+        mock_s3_client.get_paginator.return_value = mock_paginator
+
+        shards = create_sharded_manifests(mock_s3_client, os.environ['INPUT_BUCKET'], 'batch-job-manifests/multimedia-manifest')
+
+        self.assertEqual(sorted(shards), ['audio-medium', 'image-small', 'text-small', 'video-large'])
+        self.assertEqual(shards['image-small']['count'], 2)
+        self.assertEqual(shards['video-large']['key'], 'batch-job-manifests/multimedia-manifest-video-large.csv')
+        self.assertEqual(shards['video-large']['etag'], 'etag-batch-job-manifests/multimedia-manifest-video-large.csv')
+        bodies = {c[1]['Key']: c[1]['Body'].decode('utf-8') for c in mock_s3_client.put_object.call_args_list}
+        self.assertEqual(bodies['batch-job-manifests/multimedia-manifest-image-small.csv'],
+                         f"{os.environ['INPUT_BUCKET']},a.jpg\n{os.environ['INPUT_BUCKET']},b.png\n")
+        # Neither are they when the next build writes a single manifest
+        self.assertEqual(create_manifest_file(mock_s3_client, os.environ['INPUT_BUCKET'], MANIFEST_KEY)[0], 5)
+
+        # Each shard's job goes to the Lambda configured for it, the slowest shards first
+        with patch.dict('batch_processor.SHARD_LAMBDA_ARNS', {'large': 'arn:lambda:big', 'video-large': 'arn:lambda:video'}):
+            self.assertEqual(shard_lambda_arn('video-large'), 'arn:lambda:video')
+            self.assertEqual(shard_lambda_arn('audio-large'), 'arn:lambda:big')
+            self.assertEqual(shard_lambda_arn('image-small'), os.environ['LAMBDA_ARN'])
+        self.assertGreater(shard_priority('video-large'), shard_priority('image-small'))
+
+        mock_s3control_client = MagicMock()
+        mock_s3control_client.create_job.return_value = {'JobId': MOCK_JOB_ID}
+        create_s3_batch_job(mock_s3control_client, MOCK_ACCOUNT_ID, shards['video-large']['key'], shards['video-large']['etag'],
+                            function_arn='arn:lambda:video', priority=30, label='video-large')
+        job_call_kwargs = mock_s3control_client.create_job.call_args[1]
+        self.assertEqual(job_call_kwargs['Operation']['LambdaInvoke']['FunctionArn'], 'arn:lambda:video')
+        self.assertEqual(job_call_kwargs['Priority'], 30)
+        self.assertIn('video-large', job_call_kwargs['Description'])
+
+    def test_duplicate_objects_are_left_out_and_mapped_to_the_first_copy(self):
+
+        mock_s3_client = MagicMock()
+        mock_s3_client.put_object.return_value = {'ETag': f'"{MOCK_ETAG}"'}
+        mock_paginator = MagicMock()
+        mock_paginator.paginate.return_value = [{'Contents': [
+            {'Key': 'photos/a.jpg', 'ETag': '"etag-a"', 'Size': 100},
+            {'Key': 'backup/a.jpg', 'ETag': '"etag-a"', 'Size': 100},
+            {'Key': 'photos/b.jpg', 'ETag': '"etag-b"', 'Size': 100},
+            {'Key': 'copy-of-a.jpg', 'ETag': '"etag-a"', 'Size': 100},
+        ]}]
+        mock_s3_client.get_paginator.return_value = mock_paginator
+        duplicates = DuplicateGroups()
+
+        object_count, _ = create_manifest_file(mock_s3_client, os.environ['INPUT_BUCKET'], MANIFEST_KEY, duplicates=duplicates)
+
+        written = mock_s3_client.put_object.call_args[1]['Body'].decode('utf-8')
+        self.assertEqual(object_count, 2)
+        self.assertEqual(written, f"{os.environ['INPUT_BUCKET']},photos/a.jpg\n{os.environ['INPUT_BUCKET']},photos/b.jpg\n")
+        self.assertEqual(duplicates.aliases, {'photos/a.jpg': ['backup/a.jpg', 'copy-of-a.jpg']})
+
+        # The job hands the saved alias map to every invocation
+        user_arguments = {'AliasMapBucket': os.environ['INPUT_BUCKET'], 'AliasMapKey': 'batch-job-manifests/aliases.json',
+                          'AliasMapETag': duplicates.save(mock_s3_client, os.environ['INPUT_BUCKET'], 'batch-job-manifests/aliases.json')}
+        mock_s3control_client = MagicMock()
+        mock_s3control_client.create_job.return_value = {'JobId': MOCK_JOB_ID}
+        create_s3_batch_job(mock_s3control_client, MOCK_ACCOUNT_ID, MANIFEST_KEY, MOCK_ETAG, user_arguments=user_arguments)
+        lambda_invoke = mock_s3control_client.create_job.call_args[1]['Operation']['LambdaInvoke']
+        self.assertEqual(lambda_invoke['InvocationSchemaVersion'], '2.0')
+        self.assertEqual(lambda_invoke['UserArguments']['AliasMapETag'], MOCK_ETAG)
+
+    def test_progress_is_combined_across_jobs(self):
+
+        mock_s3control_client = MagicMock()
+        jobs = {
+            'job-1': {'Status': 'Complete', 'ProgressSummary': {'TotalNumberOfTasks': 10, 'NumberOfTasksSucceeded': 9, 'NumberOfTasksFailed': 1}},
+            'job-2': {'Status': 'Active', 'ProgressSummary': {'TotalNumberOfTasks': 5, 'NumberOfTasksSucceeded': 2, 'NumberOfTasksFailed': 0}},
+        }
+        mock_s3control_client.describe_job.side_effect = lambda AccountId, JobId: {'Job': jobs[JobId]}
+
+        progress = jobs_progress(mock_s3control_client, MOCK_ACCOUNT_ID, ['job-1', 'job-2'])
+        self.assertEqual(progress['TotalNumberOfTasks'], 15)
+        self.assertEqual(progress['NumberOfTasksSucceeded'], 11)
+        self.assertEqual(progress['NumberOfTasksFailed'], 1)
+        self.assertFalse(progress['done'])
+
+        jobs['job-2']['Status'] = 'Complete'
+        self.assertTrue(jobs_progress(mock_s3control_client, MOCK_ACCOUNT_ID, ['job-1', 'job-2'])['done'])
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
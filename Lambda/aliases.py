@@ -0,0 +1,41 @@
+import json
+import threading
+
+# Written next to an asynchronous invocation's output when the source object has duplicates
+ALIASES_SIDECAR = 'aliases.json'
+
+def alias_vectors(vector, canonical_key, aliases):
+    """Copies of a vector stored for canonical_key (or one of its <key>#seg-N segments) under each alias key.
+
+    Duplicates share the canonical object's content, so they get the same embedding without
+    another Bedrock call. Each copy records the key it was embedded from in canonical_key.
+    """
+    suffix = vector['key'][len(canonical_key):]
+    copies = []
+    for alias in aliases:
+        metadata = {**vector['metadata'], 'canonical_key': canonical_key}
+        if 'source_key' in metadata:
+            metadata['source_key'] = alias
+        copies.append({'key': alias + suffix, 'data': vector['data'], 'metadata': metadata})
+    return copies
+
+class AliasMapCache:
+    """Keeps the alias map of the current Batch job ({canonical key: [duplicate keys]}) for warm invocations.
+
+    The map is identified by its bucket, key and ETag, so a new job with a rewritten map is
+    picked up while every invocation of the same job reuses one download.
+    """
+
+    def __init__(self):
+        self._identity = None
+        self._aliases = {}
+        self._lock = threading.Lock()
+
+    def get(self, s3_client, bucket_name, key, etag=None):
+        identity = (bucket_name, key, etag)
+        with self._lock:
+            if identity != self._identity:
+                body = s3_client.get_object(Bucket=bucket_name, Key=key)['Body'].read()
+                self._aliases = json.loads(body)
+                self._identity = identity
+            return self._aliases
@@ -0,0 +1,101 @@
+import hashlib
+import json
+from botocore.exceptions import ClientError
+from segments import segment_key
+
+# GetVectors accepts at most 100 keys per request
+MAX_KEYS_PER_LOOKUP = 100
+
+def embedding_fingerprint(model_id, dimension, cache_version, segmentation=None):
+    """Identifies the embedding configuration a stored vector was produced with.
+
+    Changing the model, the dimension, the cache version or any of the segmentation settings
+    (how objects are cut into page ranges, time segments or text chunks) changes the
+    fingerprint, which invalidates every stored vector at once.
+    """
+    fingerprint = f"{model_id}:{dimension}:{cache_version}"
+    if segmentation:
+        settings = json.dumps(segmentation, sort_keys=True).encode('utf-8')
+        fingerprint += f":{hashlib.sha256(settings).hexdigest()[:12]}"
+    return fingerprint
+
+def is_not_modified(error):
+    """True when a conditional get_object (IfNoneMatch) failed because the object is unchanged."""
+    if not isinstance(error, ClientError):
+        return False
+    status = error.response.get('ResponseMetadata', {}).get('HTTPStatusCode')
+    return status == 304 or error.response.get('Error', {}).get('Code') in ('304', 'NotModified')
+
+class EmbeddingCache:
+    """Looks up which objects already have a current vector in the S3 Vectors index.
+
+    The index itself is the cache: each stored vector carries the source object's ETag and
+    the embedding fingerprint in its metadata. A lookup fetches that metadata for all keys of
+    an invocation in as few get_vectors calls as possible: each task looks up its key and its
+    first segment key, so one call per 50 tasks, plus follow-up calls (up to 100 keys each)
+    for the remaining segments of segmented objects.
+    """
+
+    def __init__(self, client, vector_bucket, index_name, fingerprint):
+        self.client = client
+        self.vector_bucket = vector_bucket
+        self.index_name = index_name
+        self.fingerprint = fingerprint
+
+    def metadata(self, etag):
+        """Metadata fields to store with a vector so later runs can recognise it as current."""
+        return {'etag': etag, 'embedding_fingerprint': self.fingerprint}
+
+    def lookup(self, keys):
+        """Returns {key: metadata} for every key that has a stored vector."""
+        found = {}
+        unique_keys = list(dict.fromkeys(keys))
+        for start in range(0, len(unique_keys), MAX_KEYS_PER_LOOKUP):
+            try:
+                response = self.client.get_vectors(
+                    vectorBucketName=self.vector_bucket,
+                    indexName=self.index_name,
+                    keys=unique_keys[start:start + MAX_KEYS_PER_LOOKUP],
+                    returnData=False,
+                    returnMetadata=True
+                )
+            except Exception as e:
+                # The cache is only an optimisation, so a failed lookup means "embed everything"
+                print(f"Embedding cache lookup failed, re-embedding: {e}")
+                continue
+            for vector in response.get('vectors', []):
+                found[vector['key']] = vector.get('metadata') or {}
+        return found
+
+    def is_current(self, metadata):
+        return metadata.get('embedding_fingerprint') == self.fingerprint and bool(metadata.get('etag'))
+
+    def stored_vectors(self, object_keys):
+        """Finds the vectors stored for each object, under its own key or as <key>#seg-N segments.
+
+        Returns {object key: {'etag', 'keys'}} for every object with at least one vector. 'keys'
+        lists those vectors; 'etag' is the ETag they were built from if they are all current,
+        else None. A segmented object only counts as current if every segment that its first
+        segment's segment_count promises is stored, so one lost in a partly failed write gets
+        the object re-embedded. An object with vectors in both layouts is never current.
+        """
+        found = self.lookup([lookup for key in object_keys for lookup in (key, segment_key(key, 0))])
+        segment_keys = {}
+        for key in object_keys:
+            first = found.get(segment_key(key, 0))
+            if first is not None:
+                segment_keys[key] = [segment_key(key, index) for index in range(int(first.get('segment_count', 1)))]
+        found.update(self.lookup([segment for keys in segment_keys.values() for segment in keys[1:]]))
+
+        stored = {}
+        for key in object_keys:
+            segments = segment_keys.get(key, [])
+            vectors = [found[key]] if key in found else [found[segment] for segment in segments if segment in found]
+            keys = ([key] if key in found else []) + [segment for segment in segments if segment in found]
+            if not keys:
+                continue
+            etag = vectors[0].get('etag')
+            complete = len(keys) == (1 if key in found else len(segments))
+            current = complete and all(self.is_current(vector) and vector.get('etag') == etag for vector in vectors)
+            stored[key] = {'etag': etag if current else None, 'keys': keys}
+        return stored
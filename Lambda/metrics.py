@@ -0,0 +1,158 @@
+import json
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+# CloudWatch accepts at most 100 values per metric in one embedded metric format document
+MAX_VALUES_PER_METRIC = 100
+# Stage name -> metric name of its duration
+STAGE_METRICS = {
+    'download': 'DownloadMs',
+    'encode': 'EncodeMs',
+    'embed': 'EmbedMs',
+    'store': 'StoreMs',
+}
+
+class TaskMetrics:
+    """Stage durations (ms), byte counts and outcome of one task.
+
+    A stage can be entered several times (e.g. one Bedrock call per PDF segment); its durations add up.
+    """
+
+    def __init__(self, key):
+        self.key = key
+        self.mime_type = 'unknown'
+        self.outcome = 'failed'
+        self.result_code = None
+        self.object_bytes = 0
+        self.request_bytes = 0
+        self.stages = {}
+        self.total_ms = 0.0
+
+    @contextmanager
+    def running(self):
+        """Times the task end to end."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.total_ms = (time.perf_counter() - start) * 1000
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages[name] = self.stages.get(name, 0.0) + (time.perf_counter() - start) * 1000
+
+    def detail(self):
+        return {
+            'key': self.key,
+            'mime_type': self.mime_type,
+            'outcome': self.outcome,
+            'result_code': self.result_code,
+            'object_bytes': self.object_bytes,
+            'request_bytes': self.request_bytes,
+            'task_ms': round(self.total_ms, 1),
+            **{f'{name}_ms': round(ms, 1) for name, ms in self.stages.items()}
+        }
+
+class InvocationMetrics:
+    """Collects the timings of one lambda_handler invocation and logs them as CloudWatch embedded metrics.
+
+    emit() prints one invocation-level document plus one document per MIME type seen, with
+    every task's stage durations and byte counts as metric values, so CloudWatch can graph
+    the latency breakdown by MIME type straight from the logs. A sample_rate share of tasks
+    is also logged individually for drilling into single objects.
+    """
+
+    def __init__(self, namespace, function_name, invocation_id, sample_rate=0.0):
+        self.namespace = namespace
+        self.function_name = function_name
+        self.invocation_id = invocation_id
+        self.sample_rate = sample_rate
+        self.tasks = []
+        self.stages = {}
+        self._start = time.perf_counter()
+        self._lock = threading.Lock()
+
+    def task(self, key):
+        task_metrics = TaskMetrics(key)
+        with self._lock:
+            self.tasks.append(task_metrics)
+        return task_metrics
+
+    @contextmanager
+    def stage(self, name):
+        """Times an invocation-level stage, e.g. the cache lookup or the final flush."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages[name] = self.stages.get(name, 0.0) + (time.perf_counter() - start) * 1000
+
+    def _document(self, dimensions, metrics, values):
+        return {
+            '_aws': {
+                'Timestamp': int(time.time() * 1000),
+                'CloudWatchMetrics': [{
+                    'Namespace': self.namespace,
+                    'Dimensions': [dimensions],
+                    'Metrics': [{'Name': name, 'Unit': unit} for name, unit in metrics]
+                }]
+            },
+            'FunctionName': self.function_name,
+            'invocation_id': self.invocation_id,
+            **values
+        }
+
+    def documents(self):
+        """The embedded metric format documents for this invocation."""
+        failed = sum(1 for task in self.tasks if task.result_code not in (None, 'Succeeded'))
+        documents = [self._document(
+            ['FunctionName'],
+            [('InvocationMs', 'Milliseconds'), ('Tasks', 'Count'), ('FailedTasks', 'Count')]
+            + [(f"{name.title().replace('_', '')}Ms", 'Milliseconds') for name in self.stages],
+            {
+                'InvocationMs': (time.perf_counter() - self._start) * 1000,
+                'Tasks': len(self.tasks),
+                'FailedTasks': failed,
+                **{f"{name.title().replace('_', '')}Ms": ms for name, ms in self.stages.items()}
+            }
+        )]
+
+        by_mime_type = {}
+        for task in self.tasks:
+            by_mime_type.setdefault(task.mime_type, []).append(task)
+        for mime_type, tasks in sorted(by_mime_type.items()):
+            # Larger invocations are split so no metric exceeds the per-document value limit
+            for start in range(0, len(tasks), MAX_VALUES_PER_METRIC):
+                chunk = tasks[start:start + MAX_VALUES_PER_METRIC]
+                values = {
+                    'MimeType': mime_type,
+                    'Tasks': len(chunk),
+                    'SkippedTasks': sum(1 for task in chunk if task.outcome == 'skipped'),
+                    'FailedTasks': sum(1 for task in chunk if task.result_code not in (None, 'Succeeded')),
+                    'TaskMs': [task.total_ms for task in chunk],
+                    'ObjectBytes': [task.object_bytes for task in chunk],
+                    'RequestBytes': [task.request_bytes for task in chunk],
+                }
+                metrics = [('Tasks', 'Count'), ('SkippedTasks', 'Count'), ('FailedTasks', 'Count'),
+                           ('TaskMs', 'Milliseconds'), ('ObjectBytes', 'Bytes'), ('RequestBytes', 'Bytes')]
+                for stage, metric in STAGE_METRICS.items():
+                    durations = [task.stages[stage] for task in chunk if stage in task.stages]
+                    if durations:
+                        values[metric] = durations
+                        metrics.append((metric, 'Milliseconds'))
+                documents.append(self._document(['FunctionName', 'MimeType'], metrics, values))
+        return documents
+
+    def emit(self):
+        """Prints the metric documents, then the sampled per-task details."""
+        for document in self.documents():
+            print(json.dumps(document))
+        for task in self.tasks:
+            if self.sample_rate and random.random() < self.sample_rate:
+                print(json.dumps({'message': 'task_metrics', 'invocation_id': self.invocation_id, **task.detail()}))
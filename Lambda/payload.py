@@ -0,0 +1,102 @@
+import base64
+import json
+import resource
+
+# Bytes read from S3 per chunk. A multiple of 3, so every full chunk base64-encodes without padding.
+READ_CHUNK_SIZE = 3 * 256 * 1024
+# Stands in for the data field while the JSON around it is rendered
+_DATA_PLACEHOLDER = '__NOVA_MME_DATA__'
+
+def nova_request(media_type, encoding, data, purpose='GENERIC_INDEX'):
+    """Nova MME request body for a single input."""
+    return {
+        "input": {
+            # This must be the string literal: 'image', 'video', 'audio', 'text', or 'document'
+            "mediaType": media_type,
+            "encoding": encoding,
+            # This must be the Base64 string or the raw text string
+            "data": data
+        },
+        "config": {
+            "embeddingPurpose": purpose
+        }
+    }
+
+def nova_s3_request(media_type, s3_uri, purpose='GENERIC_INDEX', segment_seconds=None):
+    """Nova MME request body that references the input in S3 instead of inlining it (asynchronous invocation).
+
+    With segment_seconds, audio/video is embedded as consecutive segments of that length.
+    """
+    request = {
+        "input": {
+            "mediaType": media_type,
+            "source": {
+                "s3Location": {"uri": s3_uri}
+            }
+        },
+        "config": {
+            "embeddingPurpose": purpose
+        }
+    }
+    if segment_seconds:
+        request["config"]["segmentation"] = {"durationSeconds": segment_seconds}
+    return request
+
+def build_base64_request(stream, content_length, media_type, purpose='GENERIC_INDEX'):
+    """Builds the JSON request body for a binary object, base64-encoding it straight into the body.
+
+    The object is read from the stream in chunks and each chunk is encoded into its place in a
+    buffer sized up front from content_length. The raw bytes, the base64 string and the JSON
+    string never exist as separate full copies, so peak memory stays close to one encoded copy.
+
+    Returns (body, estimated_bytes) where estimated_bytes adds up the payload buffers the
+    encoder holds at once. It is an estimate from buffer sizes, not a measurement.
+    """
+    prefix, suffix = json.dumps(nova_request(media_type, 'base64', _DATA_PLACEHOLDER, purpose)) \
+        .encode('utf-8').split(_DATA_PLACEHOLDER.encode('utf-8'))
+
+    if content_length is None:
+        # Size unknown up front: fall back to encoding the whole object at once
+        raw = stream.read()
+        data = base64.b64encode(raw)
+        body = prefix + data + suffix
+        return body, len(raw) + len(data) + len(body)
+
+    encoded_length = 4 * ((content_length + 2) // 3)
+    body = bytearray(len(prefix) + encoded_length + len(suffix))
+    body[:len(prefix)] = prefix
+    position = len(prefix)
+    bytes_read = 0
+    largest_chunk = 0
+    carry = b''
+    while True:
+        chunk = stream.read(READ_CHUNK_SIZE)
+        if not chunk:
+            break
+        bytes_read += len(chunk)
+        largest_chunk = max(largest_chunk, len(chunk))
+        # Short reads can leave 1-2 bytes over; keep them for the next chunk so padding only ends the data
+        if carry:
+            chunk = carry + chunk
+        usable = len(chunk) - len(chunk) % 3
+        carry = chunk[usable:]
+        encoded = base64.b64encode(memoryview(chunk)[:usable])
+        body[position:position + len(encoded)] = encoded
+        position += len(encoded)
+    if carry:
+        encoded = base64.b64encode(carry)
+        body[position:position + len(encoded)] = encoded
+        position += len(encoded)
+
+    if bytes_read != content_length:
+        raise ValueError(f"Expected {content_length} bytes but read {bytes_read}")
+    body[position:] = suffix
+    # At most the body buffer plus one raw chunk and its encoding are held at once
+    return body, len(body) + largest_chunk + 4 * ((largest_chunk + 2) // 3)
+
+def max_rss_mb():
+    """High-water mark of the process's resident memory in MiB (ru_maxrss is in KiB on Linux).
+
+    It covers the whole process since it started, i.e. every task of every warm invocation.
+    """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
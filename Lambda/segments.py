@@ -0,0 +1,110 @@
+import codecs
+from io import BytesIO
+
+def segment_key(key, index):
+    """Vector key of one segment of an object."""
+    return f"{key}#seg-{index}"
+
+def vector_keys(key, count):
+    """Keys of an object's vectors: its own key for a single vector, <key>#seg-N for several."""
+    return [key] if count == 1 else [segment_key(key, index) for index in range(count)]
+
+def page_windows(page_count, window, overlap=0):
+    """Splits page_count pages into [start, end) windows of `window` pages that share `overlap` pages."""
+    step = max(1, window - overlap)
+    windows = []
+    start = 0
+    while True:
+        end = min(start + window, page_count)
+        windows.append((start, end))
+        if end >= page_count:
+            return windows
+        start += step
+
+def split_pdf(data, window, overlap=0):
+    """Splits a PDF into page-range PDFs. Returns [(start_page, end_page, pdf_bytes)] with 0-based, end-exclusive pages.
+
+    A PDF that fits in a single window is returned as one range holding the original bytes.
+    """
+    # pypdf is only needed for segmented PDFs, so it is imported here rather than at cold start
+    from pypdf import PdfReader, PdfWriter
+
+    reader = PdfReader(BytesIO(data))
+    page_count = len(reader.pages)
+    if page_count <= window:
+        return [(0, page_count, data)]
+
+    segments = []
+    for start, end in page_windows(page_count, window, overlap):
+        writer = PdfWriter()
+        for page in reader.pages[start:end]:
+            writer.add_page(page)
+        output = BytesIO()
+        writer.write(output)
+        segments.append((start, end, output.getvalue()))
+    return segments
+
+def media_segment_bounds(item, index, segment_seconds):
+    """Start and end second of one segment of an asynchronous segmented embedding output line."""
+    segment = item.get('segmentMetadata') or {}
+    start = segment.get('segmentStartSeconds', index * segment_seconds)
+    end = segment.get('segmentEndSeconds', start + segment_seconds)
+    return start, end
+
+def iter_text(read, read_size):
+    """Decodes a UTF-8 byte stream read by read(read_size) piece by piece.
+
+    A character split across two reads is carried over by the incremental decoder, so only one
+    read's worth of bytes and text is held at a time.
+    """
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    while True:
+        data = read(read_size)
+        if not data:
+            break
+        text = decoder.decode(data)
+        if text:
+            yield text
+    tail = decoder.decode(b'', final=True)
+    if tail:
+        yield tail
+
+def _chunk_end(buffer, start, max_chars):
+    """End of the chunk starting at start: the last paragraph break, line break or space in its second half, if any."""
+    limit = start + max_chars
+    for separator in ('\n\n', '\n', ' '):
+        index = buffer.rfind(separator, start + max_chars // 2, limit)
+        if index != -1:
+            return index + len(separator)
+    return limit
+
+def _next_start(buffer, start, end, overlap_chars):
+    """Start of the chunk after [start, end): overlap_chars back from end, moved forward to the next word."""
+    if overlap_chars <= 0:
+        return end
+    next_start = max(end - overlap_chars, start + 1)
+    words = [index for index in (buffer.find(' ', next_start, end), buffer.find('\n', next_start, end)) if index != -1]
+    return min(words) + 1 if words else next_start
+
+def text_chunks(pieces, max_chars, overlap_chars=0):
+    """Splits streamed text into chunks of at most max_chars characters; consecutive chunks share about overlap_chars.
+
+    Yields (start, end, text) with 0-based, end-exclusive character offsets into the whole text.
+    Empty text yields nothing.
+    """
+    buffer = ''
+    base = 0  # offset of buffer[0] in the whole text
+    start = 0  # start of the next chunk in buffer
+    covered = 0  # end of the last chunk yielded
+    for piece in pieces:
+        buffer = buffer[start:] + piece
+        base += start
+        start = 0
+        # Only cut while more than a chunk is buffered; the rest may still grow with the next piece
+        while len(buffer) - start > max_chars:
+            end = _chunk_end(buffer, start, max_chars)
+            yield base + start, base + end, buffer[start:end]
+            covered = base + end
+            start = _next_start(buffer, start, end, overlap_chars)
+    if base + len(buffer) > covered:
+        yield base + start, base + len(buffer), buffer[start:]
@@ -1,8 +1,13 @@
 import unittest
+import base64
+import importlib.util
 import json
 import os
+import threading
+import time
 from unittest.mock import patch, MagicMock
-from io import BytesIO
+from io import BytesIO, StringIO
+from botocore.exceptions import ClientError
 
 # Define mock constants to use across the script
 MOCK_REGION = 'us-east-1'
@@ -10,6 +15,7 @@ MOCK_VECTOR_BUCKET = 'test-vector-bucket'
 MOCK_VECTOR_INDEX = 'test-index'
 MOCK_BEDROCK_MODEL_ID = 'amazon.nova-multimodal-embeddings-v1:0:8192'
 MOCK_EMBEDDING_DIMENSION = 3027
+SAMPLE_PDF = os.path.join(os.path.dirname(__file__), '..', 'Multimedia for S3', 'RomanHistoryTimeline.pdf')
 
 # Set all required os.environ variables here.
 # Note: all values in os.environ must be strings.
@@ -21,6 +27,12 @@ os.environ['EMBEDDING_DIMENSION'] = str(MOCK_EMBEDDING_DIMENSION)
 
 # Import the handler function and constants from your lambda file
 from vector_embed_lambda import lambda_handler 
+import vector_embed_lambda
+from vector_sink import VectorSink
+from embedding_cache import embedding_fingerprint
+from payload import build_base64_request, nova_request
+from segments import page_windows, iter_text, text_chunks
+from throttling import AdaptiveRateLimiter
 
 class TestVectorEmbedLambda(unittest.TestCase):
 
@@ -108,6 +120,682 @@ class TestVectorEmbedLambda(unittest.TestCase):
         self.assertEqual(stored_vector['data']['float32'], self.mock_embedding)
         self.assertEqual(stored_vector['metadata']['mime_type'], 'image/jpeg')
 
+    @patch('vector_embed_lambda.s3vectors_client')
+    @patch('vector_embed_lambda.bedrock_runtime')
+    @patch('vector_embed_lambda.s3_client')
+    def test_concurrent_tasks_keep_original_order(self, mock_s3, mock_bedrock, mock_s3vectors):
+
+        # Five tasks, the third one has an extension we cannot classify
+        keys = ['a.jpg', 'b.png', 'c.unknownext', 'd.jpg', 'e.gif']
+        self.mock_event['tasks'] = [
+            {'taskId': f'task-{i}', 's3Key': key, 's3BucketArn': 'arn:aws:s3:::source-bucket-1'}
+            for i, key in enumerate(keys)
+        ]
+        mock_s3.get_object.side_effect = lambda Bucket, Key: {
+            'Body': MagicMock(read=lambda: self.mock_file_content)
+        }
+        mock_bedrock.invoke_model.side_effect = lambda **kwargs: {
+            'body': MagicMock(read=lambda: json.dumps(self.mock_bedrock_response_body).encode('utf-8'))
+        }
+
+        with patch('vector_embed_lambda.MAX_CONCURRENCY', 4):
+            response = lambda_handler(self.mock_event, None)
+
+        # One result per task, in the order the tasks were sent
+        self.assertEqual([r['taskId'] for r in response['results']], [f'task-{i}' for i in range(5)])
+        self.assertEqual(
+            [r['resultCode'] for r in response['results']],
+            ['Succeeded', 'Succeeded', 'PermanentFailure', 'Succeeded', 'Succeeded']
+        )
+
+    @patch('vector_embed_lambda.process_task')
+    def test_unfinished_tasks_are_retried_when_time_runs_out(self, mock_process_task):
+
+        # No time left before the safety margin, so nothing can be waited on
+        mock_context = MagicMock()
+        mock_context.get_remaining_time_in_millis.return_value = vector_embed_lambda.TIMEOUT_MARGIN_MS
+        release = threading.Event()
+        mock_process_task.side_effect = lambda *args: release.wait(5)
+
+        response = lambda_handler(self.mock_event, mock_context)
+        release.set()
+
+        self.assertEqual(response['results'][0]['taskId'], 'test-task-1')
+        self.assertEqual(response['results'][0]['resultCode'], 'TemporaryFailure')
+
+    @patch('vector_embed_lambda.s3vectors_client')
+    @patch('vector_embed_lambda.bedrock_runtime')
+    @patch('vector_embed_lambda.s3_client')
+    def test_vectors_are_written_in_batches(self, mock_s3, mock_bedrock, mock_s3vectors):
+
+        self.mock_event['tasks'] = [
+            {'taskId': f'task-{i}', 's3Key': f'img-{i}.jpg', 's3BucketArn': 'arn:aws:s3:::source-bucket-1'}
+            for i in range(5)
+        ]
+        mock_s3.get_object.side_effect = lambda Bucket, Key: {
+            'Body': MagicMock(read=lambda: self.mock_file_content)
+        }
+        mock_bedrock.invoke_model.side_effect = lambda **kwargs: {
+            'body': MagicMock(read=lambda: json.dumps(self.mock_bedrock_response_body).encode('utf-8'))
+        }
+
+        with patch('vector_embed_lambda.VECTOR_BATCH_SIZE', 2):
+            response = lambda_handler(self.mock_event, None)
+
+        # 5 vectors in batches of 2 -> 3 requests, nothing lost
+        self.assertEqual(mock_s3vectors.put_vectors.call_count, 3)
+        stored_keys = sorted(v['key'] for c in mock_s3vectors.put_vectors.call_args_list for v in c[1]['vectors'])
+        self.assertEqual(stored_keys, [f'img-{i}.jpg' for i in range(5)])
+        self.assertTrue(all(r['resultCode'] == 'Succeeded' for r in response['results']))
+
+    def test_sink_fails_only_the_rejected_vector(self):
+
+        # The service rejects any request that contains the bad vector
+        def put_vectors(vectorBucketName, indexName, vectors):
+            if any(v['key'] == 'bad' for v in vectors):
+                raise ClientError({'Error': {'Code': 'ValidationException', 'Message': 'bad vector'}}, 'PutVectors')
+        mock_client = MagicMock()
+        mock_client.put_vectors.side_effect = put_vectors
+
+        sink = VectorSink(mock_client, MOCK_VECTOR_BUCKET, MOCK_VECTOR_INDEX)
+        for task_id, key in [('t1', 'good-1'), ('t2', 'bad'), ('t3', 'good-2'), ('t4', 'good-3')]:
+            sink.add(task_id, {'key': key, 'data': {'float32': [0.1]}})
+        failures = sink.flush()
+
+        self.assertEqual(list(failures), ['t2'])
+        self.assertEqual(failures['t2'][0], 'PermanentFailure')
+
+    def test_sink_fails_the_whole_batch_once_when_access_is_denied(self):
+
+        denied = ClientError({'Error': {'Code': 'AccessDeniedException', 'Message': 'not allowed'}}, 'PutVectors')
+        mock_client = MagicMock()
+        mock_client.put_vectors.side_effect = denied
+
+        sink = VectorSink(mock_client, MOCK_VECTOR_BUCKET, MOCK_VECTOR_INDEX)
+        for i in range(500):
+            sink.add(f't{i}', {'key': f'k{i}', 'data': {'float32': [0.1]}})
+        failures = sink.flush()
+
+        # Not a problem with any one vector, so the batch is not split
+        self.assertEqual(mock_client.put_vectors.call_count, 1)
+        self.assertEqual(len(failures), 500)
+        self.assertEqual({code for code, _ in failures.values()}, {'PermanentFailure'})
+
+    @patch('vector_sink.time.sleep')
+    def test_sink_retries_throttled_batches(self, mock_sleep):
+
+        throttled = ClientError({'Error': {'Code': 'ThrottlingException', 'Message': 'slow down'}}, 'PutVectors')
+        mock_client = MagicMock()
+        mock_client.put_vectors.side_effect = [throttled, None]
+
+        sink = VectorSink(mock_client, MOCK_VECTOR_BUCKET, MOCK_VECTOR_INDEX)
+        sink.add('t1', {'key': 'k1', 'data': {'float32': [0.1]}})
+
+        self.assertEqual(sink.flush(), {})
+        self.assertEqual(mock_client.put_vectors.call_count, 2)
+
+    @patch('vector_sink.time.sleep')
+    def test_sink_stops_at_the_deadline_and_rejects_late_vectors(self, mock_sleep):
+
+        mock_client = MagicMock()
+        sink = VectorSink(mock_client, MOCK_VECTOR_BUCKET, MOCK_VECTOR_INDEX)
+        sink.add('t1', {'key': 'k1', 'data': {'float32': [0.1]}})
+
+        # No time left to write the buffered vector: its task is handed back for a retry
+        failures = sink.flush(deadline=time.monotonic())
+        self.assertEqual(failures['t1'][0], 'TemporaryFailure')
+        mock_client.put_vectors.assert_not_called()
+
+        # A task that was still running adds its vector after the flush
+        sink.add('t2', {'key': 'k2', 'data': {'float32': [0.1]}})
+        self.assertEqual(sink.flush()['t2'][0], 'TemporaryFailure')
+        mock_client.put_vectors.assert_not_called()
+
+    @patch('vector_embed_lambda.s3vectors_client')
+    @patch('vector_embed_lambda.bedrock_runtime')
+    @patch('vector_embed_lambda.s3_client')
+    def test_unchanged_object_is_not_re_embedded(self, mock_s3, mock_bedrock, mock_s3vectors):
+
+        # The stored vector was built from the current ETag with the current model/dimension
+        fingerprint = vector_embed_lambda.current_fingerprint()
+        mock_s3vectors.get_vectors.return_value = {'vectors': [{
+            'key': 'media/test_image.jpg',
+            'metadata': {'etag': '"abc"', 'embedding_fingerprint': fingerprint}
+        }]}
+        mock_s3.get_object.side_effect = ClientError(
+            {'Error': {'Code': '304', 'Message': 'Not Modified'}, 'ResponseMetadata': {'HTTPStatusCode': 304}},
+            'GetObject'
+        )
+
+        response = lambda_handler(self.mock_event, None)
+
+        self.assertEqual(response['results'][0]['resultCode'], 'Succeeded')
+        self.assertEqual(mock_s3.get_object.call_args[1]['IfNoneMatch'], '"abc"')
+        mock_s3vectors.get_vectors.assert_called_once()
+        mock_bedrock.invoke_model.assert_not_called()
+        mock_s3vectors.put_vectors.assert_not_called()
+
+    @patch('vector_embed_lambda.s3vectors_client')
+    @patch('vector_embed_lambda.bedrock_runtime')
+    @patch('vector_embed_lambda.s3_client')
+    def test_segmented_object_is_only_current_with_every_segment(self, mock_s3, mock_bedrock, mock_s3vectors):
+
+        metadata = {'etag': '"abc"', 'embedding_fingerprint': vector_embed_lambda.current_fingerprint(), 'segment_count': 4}
+        index = {f'media/test_image.jpg#seg-{i}': metadata for i in range(4)}
+        mock_s3vectors.get_vectors.side_effect = lambda keys, **kwargs: {
+            'vectors': [{'key': key, 'metadata': index[key]} for key in keys if key in index]
+        }
+        mock_s3.get_object.side_effect = ClientError({'Error': {'Code': '304'}, 'ResponseMetadata': {'HTTPStatusCode': 304}}, 'GetObject')
+
+        lambda_handler(self.mock_event, None)
+        self.assertEqual(mock_s3.get_object.call_args[1]['IfNoneMatch'], '"abc"')
+
+        # A segment lost in a partly failed write: the object is embedded again
+        del index['media/test_image.jpg#seg-3']
+        lambda_handler(self.mock_event, None)
+        self.assertNotIn('IfNoneMatch', mock_s3.get_object.call_args[1])
+
+    @patch('vector_embed_lambda.s3vectors_client')
+    @patch('vector_embed_lambda.bedrock_runtime')
+    @patch('vector_embed_lambda.s3_client')
+    def test_vector_from_another_model_is_re_embedded(self, mock_s3, mock_bedrock, mock_s3vectors):
+
+        mock_s3vectors.get_vectors.return_value = {'vectors': [{
+            'key': 'media/test_image.jpg',
+            'metadata': {'etag': '"abc"', 'embedding_fingerprint': 'some-old-model:1024:1'}
+        }]}
+        mock_s3.get_object.return_value = {
+            'Body': MagicMock(read=lambda: self.mock_file_content),
+            'ContentType': 'image/jpeg',
+            'ETag': '"abc"'
+        }
+        mock_bedrock.invoke_model.return_value = {
+            'body': MagicMock(read=lambda: json.dumps(self.mock_bedrock_response_body).encode('utf-8'))
+        }
+
+        response = lambda_handler(self.mock_event, None)
+
+        self.assertEqual(response['results'][0]['resultCode'], 'Succeeded')
+        self.assertNotIn('IfNoneMatch', mock_s3.get_object.call_args[1])
+        stored_vector = mock_s3vectors.put_vectors.call_args[1]['vectors'][0]
+        self.assertEqual(stored_vector['metadata']['etag'], '"abc"')
+        self.assertTrue(stored_vector['metadata']['embedding_fingerprint'].startswith(MOCK_BEDROCK_MODEL_ID))
+
+        # Vectors cut with other segmentation settings are not current either
+        fingerprint = vector_embed_lambda.current_fingerprint()
+        with patch('vector_embed_lambda.TEXT_CHUNK_TOKENS', 4000):
+            self.assertNotEqual(vector_embed_lambda.current_fingerprint(), fingerprint)
+        with patch('vector_embed_lambda.PDF_PAGES_PER_SEGMENT', 5):
+            self.assertNotEqual(vector_embed_lambda.current_fingerprint(), fingerprint)
+        self.assertNotEqual(embedding_fingerprint(MOCK_BEDROCK_MODEL_ID, MOCK_EMBEDDING_DIMENSION, '1'), fingerprint)
+
+    def test_streamed_request_body_matches_plain_encoding(self):
+
+        class ShortReadStream(BytesIO):
+            # S3 streams may return fewer bytes than asked for
+            def read(self, size=-1):
+                return super().read(min(size, 1000) if size and size > 0 else size)
+
+        for length in (0, 1, 2, 3, 2999, 3001):
+            content = bytes(range(256)) * (length // 256) + bytes(range(length % 256))
+            body, estimated_bytes = build_base64_request(ShortReadStream(content), len(content), 'video')
+
+            expected = nova_request('video', 'base64', base64.b64encode(content).decode('utf-8'))
+            self.assertEqual(json.loads(body), expected)
+            self.assertGreaterEqual(estimated_bytes, len(body))
+
+        with self.assertRaises(ValueError):
+            build_base64_request(BytesIO(b'short'), 10, 'image')
+
+    @patch('vector_embed_lambda.s3vectors_client')
+    @patch('vector_embed_lambda.bedrock_runtime')
+    @patch('vector_embed_lambda.s3_client')
+    def test_binary_object_is_streamed_into_request(self, mock_s3, mock_bedrock, mock_s3vectors):
+
+        mock_s3.get_object.return_value = {
+            'Body': BytesIO(self.mock_file_content),
+            'ContentLength': len(self.mock_file_content),
+            'ContentType': 'image/jpeg'
+        }
+        mock_bedrock.invoke_model.return_value = {
+            'body': MagicMock(read=lambda: json.dumps(self.mock_bedrock_response_body).encode('utf-8'))
+        }
+
+        with patch('builtins.print') as mock_print:
+            response = lambda_handler(self.mock_event, None)
+
+        self.assertEqual(response['results'][0]['resultCode'], 'Succeeded')
+        request_body = json.loads(mock_bedrock.invoke_model.call_args[1]['body'])
+        self.assertEqual(base64.b64decode(request_body['input']['data']), self.mock_file_content)
+
+        # One memory report line for the object
+        report = json.loads(mock_print.call_args_list[0][0][0])
+        self.assertEqual(report['object_bytes'], len(self.mock_file_content))
+        self.assertIn('estimated_payload_bytes', report)
+
+    @patch('vector_embed_lambda.s3vectors_client')
+    @patch('vector_embed_lambda.bedrock_runtime')
+    @patch('vector_embed_lambda.s3_client')
+    def test_large_video_is_embedded_asynchronously(self, mock_s3, mock_bedrock, mock_s3vectors):
+
+        self.mock_event['tasks'][0]['s3Key'] = 'media/globe.mp4'
+        mock_body = MagicMock()
+        mock_s3.get_object.return_value = {
+            'Body': mock_body,
+            'ContentLength': 200 * 1024 * 1024,
+            'ContentType': 'video/mp4',
+            'ETag': '"video-etag"'
+        }
+        mock_bedrock.start_async_invoke.return_value = {'invocationArn': 'arn:aws:bedrock:us-east-1:123:async-invoke/abc'}
+
+        with patch('vector_embed_lambda.ASYNC_OUTPUT_URI', 's3://async-bucket/nova-output'):
+            response = lambda_handler(self.mock_event, None)
+
+        # The video is never downloaded or inlined; Bedrock reads it from S3
+        self.assertEqual(response['results'][0]['resultCode'], 'Succeeded')
+        self.assertTrue(response['results'][0]['resultString'].startswith('Pending'))
+        mock_body.read.assert_not_called()
+        mock_bedrock.invoke_model.assert_not_called()
+        mock_s3vectors.put_vectors.assert_not_called()
+        kwargs = mock_bedrock.start_async_invoke.call_args[1]
+        self.assertEqual(kwargs['modelInput']['input']['source']['s3Location']['uri'], 's3://source-bucket-1/media/globe.mp4')
+        self.assertEqual(
+            kwargs['outputDataConfig']['s3OutputDataConfig']['s3Uri'],
+            's3://async-bucket/nova-output/source-bucket-1/media/globe.mp4/'
+        )
+
+    def s3_objects(self, objects):
+        """get_object side effect serving bodies by key; other keys raise NoSuchKey."""
+        def get_object(Bucket, Key, **kwargs):
+            if Key not in objects:
+                raise ClientError({'Error': {'Code': 'NoSuchKey'}}, 'GetObject')
+            return {'Body': BytesIO(objects[Key])}
+        return get_object
+
+    @patch('vector_embed_lambda.s3vectors_client')
+    @patch('vector_embed_lambda.s3_client')
+    def test_async_output_is_written_to_the_index(self, mock_s3, mock_s3vectors):
+
+        output_line = json.dumps({'embedding': self.mock_embedding}).encode('utf-8')
+        mock_s3.get_object.side_effect = self.s3_objects({
+            'nova-output/source-bucket-1/media/globe.mp4/abc123/embedding-video.jsonl': output_line + b'\n'
+        })
+        mock_s3.head_object.return_value = {'ContentType': 'video/mp4', 'ETag': '"video-etag"'}
+        s3_event = {'Records': [{'s3': {
+            'bucket': {'name': 'async-bucket'},
+            'object': {'key': 'nova-output/source-bucket-1/media/globe.mp4/abc123/embedding-video.jsonl'}
+        }}]}
+
+        with patch('vector_embed_lambda.ASYNC_OUTPUT_URI', 's3://async-bucket/nova-output'):
+            result = vector_embed_lambda.async_result_handler(s3_event, None)
+
+        self.assertEqual(result['stored'], ['media/globe.mp4'])
+        mock_s3.head_object.assert_called_once_with(Bucket='source-bucket-1', Key='media/globe.mp4')
+        stored_vector = mock_s3vectors.put_vectors.call_args[1]['vectors'][0]
+        self.assertEqual(stored_vector['key'], 'media/globe.mp4')
+        self.assertEqual(stored_vector['metadata']['mime_type'], 'video/mp4')
+        self.assertEqual(stored_vector['metadata']['etag'], '"video-etag"')
+
+    def test_page_windows_overlap(self):
+
+        self.assertEqual(page_windows(10, 4, 1), [(0, 4), (3, 7), (6, 10)])
+        self.assertEqual(page_windows(3, 4, 1), [(0, 3)])
+        self.assertEqual(page_windows(5, 2, 0), [(0, 2), (2, 4), (4, 5)])
+
+    def test_text_is_decoded_and_chunked_as_it_streams(self):
+
+        text = 'Roma ' * 20 + 'über alles ' * 10 + 'Ελλάδα ' * 10
+        # 7-byte reads split the multi-byte characters across reads
+        pieces = list(iter_text(BytesIO(text.encode('utf-8')).read, 7))
+        self.assertEqual(''.join(pieces), text)
+
+        chunks = list(text_chunks(pieces, 40, 10))
+        self.assertEqual(chunks[0][0], 0)
+        self.assertEqual(chunks[-1][1], len(text))
+        for (start, end, chunk), (next_start, _, _) in zip(chunks, chunks[1:]):
+            self.assertEqual(chunk, text[start:end])
+            self.assertLessEqual(len(chunk), 40)
+            # Consecutive chunks overlap and end on a word boundary
+            self.assertTrue(end - 10 <= next_start < end)
+            self.assertEqual(text[end - 1], ' ')
+        self.assertEqual(list(text_chunks(['short text'], 40, 10)), [(0, 10, 'short text')])
+        self.assertEqual(list(text_chunks([], 40, 10)), [])
+
+    @patch('vector_embed_lambda.s3vectors_client')
+    @patch('vector_embed_lambda.bedrock_runtime')
+    @patch('vector_embed_lambda.s3_client')
+    def test_long_text_is_embedded_as_overlapping_chunks(self, mock_s3, mock_bedrock, mock_s3vectors):
+
+        texts = {'note.txt': 'first note', 'long.txt': 'chunk of words ' * 10}
+        self.mock_event['tasks'] = [
+            {'taskId': f'task-{key}', 's3Key': key, 's3BucketArn': 'arn:aws:s3:::source-bucket-1'} for key in texts
+        ]
+        mock_s3.get_object.side_effect = lambda Bucket, Key: {
+            'Body': BytesIO(texts[Key].encode('utf-8')), 'ContentType': 'text/plain', 'ETag': f'"etag-{Key}"'
+        }
+        requests = []
+        def invoke_model(body, **kwargs):
+            requests.append(json.loads(body)['input']['data'])
+            return {'body': BytesIO(json.dumps(self.mock_bedrock_response_body).encode('utf-8'))}
+        mock_bedrock.invoke_model.side_effect = invoke_model
+        mock_s3vectors.get_vectors.return_value = {'vectors': []}
+
+        with patch('vector_embed_lambda.TEXT_CHUNK_TOKENS', 10), patch('vector_embed_lambda.TEXT_CHUNK_OVERLAP_TOKENS', 2), \
+                patch('vector_embed_lambda.TEXT_CHARS_PER_TOKEN', 4):
+            response = lambda_handler(self.mock_event, None)
+
+        self.assertEqual({result['resultCode'] for result in response['results']}, {'Succeeded'})
+        vectors = {v['key']: v for c in mock_s3vectors.put_vectors.call_args_list for v in c[1]['vectors']}
+        # A text that fits in one chunk keeps its key
+        self.assertEqual(vectors['note.txt']['metadata']['char_start'], 0)
+        self.assertEqual(vectors['note.txt']['metadata']['char_end'], len('first note'))
+        # One request per chunk, each chunk stored with the characters it covers
+        segments = sorted((v for v in vectors.values() if v['key'].startswith('long.txt#seg-')), key=lambda v: v['metadata']['segment_index'])
+        self.assertEqual(len(segments), len(requests) - 1)
+        self.assertEqual(segments[-1]['metadata']['char_end'], len(texts['long.txt']))
+        for vector in segments:
+            metadata = vector['metadata']
+            self.assertEqual(metadata['source_key'], 'long.txt')
+            self.assertIn(texts['long.txt'][metadata['char_start']:metadata['char_end']], requests)
+            self.assertLessEqual(metadata['char_end'] - metadata['char_start'], 40)
+            self.assertEqual(metadata['segment_count'], len(segments))
+
+    @patch('vector_embed_lambda.s3vectors_client')
+    @patch('vector_embed_lambda.bedrock_runtime')
+    @patch('vector_embed_lambda.s3_client')
+    def test_re_embedded_text_replaces_its_old_vectors(self, mock_s3, mock_bedrock, mock_s3vectors):
+
+        self.mock_event['tasks'][0]['s3Key'] = 'doc.txt'
+        text = {'body': 'short'}
+        mock_s3.get_object.side_effect = lambda Bucket, Key, **kwargs: {
+            'Body': BytesIO(text['body'].encode('utf-8')), 'ContentType': 'text/plain', 'ETag': '"new"'
+        }
+        mock_bedrock.invoke_model.side_effect = lambda **kwargs: {
+            'body': BytesIO(json.dumps(self.mock_bedrock_response_body).encode('utf-8'))
+        }
+        metadata = {'etag': '"old"', 'embedding_fingerprint': vector_embed_lambda.current_fingerprint(), 'segment_count': 5}
+        index = {f'doc.txt#seg-{i}': metadata for i in range(5)}
+        mock_s3vectors.get_vectors.side_effect = lambda keys, **kwargs: {
+            'vectors': [{'key': key, 'metadata': index[key]} for key in keys if key in index]
+        }
+
+        # The text shrank to a single chunk: its five segments are replaced by the plain key
+        lambda_handler(self.mock_event, None)
+        self.assertEqual(mock_s3vectors.delete_vectors.call_args[1]['keys'], [f'doc.txt#seg-{i}' for i in range(5)])
+        self.assertEqual([v['key'] for v in mock_s3vectors.put_vectors.call_args[1]['vectors']], ['doc.txt'])
+
+        # It grew again: the plain-key vector is deleted, segments that are rewritten are not
+        index = {'doc.txt': {'etag': '"old"', 'embedding_fingerprint': metadata['embedding_fingerprint']}}
+        text['body'] = 'chunk of words ' * 10
+        with patch('vector_embed_lambda.TEXT_CHUNK_TOKENS', 10), patch('vector_embed_lambda.TEXT_CHARS_PER_TOKEN', 4):
+            lambda_handler(self.mock_event, None)
+        self.assertEqual(mock_s3vectors.delete_vectors.call_args[1]['keys'], ['doc.txt'])
+
+    @patch('vector_embed_lambda.s3vectors_client')
+    @patch('vector_embed_lambda.bedrock_runtime')
+    @patch('vector_embed_lambda.s3_client')
+    def test_long_pdf_is_embedded_as_page_segments(self, mock_s3, mock_bedrock, mock_s3vectors):
+
+        with open(SAMPLE_PDF, 'rb') as f:
+            pdf = f.read()
+        self.mock_event['tasks'][0]['s3Key'] = 'docs/RomanHistoryTimeline.pdf'
+        mock_s3.get_object.return_value = {
+            'Body': BytesIO(pdf),
+            'ContentLength': len(pdf),
+            'ContentType': 'application/pdf',
+            'ETag': '"pdf-etag"'
+        }
+        mock_bedrock.invoke_model.side_effect = lambda **kwargs: {
+            'body': MagicMock(read=lambda: json.dumps(self.mock_bedrock_response_body).encode('utf-8'))
+        }
+
+        with patch('vector_embed_lambda.PDF_PAGES_PER_SEGMENT', 10), patch('vector_embed_lambda.PDF_PAGE_OVERLAP', 2):
+            response = lambda_handler(self.mock_event, None)
+
+        # 26 pages in windows of 10 sharing 2 pages -> pages 1-10, 9-18, 17-26
+        self.assertEqual(response['results'][0]['resultCode'], 'Succeeded')
+        self.assertEqual(mock_bedrock.invoke_model.call_count, 3)
+        vectors = mock_s3vectors.put_vectors.call_args[1]['vectors']
+        self.assertEqual([v['key'] for v in vectors], [f'docs/RomanHistoryTimeline.pdf#seg-{i}' for i in range(3)])
+        self.assertEqual([(v['metadata']['page_start'], v['metadata']['page_end']) for v in vectors], [(1, 10), (9, 18), (17, 26)])
+        self.assertEqual(vectors[0]['metadata']['source_key'], 'docs/RomanHistoryTimeline.pdf')
+
+        # Segments of concurrent PDFs share one pool, so at most MAX_CONCURRENCY of them are embedded at once
+        self.mock_event['tasks'] = [
+            {'taskId': f'task-{i}', 's3Key': f'docs/copy-{i}.pdf', 's3BucketArn': 'arn:aws:s3:::source-bucket-1'} for i in range(2)
+        ]
+        mock_s3.get_object.side_effect = lambda **kwargs: {
+            'Body': BytesIO(pdf), 'ContentLength': len(pdf), 'ContentType': 'application/pdf', 'ETag': '"pdf-etag"'
+        }
+        in_flight, peak, lock = [0], [0], threading.Lock()
+        def invoke_model(**kwargs):
+            with lock:
+                in_flight[0] += 1
+                peak[0] = max(peak[0], in_flight[0])
+            time.sleep(0.05)
+            with lock:
+                in_flight[0] -= 1
+            return {'body': MagicMock(read=lambda: json.dumps(self.mock_bedrock_response_body).encode('utf-8'))}
+        mock_bedrock.invoke_model.side_effect = invoke_model
+        with patch('vector_embed_lambda.PDF_PAGES_PER_SEGMENT', 10), patch('vector_embed_lambda.PDF_PAGE_OVERLAP', 2), \
+                patch('vector_embed_lambda.MAX_CONCURRENCY', 2), patch('vector_embed_lambda.segment_executor', None):
+            response = lambda_handler(self.mock_event, None)
+        self.assertEqual({result['resultCode'] for result in response['results']}, {'Succeeded'})
+        self.assertLessEqual(peak[0], 2)
+
+    @patch('vector_embed_lambda.s3vectors_client')
+    @patch('vector_embed_lambda.s3_client')
+    def test_segmented_async_output_keeps_offsets(self, mock_s3, mock_s3vectors):
+
+        lines = [
+            json.dumps({'embedding': self.mock_embedding, 'segmentMetadata': {'segmentStartSeconds': 0, 'segmentEndSeconds': 10}}),
+            json.dumps({'embedding': self.mock_embedding, 'segmentMetadata': {'segmentStartSeconds': 10, 'segmentEndSeconds': 14.5}}),
+        ]
+        mock_s3.get_object.side_effect = self.s3_objects({
+            'nova-output/source-bucket-1/harvard.wav/abc123/embedding-audio.jsonl': '\n'.join(lines).encode('utf-8')
+        })
+        mock_s3.head_object.return_value = {'ContentType': 'audio/wav', 'ETag': '"wav-etag"'}
+        s3_event = {'Records': [{'s3': {
+            'bucket': {'name': 'async-bucket'},
+            'object': {'key': 'nova-output/source-bucket-1/harvard.wav/abc123/embedding-audio.jsonl'}
+        }}]}
+
+        with patch('vector_embed_lambda.ASYNC_OUTPUT_URI', 's3://async-bucket/nova-output'), \
+                patch('vector_embed_lambda.SEGMENT_MEDIA', True):
+            result = vector_embed_lambda.async_result_handler(s3_event, None)
+
+        self.assertEqual(result['stored'], ['harvard.wav#seg-0', 'harvard.wav#seg-1'])
+        vectors = mock_s3vectors.put_vectors.call_args[1]['vectors']
+        self.assertEqual(vectors[1]['metadata']['segment_start_seconds'], 10)
+        self.assertEqual(vectors[1]['metadata']['segment_end_seconds'], 14.5)
+        self.assertEqual(vectors[1]['metadata']['source_key'], 'harvard.wav')
+
+    @patch('throttling.time.sleep')
+    @patch('vector_embed_lambda.s3vectors_client')
+    @patch('vector_embed_lambda.bedrock_runtime')
+    @patch('vector_embed_lambda.s3_client')
+    def test_throttling_is_retried_then_reported_as_temporary(self, mock_s3, mock_bedrock, mock_s3vectors, mock_sleep):
+
+        mock_s3.get_object.side_effect = lambda **kwargs: {
+            'Body': MagicMock(read=lambda: self.mock_file_content),
+            'ContentType': 'image/jpeg'
+        }
+        throttled = ClientError({'Error': {'Code': 'ThrottlingException', 'Message': 'Too many requests'}}, 'InvokeModel')
+        limiter = AdaptiveRateLimiter(1000, max_attempts=3)
+
+        # Throttled once, then accepted: the task succeeds
+        mock_bedrock.invoke_model.side_effect = [
+            throttled,
+            {'body': MagicMock(read=lambda: json.dumps(self.mock_bedrock_response_body).encode('utf-8'))}
+        ]
+        with patch('vector_embed_lambda.bedrock_limiter', limiter):
+            response = lambda_handler(self.mock_event, None)
+        self.assertEqual(response['results'][0]['resultCode'], 'Succeeded')
+        self.assertLess(limiter.rate, 1000)
+
+        # Throttled on every attempt: S3 Batch should retry the task later
+        mock_bedrock.invoke_model.side_effect = throttled
+        with patch('vector_embed_lambda.bedrock_limiter', limiter):
+            response = lambda_handler(self.mock_event, None)
+        self.assertEqual(response['results'][0]['resultCode'], 'TemporaryFailure')
+        self.assertEqual(mock_bedrock.invoke_model.call_count, 2 + 3)
+
+        # Calls throttled by the same burst lower the rate once, not once each
+        limiter = AdaptiveRateLimiter(20, max_attempts=2)
+        in_flight = threading.Barrier(8)
+        attempts = threading.local()
+        def burst():
+            attempts.count = getattr(attempts, 'count', 0) + 1
+            if attempts.count == 1:
+                in_flight.wait(5)
+                raise throttled
+        threads = [threading.Thread(target=limiter.call, args=(burst,)) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertGreaterEqual(limiter.rate, 10)
+
+        # Bad input is not retried and stays permanent
+        mock_bedrock.invoke_model.reset_mock()
+        mock_bedrock.invoke_model.side_effect = ClientError(
+            {'Error': {'Code': 'ValidationException', 'Message': 'Invalid image'}}, 'InvokeModel'
+        )
+        with patch('vector_embed_lambda.bedrock_limiter', limiter):
+            response = lambda_handler(self.mock_event, None)
+        self.assertEqual(response['results'][0]['resultCode'], 'PermanentFailure')
+        self.assertEqual(mock_bedrock.invoke_model.call_count, 1)
+
+    @patch('vector_embed_lambda.s3vectors_client')
+    @patch('vector_embed_lambda.bedrock_runtime')
+    @patch('vector_embed_lambda.s3_client')
+    def test_stage_metrics_are_logged_per_mime_type(self, mock_s3, mock_bedrock, mock_s3vectors):
+
+        keys = ['a.jpg', 'b.jpg', 'notes.txt', 'c.unknownext']
+        self.mock_event['tasks'] = [
+            {'taskId': f'task-{i}', 's3Key': key, 's3BucketArn': 'arn:aws:s3:::source-bucket-1'}
+            for i, key in enumerate(keys)
+        ]
+        mock_s3.get_object.side_effect = lambda Bucket, Key: {
+            'Body': BytesIO(b'some text' if Key.endswith('.txt') else self.mock_file_content),
+            'ContentLength': 9 if Key.endswith('.txt') else len(self.mock_file_content)
+        }
+        mock_bedrock.invoke_model.side_effect = lambda **kwargs: {
+            'body': MagicMock(read=lambda: json.dumps(self.mock_bedrock_response_body).encode('utf-8'))
+        }
+
+        with patch('sys.stdout', new_callable=StringIO) as stdout, patch('vector_embed_lambda.METRICS_TASK_SAMPLE_RATE', 1.0):
+            lambda_handler(self.mock_event, None)
+        lines = [json.loads(line) for line in stdout.getvalue().splitlines() if line.startswith('{')]
+        documents = [line for line in lines if '_aws' in line]
+        details = [line for line in lines if line.get('message') == 'task_metrics']
+
+        # One invocation document, then one per MIME type
+        self.assertEqual(documents[0]['Tasks'], 4)
+        self.assertEqual(documents[0]['FailedTasks'], 1)
+        self.assertIn('FlushMs', documents[0])
+        by_type = {document['MimeType']: document for document in documents[1:]}
+        self.assertEqual(sorted(by_type), ['image/jpeg', 'text/plain', 'unknown'])
+        self.assertEqual(by_type['image/jpeg']['ObjectBytes'], [len(self.mock_file_content)] * 2)
+        self.assertEqual(len(by_type['image/jpeg']['EmbedMs']), 2)
+        self.assertEqual(by_type['unknown']['FailedTasks'], 1)
+        metric_names = {m['Name'] for m in by_type['text/plain']['_aws']['CloudWatchMetrics'][0]['Metrics']}
+        self.assertTrue({'DownloadMs', 'EncodeMs', 'EmbedMs', 'StoreMs', 'TaskMs'} <= metric_names)
+        self.assertEqual(by_type['text/plain']['ObjectBytes'], [9])
+        self.assertEqual(by_type['text/plain']['_aws']['CloudWatchMetrics'][0]['Dimensions'], [['FunctionName', 'MimeType']])
+
+        # Every task sampled
+        self.assertEqual(sorted(detail['key'] for detail in details), sorted(keys))
+        self.assertEqual({detail['outcome'] for detail in details}, {'embedded', 'failed'})
+
+    @patch('vector_embed_lambda.alias_maps', new_callable=lambda: vector_embed_lambda.AliasMapCache())
+    @patch('vector_embed_lambda.s3vectors_client')
+    @patch('vector_embed_lambda.bedrock_runtime')
+    @patch('vector_embed_lambda.s3_client')
+    def test_duplicates_get_a_copy_of_the_canonical_vector(self, mock_s3, mock_bedrock, mock_s3vectors, mock_alias_maps):
+
+        alias_map = {'media/test_image.jpg': ['copies/test_image.jpg', 'backup/test_image.jpg']}
+        def get_object(Bucket, Key, **kwargs):
+            if Key == 'batch-job-manifests/aliases.json':
+                return {'Body': BytesIO(json.dumps(alias_map).encode('utf-8'))}
+            return {'Body': BytesIO(self.mock_file_content), 'ContentType': 'image/jpeg', 'ETag': '"image-etag"'}
+        mock_s3.get_object.side_effect = get_object
+        mock_stream = MagicMock()
+        mock_stream.read.return_value = json.dumps(self.mock_bedrock_response_body).encode('utf-8')
+        mock_bedrock.invoke_model.return_value = {'body': mock_stream}
+        mock_s3vectors.get_vectors.return_value = {'vectors': []}
+        # Jobs created with user arguments invoke with schema 2.0 and the bucket name
+        event = {
+            'invocationSchemaVersion': '2.0',
+            'invocationId': 'test-invocation-id',
+            'job': {'id': 'job-1', 'userArguments': {
+                'AliasMapBucket': 'source-bucket-1', 'AliasMapKey': 'batch-job-manifests/aliases.json', 'AliasMapETag': 'map-etag'
+            }},
+            'tasks': [{'taskId': 'test-task-1', 's3Key': 'media/test_image.jpg', 's3Bucket': 'source-bucket-1'}]
+        }
+
+        response = lambda_handler(event, None)
+        lambda_handler(event, None)
+
+        self.assertEqual(response['invocationSchemaVersion'], '2.0')
+        self.assertEqual(response['results'][0]['resultCode'], 'Succeeded')
+        # One embedding per invocation, stored under the canonical key and both duplicates
+        self.assertEqual(mock_bedrock.invoke_model.call_count, 2)
+        vectors = {v['key']: v for v in mock_s3vectors.put_vectors.call_args[1]['vectors']}
+        self.assertEqual(sorted(vectors), ['backup/test_image.jpg', 'copies/test_image.jpg', 'media/test_image.jpg'])
+        self.assertEqual(vectors['copies/test_image.jpg']['data'], vectors['media/test_image.jpg']['data'])
+        self.assertEqual(vectors['copies/test_image.jpg']['metadata']['canonical_key'], 'media/test_image.jpg')
+        # The alias map is downloaded once per job, not per invocation
+        map_reads = [c for c in mock_s3.get_object.call_args_list if c[1]['Key'] == 'batch-job-manifests/aliases.json']
+        self.assertEqual(len(map_reads), 1)
+
+    def load_fresh_module(self, **env):
+        """Imports a separate copy of vector_embed_lambda under the given environment."""
+        spec = importlib.util.spec_from_file_location('fresh_vector_embed_lambda', vector_embed_lambda.__file__)
+        module = importlib.util.module_from_spec(spec)
+        with patch.dict(os.environ, {name: value for name, value in env.items() if value is not None}):
+            for name in [name for name, value in env.items() if value is None]:
+                os.environ.pop(name, None)
+            spec.loader.exec_module(module)
+        return module
+
+    def test_clients_are_created_lazily_with_a_pool_sized_for_the_concurrency(self):
+
+        with patch('boto3.client') as mock_client:
+            module = self.load_fresh_module(MAX_CONCURRENCY='12')
+            mock_client.assert_not_called()
+            self.assertIsNone(module.s3_client)
+
+            # Created once on first use, then cached
+            self.assertIs(module.get_s3_client(), module.get_s3_client())
+            self.assertEqual(mock_client.call_count, 1)
+            self.assertEqual(mock_client.call_args[1]['config'].max_pool_connections, 24)
+            module.get_bedrock_runtime()
+            self.assertEqual(mock_client.call_args[1]['config'].retries['max_attempts'], 1)
+
+            # Eager mode builds every client during the import
+            mock_client.reset_mock()
+            self.load_fresh_module(LAZY_CLIENTS='false')
+            self.assertEqual(mock_client.call_count, 3)
+
+        # Objects assigned by tests (or patched) are what the getters hand out
+        with patch('vector_embed_lambda.s3_client') as mock_s3:
+            self.assertIs(vector_embed_lambda.get_s3_client(), mock_s3)
+
+    def test_bad_configuration_is_reported_on_invocation_not_at_import(self):
+
+        with patch('boto3.client') as mock_client:
+            module = self.load_fresh_module(EMBEDDING_DIMENSION=None, VECTOR_INDEX=None, MAX_CONCURRENCY='eight', LAZY_CLIENTS='false')
+        # The import succeeds and no clients are built from a broken configuration
+        mock_client.assert_not_called()
+
+        with self.assertRaises(ValueError) as raised:
+            module.lambda_handler(self.mock_event, None)
+        message = str(raised.exception)
+        self.assertIn('EMBEDDING_DIMENSION is not set', message)
+        self.assertIn('VECTOR_INDEX is not set', message)
+        self.assertIn("MAX_CONCURRENCY must be an integer, got 'eight'", message)
+
 
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
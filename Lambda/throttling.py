@@ -0,0 +1,103 @@
+import random
+import threading
+import time
+from botocore.exceptions import ClientError, ConnectionError, HTTPClientError
+
+# Error codes that mean "slow down"
+THROTTLING_ERROR_CODES = {
+    'ThrottlingException',
+    'TooManyRequestsException',
+    'SlowDown',
+}
+# Error codes for failures that are expected to go away on a retry
+TRANSIENT_ERROR_CODES = THROTTLING_ERROR_CODES | {
+    'ServiceUnavailableException',
+    'InternalServerException',
+    'ModelTimeoutException',
+    'ModelNotReadyException',
+    'RequestTimeout',
+    'InternalError',
+    'ServiceUnavailable',
+}
+
+def is_throttling_error(error):
+    return isinstance(error, ClientError) and error.response.get('Error', {}).get('Code') in THROTTLING_ERROR_CODES
+
+def is_transient_error(error):
+    """True for throttling, service-side and network errors; False for problems with the input itself."""
+    if isinstance(error, (ConnectionError, HTTPClientError)):
+        return True
+    if not isinstance(error, ClientError):
+        return False
+    if error.response.get('Error', {}).get('Code') in TRANSIENT_ERROR_CODES:
+        return True
+    status = error.response.get('ResponseMetadata', {}).get('HTTPStatusCode') or 0
+    return status == 429 or status >= 500
+
+class AdaptiveRateLimiter:
+    """Client-side token bucket shared by every thread in the container.
+
+    Calls start at max_rate per second. A throttling response halves the rate (down to
+    min_rate) and each success adds `increase` back, so a container settles just below the
+    rate the service accepts instead of retrying into a wall of ThrottlingExceptions. Only
+    calls started after the last decrease can lower the rate again, so many in-flight calls
+    throttled by the same burst halve it once instead of collapsing it to min_rate.
+    """
+
+    def __init__(self, max_rate, min_rate=0.5, increase=0.1, max_attempts=4, base_delay=0.25, max_delay=8.0):
+        self.max_rate = max(max_rate, min_rate)
+        self.min_rate = min_rate
+        self.increase = increase
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.rate = self.max_rate
+        self._tokens = max(1.0, self.rate)
+        self._updated = time.monotonic()
+        self._last_decrease = float('-inf')
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Blocks until the bucket has a token for one call."""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(max(1.0, self.rate), self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait_seconds = (1 - self._tokens) / self.rate
+            time.sleep(wait_seconds)
+
+    def on_throttle(self, started=None):
+        """Halves the rate, unless the throttled call (started at time.monotonic() `started`) predates the last decrease."""
+        with self._lock:
+            if started is not None and started < self._last_decrease:
+                return
+            self.rate = max(self.min_rate, self.rate / 2)
+            self._last_decrease = time.monotonic()
+
+    def on_success(self):
+        with self._lock:
+            self.rate = min(self.max_rate, self.rate + self.increase)
+
+    def call(self, fn):
+        """Runs fn under the rate limit, retrying transient errors with jittered exponential backoff.
+
+        The last error is raised once max_attempts is used up, or straight away if it is not transient.
+        """
+        for attempt in range(1, self.max_attempts + 1):
+            self.acquire()
+            started = time.monotonic()
+            try:
+                result = fn()
+            except Exception as e:
+                if is_throttling_error(e):
+                    self.on_throttle(started)
+                if not is_transient_error(e) or attempt == self.max_attempts:
+                    raise
+                time.sleep(random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt)))
+            else:
+                self.on_success()
+                return result
@@ -1,135 +1,699 @@
 import boto3
+from botocore.config import Config
+from botocore.exceptions import ClientError
 import json
 import os
-import base64
+import hashlib
+import threading
+import time
 import mimetypes
+from io import BytesIO
+from urllib.parse import unquote_plus
+from concurrent.futures import ThreadPoolExecutor, wait
+from vector_sink import VectorSink, MAX_VECTORS_PER_REQUEST
+from embedding_cache import EmbeddingCache, embedding_fingerprint, is_not_modified
+from payload import nova_request, nova_s3_request, build_base64_request, max_rss_mb, READ_CHUNK_SIZE
+from segments import segment_key, vector_keys, split_pdf, media_segment_bounds, iter_text, text_chunks
+from throttling import AdaptiveRateLimiter, is_transient_error
+from metrics import InvocationMetrics, TaskMetrics
+from aliases import ALIASES_SIDECAR, AliasMapCache, alias_vectors
+
+# Problems found while reading the environment. They are reported by validate_config() on the
+# first invocation instead of failing the import with a bare KeyError/TypeError.
+_config_errors = []
+
+def _env_number(name, default=None, cast=int):
+    """Reads a numeric environment variable; None (and a recorded error) if it is missing or malformed."""
+    value = os.environ.get(name, default)
+    if value is None:
+        _config_errors.append(f"{name} is not set")
+        return None
+    try:
+        return cast(value)
+    except ValueError:
+        _config_errors.append(f"{name} must be a{'n integer' if cast is int else ' number'}, got {value!r}")
+        return None
 
 # Environment variables for Lambda
 VECTOR_BUCKET = os.environ.get('VECTOR_BUCKET')
-S3_REGION = os.environ['S3_REGION']
+S3_REGION = os.environ.get('S3_REGION')
 VECTOR_INDEX = os.environ.get('VECTOR_INDEX')
 BEDROCK_MODEL_ID = os.environ.get('BEDROCK_MODEL_ID')
-EMBEDDING_DIMENSION = int(os.environ.get('EMBEDDING_DIMENSION'))
+EMBEDDING_DIMENSION = _env_number('EMBEDDING_DIMENSION')
+# Max number of tasks processed at once per invocation (1 = process tasks one after another)
+MAX_CONCURRENCY = _env_number('MAX_CONCURRENCY', '8')
+# Stop waiting on in-flight tasks this long before the Lambda times out, so the buffered vectors
+# can still be written and the results returned
+TIMEOUT_MARGIN_MS = _env_number('TIMEOUT_MARGIN_MS', '5000')
+# Part of TIMEOUT_MARGIN_MS kept back from writing the buffered vectors, to return the results.
+# Vectors not stored by then fail their task with a TemporaryFailure so S3 Batch retries it.
+RESPONSE_MARGIN_MS = _env_number('RESPONSE_MARGIN_MS', '1000')
+# Vectors per put_vectors request (the API allows at most 500)
+VECTOR_BATCH_SIZE = _env_number('VECTOR_BATCH_SIZE', str(MAX_VECTORS_PER_REQUEST))
+# Skip objects whose stored vector was built from the same ETag, model and dimension
+ENABLE_EMBEDDING_CACHE = os.environ.get('ENABLE_EMBEDDING_CACHE', 'true').lower() == 'true'
+# Bump to force every object to be re-embedded on the next run (e.g. after a model change)
+EMBEDDING_CACHE_VERSION = os.environ.get('EMBEDDING_CACHE_VERSION', '1')
+# Log the request size and the encoder's estimated payload memory of every embedded object, along with
+# the memory high-water mark of the whole process (shared by all tasks, so not a per-object peak)
+REPORT_PAYLOAD_MEMORY = os.environ.get('REPORT_PAYLOAD_MEMORY', 'true').lower() == 'true'
+# Where Bedrock asynchronous invocations write their output, e.g. s3://my-async-bucket/nova-output
+# (keep it outside the input bucket so outputs are not picked up by the next manifest).
+# Unset disables asynchronous routing.
+ASYNC_OUTPUT_URI = os.environ.get('ASYNC_OUTPUT_URI')
+# Audio and video objects larger than this are embedded asynchronously from their S3 URI
+ASYNC_SIZE_THRESHOLD_BYTES = _env_number('ASYNC_SIZE_THRESHOLD_BYTES', str(15 * 1024 * 1024))
+# Embed audio/video as time segments of SEGMENT_SECONDS each, stored as <key>#seg-N.
+# Segmented media always goes through the asynchronous path, so ASYNC_OUTPUT_URI must be set.
+SEGMENT_MEDIA = os.environ.get('SEGMENT_MEDIA', 'false').lower() == 'true'
+SEGMENT_SECONDS = _env_number('SEGMENT_SECONDS', '10')
+# Split PDFs longer than this many pages into page ranges stored as <key>#seg-N (0 = one vector per PDF)
+PDF_PAGES_PER_SEGMENT = _env_number('PDF_PAGES_PER_SEGMENT', '0')
+# Pages shared by consecutive PDF segments
+PDF_PAGE_OVERLAP = _env_number('PDF_PAGE_OVERLAP', '1')
+# Text objects are split into chunks of up to TEXT_CHUNK_TOKENS tokens (estimated as TEXT_CHARS_PER_TOKEN
+# characters each), consecutive chunks sharing TEXT_CHUNK_OVERLAP_TOKENS. A text that fits in one chunk
+# keeps a single vector under its key; longer texts are stored as <key>#seg-N.
+TEXT_CHUNK_TOKENS = _env_number('TEXT_CHUNK_TOKENS', '2000')
+TEXT_CHUNK_OVERLAP_TOKENS = _env_number('TEXT_CHUNK_OVERLAP_TOKENS', '200')
+TEXT_CHARS_PER_TOKEN = _env_number('TEXT_CHARS_PER_TOKEN', '4')
+# Upper bound on Bedrock requests per second from one Lambda container; the limiter backs off below it when throttled
+BEDROCK_MAX_RPS = _env_number('BEDROCK_MAX_RPS', '20', float)
+# Attempts per Bedrock request before a throttled/transient failure is handed back to S3 Batch
+BEDROCK_MAX_ATTEMPTS = _env_number('BEDROCK_MAX_ATTEMPTS', '4')
+# Log per-stage timings of every invocation as CloudWatch embedded metrics
+ENABLE_METRICS = os.environ.get('ENABLE_METRICS', 'true').lower() == 'true'
+METRICS_NAMESPACE = os.environ.get('METRICS_NAMESPACE', 'VectorEmbedding')
+# Share of tasks (0.0-1.0) whose individual stage timings are also logged
+METRICS_TASK_SAMPLE_RATE = _env_number('METRICS_TASK_SAMPLE_RATE', '0', float)
+# Create the AWS clients on first use (true) or while the module is imported (false). Importing
+# them eagerly moves the cost into the init phase, which only pays off with provisioned concurrency.
+LAZY_CLIENTS = os.environ.get('LAZY_CLIENTS', 'true').lower() == 'true'
+# HTTP connections per client. Defaults to two per concurrent task: up to MAX_CONCURRENCY task calls
+# plus up to MAX_CONCURRENCY calls from the shared PDF segment pool (or sink flushes), so neither
+# waits on botocore's default pool of 10.
+MAX_POOL_CONNECTIONS = _env_number('MAX_POOL_CONNECTIONS', str(max(10, 2 * (MAX_CONCURRENCY or 0))))
 
-s3_client = boto3.client('s3', region_name=S3_REGION)
-bedrock_runtime = boto3.client('bedrock-runtime', region_name=S3_REGION)
-s3vectors_client = boto3.client('s3vectors', region_name=S3_REGION)
+# Cached clients and the Bedrock rate limiter, shared by all tasks and warm invocations of this
+# container. Use the get_* functions below; tests and benchmarks assign their own objects here.
+s3_client = None
+bedrock_runtime = None
+s3vectors_client = None
+bedrock_limiter = None
+# Embeds the segments of PDFs, shared by all tasks so segment calls never exceed MAX_CONCURRENCY
+segment_executor = None
+_client_lock = threading.Lock()
+# Alias map of the current Batch job, kept across warm invocations
+alias_maps = AliasMapCache()
+_config_validated = False
 
-def lambda_handler(event, context):
-    invocation_id = event['invocationId']
-    results = []
+def validate_config():
+    """Checks the environment once per container; raises ValueError listing every problem found."""
+    global _config_validated
+    if _config_validated:
+        return
+    errors = list(_config_errors)
+    for name in ('S3_REGION', 'VECTOR_BUCKET', 'VECTOR_INDEX', 'BEDROCK_MODEL_ID'):
+        if not globals()[name]:
+            errors.append(f"{name} is not set")
+    if SEGMENT_MEDIA and not ASYNC_OUTPUT_URI:
+        errors.append("SEGMENT_MEDIA requires ASYNC_OUTPUT_URI")
+    if TIMEOUT_MARGIN_MS is not None and RESPONSE_MARGIN_MS is not None and not 0 <= RESPONSE_MARGIN_MS < TIMEOUT_MARGIN_MS:
+        errors.append(f"RESPONSE_MARGIN_MS must be between 0 and TIMEOUT_MARGIN_MS - 1, got {RESPONSE_MARGIN_MS}")
+    if MAX_CONCURRENCY is not None and MAX_CONCURRENCY < 1:
+        errors.append(f"MAX_CONCURRENCY must be at least 1, got {MAX_CONCURRENCY}")
+    for name in ('TEXT_CHUNK_TOKENS', 'TEXT_CHARS_PER_TOKEN'):
+        if globals()[name] is not None and globals()[name] < 1:
+            errors.append(f"{name} must be at least 1, got {globals()[name]}")
+    if TEXT_CHUNK_TOKENS and TEXT_CHUNK_OVERLAP_TOKENS is not None and not 0 <= TEXT_CHUNK_OVERLAP_TOKENS < TEXT_CHUNK_TOKENS:
+        errors.append(f"TEXT_CHUNK_OVERLAP_TOKENS must be between 0 and TEXT_CHUNK_TOKENS - 1, got {TEXT_CHUNK_OVERLAP_TOKENS}")
+    if METRICS_TASK_SAMPLE_RATE is not None and not 0 <= METRICS_TASK_SAMPLE_RATE <= 1:
+        errors.append(f"METRICS_TASK_SAMPLE_RATE must be between 0 and 1, got {METRICS_TASK_SAMPLE_RATE}")
+    if errors:
+        raise ValueError(f"Invalid Lambda configuration: {'; '.join(errors)}")
+    _config_validated = True
 
-    for task in event['tasks']:
-        task_id = task['taskId']
-        s3_uri = task['s3Key']
-        bucket_name = task['s3BucketArn'].split(':::')[-1]
+def _client(service_name, **config):
+    return boto3.client(service_name, region_name=S3_REGION, config=Config(max_pool_connections=MAX_POOL_CONNECTIONS, **config))
 
-        try:
-            # Download the file content
-            response = s3_client.get_object(Bucket=bucket_name, Key=s3_uri)
-            file_content = response['Body'].read()
-
-            # Try to get the ContentType from S3
-            s3_content_type = response.get('ContentType') 
-            # Fallback: Use mime types if ContentType is not set on the S3 object (defaults to binary)
-            if not s3_content_type or s3_content_type == 'binary/octet-stream' or s3_content_type == 'application/octet-stream':
-                 content_type, _ = mimetypes.guess_type(s3_uri)
-            else:
-                 content_type = s3_content_type
-            
-            if content_type is None:
-                raise ValueError(f"Could not determine data type for {s3_uri}")
-            
-            # Determine Nova MME Payload components
-            content_data = None
-            bedrock_media_type = None
-            content_encoding = None
-
-            # Nova MME requires a unified structure where mediaType is a string literal.
-            if content_type.startswith('image/'):
-                bedrock_media_type = 'image'
-            elif content_type.startswith('audio/'):
-                bedrock_media_type = 'audio'
-            elif content_type.startswith('video/'):
-                bedrock_media_type = 'video'
-            elif content_type == 'application/pdf':
-                bedrock_media_type = 'document'
-            elif content_type.startswith('text/'):
-                bedrock_media_type = 'text'
-            else:
-                raise ValueError(f"Unsupported MIME type: {content_type}")
-
-            
-            # Binary files (media and documents) must be Base64 encoded
-            if bedrock_media_type in ['image', 'video', 'audio', 'document']:
-                content_data = base64.b64encode(file_content).decode('utf-8')
-                content_encoding = 'base64'
-            # Text files should be sent as raw UTF-8 strings
-            elif bedrock_media_type == 'text':
-                content_data = file_content.decode('utf-8')
-                content_encoding = 'utf8'
-
-            # Construct the correct Bedrock request body for Nova MME
-            request_body = {
-                "input": {
-                    # This must be the string literal: 'image', 'video', 'audio', 'text', or 'document'
-                    "mediaType": bedrock_media_type, 
-                    "encoding": content_encoding,    
-                    # This must be the Base64 string or the raw text string
-                    "data": content_data 
-                },
-                "config": {
-                    "embeddingPurpose": "GENERIC_INDEX"
-                }
+# Each getter only takes the lock until its object exists; creating a boto3 client is not thread-safe
+
+def get_s3_client():
+    global s3_client
+    if s3_client is None:
+        with _client_lock:
+            if s3_client is None:
+                s3_client = _client('s3')
+    return s3_client
+
+def get_bedrock_runtime():
+    global bedrock_runtime
+    if bedrock_runtime is None:
+        with _client_lock:
+            if bedrock_runtime is None:
+                # Retries are left to bedrock_limiter so throttling feeds back into the shared request rate
+                bedrock_runtime = _client('bedrock-runtime', retries={'mode': 'standard', 'max_attempts': 1})
+    return bedrock_runtime
+
+def get_s3vectors_client():
+    global s3vectors_client
+    if s3vectors_client is None:
+        with _client_lock:
+            if s3vectors_client is None:
+                s3vectors_client = _client('s3vectors')
+    return s3vectors_client
+
+def get_bedrock_limiter():
+    global bedrock_limiter
+    if bedrock_limiter is None:
+        with _client_lock:
+            if bedrock_limiter is None:
+                bedrock_limiter = AdaptiveRateLimiter(BEDROCK_MAX_RPS, max_attempts=BEDROCK_MAX_ATTEMPTS)
+    return bedrock_limiter
+
+def get_segment_executor():
+    global segment_executor
+    if segment_executor is None:
+        with _client_lock:
+            if segment_executor is None:
+                segment_executor = ThreadPoolExecutor(max_workers=max(1, MAX_CONCURRENCY))
+    return segment_executor
+
+if not LAZY_CLIENTS and not _config_errors:
+    get_s3_client()
+    get_bedrock_runtime()
+    get_s3vectors_client()
+
+def current_fingerprint():
+    """Fingerprint of the current model and segmentation settings, stored with every vector."""
+    return embedding_fingerprint(BEDROCK_MODEL_ID, EMBEDDING_DIMENSION, EMBEDDING_CACHE_VERSION, {
+        'pdf_pages_per_segment': PDF_PAGES_PER_SEGMENT,
+        'pdf_page_overlap': PDF_PAGE_OVERLAP,
+        'segment_media': SEGMENT_MEDIA,
+        'segment_seconds': SEGMENT_SECONDS,
+        'text_chunk_tokens': TEXT_CHUNK_TOKENS,
+        'text_chunk_overlap_tokens': TEXT_CHUNK_OVERLAP_TOKENS,
+        'text_chars_per_token': TEXT_CHARS_PER_TOKEN,
+    })
+
+def resolve_content_type(key, s3_content_type):
+    """Returns the object's MIME type, guessing from the key when S3 only knows it as binary."""
+    # Fallback: Use mime types if ContentType is not set on the S3 object (defaults to binary)
+    if not s3_content_type or s3_content_type == 'binary/octet-stream' or s3_content_type == 'application/octet-stream':
+         content_type, _ = mimetypes.guess_type(key)
+    else:
+         content_type = s3_content_type
+    return content_type
+
+def should_embed_async(media_type, object_bytes):
+    """Large (or segmented) audio and video go to an asynchronous invocation instead of being inlined."""
+    if ASYNC_OUTPUT_URI is None or media_type not in ('audio', 'video'):
+        return False
+    if SEGMENT_MEDIA:
+        return True
+    return object_bytes is not None and object_bytes > ASYNC_SIZE_THRESHOLD_BYTES
+
+def async_output_uri(bucket_name, key):
+    """Output location of an object's asynchronous invocation; the source bucket and key are encoded in the path."""
+    return f"{ASYNC_OUTPUT_URI.rstrip('/')}/{bucket_name}/{key}/"
+
+def write_async_aliases(bucket_name, key, aliases):
+    """Leaves the object's duplicate keys next to its asynchronous output for async_result_handler."""
+    output_bucket, _, output_prefix = async_output_uri(bucket_name, key).split('://', 1)[-1].partition('/')
+    get_s3_client().put_object(
+        Bucket=output_bucket, Key=output_prefix + ALIASES_SIDECAR, Body=json.dumps(list(aliases)).encode('utf-8')
+    )
+
+def read_async_aliases(output_bucket, output_key):
+    """Duplicate keys left by write_async_aliases for the invocation that wrote output_key ([] if none)."""
+    # <output dir of the source object>/<invocation id>/<file>
+    sidecar_key = '/'.join(output_key.split('/')[:-2] + [ALIASES_SIDECAR])
+    try:
+        body = get_s3_client().get_object(Bucket=output_bucket, Key=sidecar_key)['Body'].read()
+    except ClientError as e:
+        if e.response.get('Error', {}).get('Code') not in ('NoSuchKey', '404'):
+            raise
+        return []
+    return json.loads(body)
+
+def start_async_embedding(bucket_name, key, media_type, etag):
+    """Starts an asynchronous Nova MME invocation that reads the object straight from S3. Returns the invocation ARN."""
+    # Same object version -> same token, so an S3 Batch retry does not start a second invocation
+    token = hashlib.sha256(f"{bucket_name}/{key}/{etag}".encode('utf-8')).hexdigest()
+    response = get_bedrock_limiter().call(lambda: get_bedrock_runtime().start_async_invoke(
+        clientRequestToken=token,
+        modelId=BEDROCK_MODEL_ID,
+        modelInput=nova_s3_request(
+            media_type, f"s3://{bucket_name}/{key}", segment_seconds=SEGMENT_SECONDS if SEGMENT_MEDIA else None
+        ),
+        outputDataConfig={'s3OutputDataConfig': {'s3Uri': async_output_uri(bucket_name, key)}}
+    ))
+    return response['invocationArn']
+
+def invoke_embedding(request_body):
+    """Runs one synchronous Nova MME request and returns its embedding."""
+    bedrock_response = get_bedrock_limiter().call(lambda: get_bedrock_runtime().invoke_model(
+        modelId=BEDROCK_MODEL_ID,
+        body=request_body,
+        contentType='application/json',
+        accept='application/json'
+    ))
+
+    # Extract embedding
+    response_body = json.loads(bedrock_response['body'].read())
+    # Note: The Nova MME response format uses 'embeddings' -> [0] -> 'embedding'
+    return response_body["embeddings"][0]["embedding"]
+
+def delete_stale_vectors(previous_keys, current_keys):
+    """Deletes the vectors of an earlier embedding that the new one does not overwrite.
+
+    E.g. <key>#seg-2..4 after a text shrank from five chunks to two, or the plain key of a
+    document that is now stored in segments. Returns the deleted keys.
+    """
+    current_keys = set(current_keys)
+    stale = [key for key in dict.fromkeys(previous_keys) if key not in current_keys]
+    for start in range(0, len(stale), MAX_VECTORS_PER_REQUEST):
+        get_s3vectors_client().delete_vectors(
+            vectorBucketName=VECTOR_BUCKET,
+            indexName=VECTOR_INDEX,
+            keys=stale[start:start + MAX_VECTORS_PER_REQUEST]
+        )
+    return stale
+
+def embed_pdf_segments(task_id, bucket_name, key, content_type, etag, segments, sink, cache, aliases=(), previous_keys=()):
+    """Embeds the page ranges of a PDF together and stores one vector per range under <key>#seg-N (and each alias)."""
+    def embed(segment):
+        pdf = segment[2]
+        return invoke_embedding(build_base64_request(BytesIO(pdf), len(pdf), 'document')[0])
+
+    # One pool for the segments of every task, instead of one per task on top of the task pool
+    embeddings = list(get_segment_executor().map(embed, segments))
+
+    # Vectors are only handed to the sink once every segment embedded, so a PDF is never half-indexed
+    delete_stale_vectors(previous_keys, [vector for source in [key, *aliases] for vector in vector_keys(source, len(segments))])
+    for index, ((start, end, _), embedding) in enumerate(zip(segments, embeddings)):
+        vector = {
+            "key": segment_key(key, index),
+            "data": {"float32": embedding},
+            "metadata": {
+                "source_bucket": bucket_name,
+                "mime_type": content_type,
+                "source_key": key,
+                "segment_index": index,
+                "segment_count": len(segments),
+                # 1-based, inclusive page numbers
+                "page_start": start + 1,
+                "page_end": end,
+                **cache.metadata(etag)
             }
+        }
+        for stored in [vector] + alias_vectors(vector, key, aliases):
+            sink.add(task_id, stored)
 
-            # Invoke Bedrock Model
-            bedrock_response = bedrock_runtime.invoke_model(
-                modelId=BEDROCK_MODEL_ID,
-                body=json.dumps(request_body),
-                contentType='application/json',
-                accept='application/json'
-            )
-            
-            # Extract embedding
-            response_body = json.loads(bedrock_response['body'].read())
-            # Note: The Nova MME response format uses 'embeddings' -> [0] -> 'embedding'
-            embedding = response_body["embeddings"][0]["embedding"]
-
-            # Store the vector in S3 Vector Bucket
-            vector_to_store = {
-                "key": s3_uri,
+def embed_text(task_id, bucket_name, key, content_type, etag, body_stream, sink, cache, task_metrics, aliases=(), previous_keys=()):
+    """Embeds a text object chunk by chunk as it streams in and stores the vectors. Returns the number of chunks.
+
+    Every vector records the character range it covers. Only the current chunk's text is held
+    in memory; the vectors are handed to the sink once every chunk embedded.
+    """
+    def read(size):
+        with task_metrics.stage('download'):
+            data = body_stream.read(size)
+        task_metrics.object_bytes += len(data)
+        return data
+
+    task_metrics.object_bytes = 0
+    offsets = []
+    embeddings = []
+    max_chars = TEXT_CHUNK_TOKENS * TEXT_CHARS_PER_TOKEN
+    for start, end, text in text_chunks(iter_text(read, READ_CHUNK_SIZE), max_chars, TEXT_CHUNK_OVERLAP_TOKENS * TEXT_CHARS_PER_TOKEN):
+        with task_metrics.stage('encode'):
+            request_body = json.dumps(nova_request('text', 'utf8', text)).encode('utf-8')
+        task_metrics.request_bytes += len(request_body)
+        with task_metrics.stage('embed'):
+            embeddings.append(invoke_embedding(request_body))
+        offsets.append((start, end))
+
+    # Vectors are only handed to the sink once every chunk embedded, so a text is never half-indexed
+    with task_metrics.stage('store'):
+        delete_stale_vectors(previous_keys, [vector for source in [key, *aliases] for vector in vector_keys(source, len(offsets))])
+        for index, ((start, end), embedding) in enumerate(zip(offsets, embeddings)):
+            metadata = {"source_bucket": bucket_name, "mime_type": content_type}
+            if len(offsets) > 1:
+                metadata.update({"source_key": key, "segment_index": index, "segment_count": len(offsets)})
+            vector = {
+                "key": segment_key(key, index) if len(offsets) > 1 else key,
                 "data": {"float32": embedding},
                 "metadata": {
-                    "source_bucket": bucket_name,
-                    "mime_type": content_type 
+                    **metadata,
+                    # 0-based, end-exclusive character offsets into the decoded text
+                    "char_start": start,
+                    "char_end": end,
+                    **cache.metadata(etag)
                 }
             }
-            
-            s3vectors_client.put_vectors(
-                vectorBucketName=VECTOR_BUCKET,
-                indexName=VECTOR_INDEX,
-                vectors=[vector_to_store]
-            )
+            for stored in [vector] + alias_vectors(vector, key, aliases):
+                sink.add(task_id, stored)
 
-            # Task succeeded
-            results.append({
+    return len(offsets)
+
+def task_bucket(task):
+    """Source bucket of a task: invocation schema 2.0 sends the name, 1.0 the bucket ARN."""
+    return task.get('s3Bucket') or task['s3BucketArn'].split(':::')[-1]
+
+def process_task(task, sink, cache, cached_etag=None, task_metrics=None, aliases=None, previous_keys=()):
+    """Downloads and embeds a single S3 Batch task and hands its vector to the sink. Returns the task's result entry.
+
+    cached_etag is the ETag the task's stored vector was built from, if that vector is current.
+    Stage timings and sizes are recorded on task_metrics. aliases are keys of objects with the
+    same content, which get a copy of the vector instead of being embedded themselves (None
+    when the job has no alias map). previous_keys are the vectors already stored for the object
+    and its aliases; those the new embedding does not overwrite are deleted.
+    """
+    task_id = task['taskId']
+    s3_uri = task['s3Key']
+    bucket_name = task_bucket(task)
+    task_metrics = task_metrics or TaskMetrics(s3_uri)
+
+    try:
+        # Download the file content, unless it still matches the ETag of the stored vector
+        get_object_args = {'Bucket': bucket_name, 'Key': s3_uri}
+        if cached_etag:
+            get_object_args['IfNoneMatch'] = cached_etag
+        try:
+            with task_metrics.stage('download'):
+                response = get_s3_client().get_object(**get_object_args)
+        except Exception as e:
+            if not is_not_modified(e):
+                raise
+            task_metrics.outcome = 'skipped'
+            return {
                 'taskId': task_id,
                 'resultCode': 'Succeeded',
-                'resultString': f'Successfully embedded {s3_uri} ({content_type}) with {EMBEDDING_DIMENSION} dimensions'
-            })
+                'resultString': f'Skipped {s3_uri}: stored vector is already current'
+            }
+        body_stream = response['Body']
 
-        except Exception as e:
-            # Error handling for the S3 Batch Job
-            print(f"Error processing {s3_uri}: {e}")
-            results.append({
+        # Try to get the ContentType from S3
+        content_type = resolve_content_type(s3_uri, response.get('ContentType'))
+
+        if content_type is None:
+            raise ValueError(f"Could not determine data type for {s3_uri}")
+        task_metrics.mime_type = content_type
+        task_metrics.object_bytes = response.get('ContentLength') or 0
+
+        # Determine Nova MME Payload components
+        bedrock_media_type = None
+
+        # Nova MME requires a unified structure where mediaType is a string literal.
+        if content_type.startswith('image/'):
+            bedrock_media_type = 'image'
+        elif content_type.startswith('audio/'):
+            bedrock_media_type = 'audio'
+        elif content_type.startswith('video/'):
+            bedrock_media_type = 'video'
+        elif content_type == 'application/pdf':
+            bedrock_media_type = 'document'
+        elif content_type.startswith('text/'):
+            bedrock_media_type = 'text'
+        else:
+            body_stream.close()
+            raise ValueError(f"Unsupported MIME type: {content_type}")
+
+        # Large audio/video: let Bedrock read the object from S3 asynchronously. The vector is
+        # written later by async_result_handler, so the task reports a pending success.
+        if should_embed_async(bedrock_media_type, response.get('ContentLength')):
+            body_stream.close()
+            # Always rewritten in deduplicating jobs so an earlier job's aliases are not reused
+            if aliases is not None:
+                write_async_aliases(bucket_name, s3_uri, aliases)
+            with task_metrics.stage('embed'):
+                invocation_arn = start_async_embedding(bucket_name, s3_uri, bedrock_media_type, response.get('ETag'))
+            task_metrics.outcome = 'async'
+            return {
+                'taskId': task_id,
+                'resultCode': 'Succeeded',
+                'resultString': f'Pending: asynchronous embedding of {s3_uri} ({content_type}) started as {invocation_arn}'
+            }
+
+        # Text is decoded and chunked as it streams in
+        if bedrock_media_type == 'text':
+            chunk_count = embed_text(
+                task_id, bucket_name, s3_uri, content_type, response.get('ETag'), body_stream, sink, cache,
+                task_metrics, aliases or (), previous_keys
+            )
+            if chunk_count == 0:
+                raise ValueError(f"{s3_uri} contains no text")
+            task_metrics.outcome = 'segmented' if chunk_count > 1 else 'embedded'
+            return {
                 'taskId': task_id,
-                'resultCode': 'PermanentFailure',
-                'resultString': str(e)
+                'resultCode': 'Succeeded',
+                'resultString': f'Successfully embedded {s3_uri} ({content_type}) as {chunk_count} text chunk{"s" if chunk_count > 1 else ""}'
+            }
+
+        # Long PDFs: embed page ranges instead of the whole document
+        if bedrock_media_type == 'document' and PDF_PAGES_PER_SEGMENT > 0:
+            with task_metrics.stage('download'):
+                data = body_stream.read()
+            with task_metrics.stage('encode'):
+                segments = split_pdf(data, PDF_PAGES_PER_SEGMENT, PDF_PAGE_OVERLAP)
+            if len(segments) > 1:
+                # Segments are encoded and embedded in parallel, so they are timed together
+                with task_metrics.stage('embed'):
+                    embed_pdf_segments(task_id, bucket_name, s3_uri, content_type, response.get('ETag'), segments, sink, cache, aliases or (), previous_keys)
+                task_metrics.outcome = 'segmented'
+                return {
+                    'taskId': task_id,
+                    'resultCode': 'Succeeded',
+                    'resultString': f'Successfully embedded {s3_uri} ({content_type}) as {len(segments)} page segments'
+                }
+            # Short enough for a single vector; carry on with the bytes already read
+            body_stream = BytesIO(segments[0][2])
+            response['ContentLength'] = len(segments[0][2])
+
+        # Binary files (media and documents) must be Base64 encoded. The object is streamed
+        # and encoded directly into the request body to avoid holding several full copies.
+        object_bytes = response.get('ContentLength')
+        # The object is read while it is encoded, so this stage includes the transfer of the body
+        with task_metrics.stage('encode'):
+            request_body, estimated_payload_bytes = build_base64_request(body_stream, object_bytes, bedrock_media_type)
+        task_metrics.object_bytes = object_bytes or 0
+        task_metrics.request_bytes = len(request_body)
+
+        if REPORT_PAYLOAD_MEMORY:
+            print(json.dumps({
+                'message': 'payload_memory',
+                'key': s3_uri,
+                'media_type': bedrock_media_type,
+                'object_bytes': object_bytes,
+                'request_bytes': len(request_body),
+                'estimated_payload_bytes': estimated_payload_bytes,
+                'process_max_rss_mb': round(max_rss_mb(), 1)
+            }))
+
+        # Invoke Bedrock Model
+        with task_metrics.stage('embed'):
+            embedding = invoke_embedding(request_body)
+
+        # Store the vector in S3 Vector Bucket
+        vector_to_store = {
+            "key": s3_uri,
+            "data": {"float32": embedding},
+            "metadata": {
+                "source_bucket": bucket_name,
+                "mime_type": content_type,
+                **cache.metadata(response.get('ETag'))
+            }
+        }
+
+        with task_metrics.stage('store'):
+            delete_stale_vectors(previous_keys, [s3_uri, *(aliases or ())])
+            for stored in [vector_to_store] + alias_vectors(vector_to_store, s3_uri, aliases or ()):
+                sink.add(task_id, stored)
+        task_metrics.outcome = 'embedded'
+
+        # Task succeeded (unless the sink reports a write failure on flush)
+        return {
+            'taskId': task_id,
+            'resultCode': 'Succeeded',
+            'resultString': f'Successfully embedded {s3_uri} ({content_type}) with {EMBEDDING_DIMENSION} dimensions'
+        }
+
+    except Exception as e:
+        # Error handling for the S3 Batch Job: throttling and other transient errors are
+        # retried by S3 Batch, anything else (bad input, unsupported type) is permanent
+        print(f"Error processing {s3_uri}: {e}")
+        return {
+            'taskId': task_id,
+            'resultCode': 'TemporaryFailure' if is_transient_error(e) else 'PermanentFailure',
+            'resultString': str(e)
+        }
+
+def async_result_handler(event, context):
+    """Stores the vectors produced by asynchronous invocations.
+
+    Triggered by S3 ObjectCreated notifications on ASYNC_OUTPUT_URI. Bedrock writes each
+    invocation's output below <ASYNC_OUTPUT_URI>/<source bucket>/<source key>/<invocation id>/,
+    so the source object is recovered from the output key.
+    """
+    validate_config()
+    output_prefix = ASYNC_OUTPUT_URI.split('://', 1)[-1].partition('/')[2].strip('/')
+    output_prefix = output_prefix + '/' if output_prefix else ''
+    sink = VectorSink(get_s3vectors_client(), VECTOR_BUCKET, VECTOR_INDEX, batch_size=VECTOR_BATCH_SIZE)
+    cache = EmbeddingCache(
+        get_s3vectors_client(), VECTOR_BUCKET, VECTOR_INDEX,
+        current_fingerprint()
+    )
+    stored = []
+
+    for record in event.get('Records', []):
+        output_bucket = record['s3']['bucket']['name']
+        output_key = unquote_plus(record['s3']['object']['key'])
+        # Embeddings are written as JSON lines; skip the invocation's other output files
+        if not output_key.endswith('.jsonl') or not output_key.startswith(output_prefix):
+            continue
+        parts = output_key[len(output_prefix):].split('/')
+        source_bucket, source_key = parts[0], '/'.join(parts[1:-2])
+
+        body = get_s3_client().get_object(Bucket=output_bucket, Key=output_key)['Body'].read().decode('utf-8')
+        embeddings = [json.loads(line) for line in body.splitlines() if line.strip()]
+        embeddings = [item for item in embeddings if 'embedding' in item]
+        if not embeddings:
+            print(f"No embeddings in s3://{output_bucket}/{output_key}")
+            continue
+
+        source = get_s3_client().head_object(Bucket=source_bucket, Key=source_key)
+        aliases = read_async_aliases(output_bucket, output_key)
+        metadata = {
+            "source_bucket": source_bucket,
+            "mime_type": resolve_content_type(source_key, source.get('ContentType')),
+            **cache.metadata(source.get('ETag'))
+        }
+        if not SEGMENT_MEDIA:
+            vectors = [{"key": source_key, "data": {"float32": embeddings[0]["embedding"]}, "metadata": metadata}]
+        else:
+            vectors = []
+        # Segmented output: one vector per time segment, with its offsets so queries can seek to it
+        for index, item in enumerate(embeddings if SEGMENT_MEDIA else []):
+            start, end = media_segment_bounds(item, index, SEGMENT_SECONDS)
+            vectors.append({
+                "key": segment_key(source_key, index),
+                "data": {"float32": item["embedding"]},
+                "metadata": {
+                    **metadata,
+                    "source_key": source_key,
+                    "segment_index": index,
+                    "segment_count": len(embeddings),
+                    "segment_start_seconds": start,
+                    "segment_end_seconds": end
+                }
             })
+        copies = [copy for vector in vectors for copy in [vector] + alias_vectors(vector, source_key, aliases)]
+        # Remove what an earlier embedding of the object left behind, e.g. segments of a longer version
+        previous = cache.stored_vectors([source_key, *aliases])
+        delete_stale_vectors([key for found in previous.values() for key in found['keys']], [copy['key'] for copy in copies])
+        for copy in copies:
+            sink.add(source_key, copy)
+            stored.append(copy['key'])
+
+    failures = sink.flush()
+    if failures:
+        # Fail the invocation so the S3 notification is retried
+        raise RuntimeError(f"Failed to store asynchronous embeddings: {failures}")
+    return {'stored': stored}
+
+def remaining_time_seconds(context):
+    """Seconds left to wait on tasks before the Lambda timeout (None when running without a Lambda context)."""
+    if context is None:
+        return None
+    return max(0, context.get_remaining_time_in_millis() - TIMEOUT_MARGIN_MS) / 1000
+
+def flush_deadline(context):
+    """time.monotonic() by which the buffered vectors must be written (None when running without a Lambda context)."""
+    if context is None:
+        return None
+    return time.monotonic() + max(0, context.get_remaining_time_in_millis() - RESPONSE_MARGIN_MS) / 1000
+
+def run_task(task, sink, cache, cached_etag, task_metrics, aliases, previous_keys):
+    with task_metrics.running():
+        return process_task(task, sink, cache, cached_etag, task_metrics, aliases, previous_keys)
+
+def lambda_handler(event, context):
+    validate_config()
+    invocation_id = event['invocationId']
+    # Jobs created with user arguments (e.g. an alias map) invoke with schema 2.0; the response must echo it
+    schema_version = event.get('invocationSchemaVersion', '1.0')
+    user_arguments = (event.get('job') or {}).get('userArguments') or {}
+    tasks = event['tasks']
+    results = [None] * len(tasks)
+    metrics = InvocationMetrics(
+        METRICS_NAMESPACE, os.environ.get('AWS_LAMBDA_FUNCTION_NAME', 'local'), invocation_id, METRICS_TASK_SAMPLE_RATE
+    )
+    task_metrics = [metrics.task(task['s3Key']) for task in tasks]
+    sink = VectorSink(get_s3vectors_client(), VECTOR_BUCKET, VECTOR_INDEX, batch_size=VECTOR_BATCH_SIZE)
+    cache = EmbeddingCache(
+        get_s3vectors_client(), VECTOR_BUCKET, VECTOR_INDEX,
+        current_fingerprint()
+    )
+    # Duplicate keys of each task's object, from the alias map the manifest build wrote
+    aliases = None
+    if user_arguments.get('AliasMapKey'):
+        alias_map = alias_maps.get(
+            get_s3_client(), user_arguments['AliasMapBucket'], user_arguments['AliasMapKey'], user_arguments.get('AliasMapETag')
+        )
+        aliases = {task['s3Key']: alias_map.get(task['s3Key'], []) for task in tasks}
+
+    # One batched lookup for all tasks (and their aliases) of the invocation
+    # (segmented objects are looked up by their first segment, then their other segments).
+    # Even with the cache disabled it finds the vectors a re-embedded object has to replace.
+    keys = [key for task in tasks for key in [task['s3Key']] + (aliases or {}).get(task['s3Key'], [])]
+    with metrics.stage('cache_lookup'):
+        stored = cache.stored_vectors(keys)
+
+    # Run up to MAX_CONCURRENCY tasks at once. boto3 clients are thread-safe, so the
+    # S3 download, Bedrock call and put_vectors round trips of different tasks overlap.
+    executor = ThreadPoolExecutor(max_workers=max(1, min(MAX_CONCURRENCY, len(tasks))))
+    futures = {}
+    for index, task in enumerate(tasks):
+        task_aliases = aliases[task['s3Key']] if aliases is not None else None
+        object_keys = [task['s3Key']] + (task_aliases or [])
+        cached = [stored.get(key, {}).get('etag') for key in object_keys]
+        # Only skip the object if every alias already has the same current vector too
+        cached_etag = cached[0] if ENABLE_EMBEDDING_CACHE and all(etag == cached[0] for etag in cached) else None
+        previous_keys = [vector for key in object_keys for vector in stored.get(key, {}).get('keys', [])]
+        futures[executor.submit(run_task, task, sink, cache, cached_etag, task_metrics[index], task_aliases, previous_keys)] = index
+    with metrics.stage('tasks'):
+        done, not_done = wait(futures, timeout=remaining_time_seconds(context))
+
+    for future in done:
+        results[futures[future]] = future.result()
+
+    # Tasks still queued or running when time runs out are handed back to S3 Batch for a retry
+    for future in not_done:
+        future.cancel()
+        task = tasks[futures[future]]
+        print(f"Timed out before finishing {task['s3Key']} (invocation {invocation_id})")
+        results[futures[future]] = {
+            'taskId': task['taskId'],
+            'resultCode': 'TemporaryFailure',
+            'resultString': 'Lambda timeout reached before the task finished'
+        }
+    executor.shutdown(wait=False, cancel_futures=True)
+
+    # Write the remaining buffered vectors and fail the tasks whose vectors could not be stored.
+    # Tasks that timed out may still be running; the flushed sink rejects what they add later.
+    with metrics.stage('flush'):
+        failures = sink.flush(deadline=flush_deadline(context))
+    for result, task_metric in zip(results, task_metrics):
+        if result['taskId'] in failures and result['resultCode'] == 'Succeeded':
+            result['resultCode'], result['resultString'] = failures[result['taskId']]
+        task_metric.result_code = result['resultCode']
+
+    if ENABLE_METRICS:
+        metrics.emit()
 
     return {
-        'invocationSchemaVersion': '1.0',
+        'invocationSchemaVersion': schema_version,
         'treatMissingKeysAs': 'Succeeded',
         'results': results
     }
\ No newline at end of file
@@ -0,0 +1,106 @@
+import random
+import threading
+import time
+from botocore.exceptions import ClientError
+from throttling import is_transient_error
+
+# PutVectors accepts at most 500 vectors per request
+MAX_VECTORS_PER_REQUEST = 500
+# Error codes that blame the vectors in the request rather than the index or the caller's permissions
+INVALID_VECTOR_ERROR_CODES = {'ValidationException'}
+
+def is_invalid_vector_error(error):
+    return isinstance(error, ClientError) and error.response.get('Error', {}).get('Code') in INVALID_VECTOR_ERROR_CODES
+
+class VectorSink:
+    """Collects vectors from S3 Batch tasks and writes them to the index in batched put_vectors calls.
+
+    Every vector is added together with the taskId it belongs to, so write failures can be
+    reported against the right task. Call flush() once all tasks are done; it returns
+    {taskId: (resultCode, resultString)} for every task that had a vector fail to store.
+    The sink is closed by flush(): vectors added later (by a task still running after the
+    invocation gave up on it) are not written but logged and recorded as failures.
+    """
+
+    def __init__(self, client, vector_bucket, index_name, batch_size=MAX_VECTORS_PER_REQUEST, max_attempts=4):
+        self.client = client
+        self.vector_bucket = vector_bucket
+        self.index_name = index_name
+        self.batch_size = max(1, min(batch_size, MAX_VECTORS_PER_REQUEST))
+        self.max_attempts = max_attempts
+        self._pending = []
+        self._failures = {}
+        self._closed = False
+        self._deadline = None
+        self._lock = threading.Lock()
+
+    def add(self, task_id, vector):
+        """Buffers one vector, writing a full batch as soon as one is available."""
+        batch = None
+        with self._lock:
+            closed = self._closed
+            if not closed:
+                self._pending.append((task_id, vector))
+                if len(self._pending) >= self.batch_size:
+                    batch = self._pending[:self.batch_size]
+                    self._pending = self._pending[self.batch_size:]
+        if closed:
+            self._record_failure([(task_id, vector)], 'TemporaryFailure', 'Vector added after the sink was flushed')
+        if batch:
+            self._write(batch)
+
+    def flush(self, deadline=None):
+        """Writes everything still buffered and returns the failures seen so far.
+
+        deadline is a time.monotonic() value; batches that are not stored by then (including
+        retries that would back off past it) fail their tasks with a TemporaryFailure.
+        """
+        with self._lock:
+            pending, self._pending = self._pending, []
+            self._closed = True
+            self._deadline = deadline
+        for start in range(0, len(pending), self.batch_size):
+            self._write(pending[start:start + self.batch_size])
+        with self._lock:
+            return dict(self._failures)
+
+    def _write(self, batch):
+        for attempt in range(1, self.max_attempts + 1):
+            if self._deadline is not None and time.monotonic() >= self._deadline:
+                self._record_failure(batch, 'TemporaryFailure', 'Lambda timeout reached before the vector was stored')
+                return
+            try:
+                self.client.put_vectors(
+                    vectorBucketName=self.vector_bucket,
+                    indexName=self.index_name,
+                    vectors=[vector for _, vector in batch]
+                )
+                return
+            except Exception as e:
+                # Errors worth retrying as-is
+                if is_transient_error(e):
+                    if attempt < self.max_attempts:
+                        # Exponential backoff with full jitter, never sleeping past the deadline
+                        delay = random.uniform(0, 0.2 * 2 ** attempt)
+                        if self._deadline is not None:
+                            delay = max(0, min(delay, self._deadline - time.monotonic()))
+                        time.sleep(delay)
+                        continue
+                    self._record_failure(batch, 'TemporaryFailure', f'Failed to store vector: {e}')
+                    return
+                if is_invalid_vector_error(e) and len(batch) > 1:
+                    # PutVectors rejects the whole request if any vector is invalid. Split the
+                    # batch so the good vectors still get stored and only the bad ones fail.
+                    middle = len(batch) // 2
+                    self._write(batch[:middle])
+                    self._write(batch[middle:])
+                    return
+                # Anything else (AccessDenied, a missing index, ...) fails the whole batch at once
+                self._record_failure(batch, 'PermanentFailure', f'Failed to store vector: {e}')
+                return
+
+    def _record_failure(self, batch, result_code, message):
+        print(f"{message} (keys: {', '.join(vector['key'] for _, vector in batch)})")
+        with self._lock:
+            for task_id, _ in batch:
+                self._failures[task_id] = (result_code, message)
@@ -0,0 +1,251 @@
+import argparse
+import os
+import numpy as np
+
+from query_engine import LocalVectorIndex, INDEX_DIR
+
+# Where the approximate index is saved, next to the exported vectors
+ANN_FILE = 'ivfpq.npz'
+# Each sub-vector is encoded as one byte
+CODES_PER_SUBSPACE = 256
+
+def kmeans(vectors, n_clusters, iterations=20, seed=0):
+    """Plain Lloyd's k-means. Returns (n_clusters, dimension) centroids."""
+    rng = np.random.default_rng(seed)
+    n_clusters = min(n_clusters, len(vectors))
+    centroids = vectors[rng.choice(len(vectors), n_clusters, replace=False)].copy()
+    for _ in range(iterations):
+        assignment = nearest_centroid(vectors, centroids)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignment, vectors)
+        counts = np.bincount(assignment, minlength=n_clusters)
+        empty = counts == 0
+        centroids[~empty] = sums[~empty] / counts[~empty, None]
+        # Re-seed empty clusters with random points so every centroid stays in use
+        if empty.any():
+            centroids[empty] = vectors[rng.choice(len(vectors), int(empty.sum()), replace=False)]
+    return centroids
+
+def nearest_centroid(vectors, centroids, block_rows=16384):
+    """Index of the closest centroid (squared L2) for each vector."""
+    centroid_norms = (centroids ** 2).sum(axis=1)
+    assignment = np.empty(len(vectors), dtype=np.int64)
+    for start in range(0, len(vectors), block_rows):
+        block = vectors[start:start + block_rows]
+        assignment[start:start + len(block)] = np.argmin(centroid_norms - 2 * block @ centroids.T, axis=1)
+    return assignment
+
+def normalize(vectors):
+    vectors = np.atleast_2d(np.asarray(vectors, dtype=np.float32))
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.where(norms == 0, 1, norms)
+
+class IVFPQIndex:
+    """Inverted-file index with product-quantised residuals for approximate cosine search.
+
+    Vectors are normalised, assigned to the nearest of n_lists coarse centroids, and the
+    residual to that centroid is split into n_subvectors pieces that are each stored as a
+    one-byte code. A query only scores the vectors of its n_probe closest lists, using
+    per-query lookup tables, so search cost grows with n_probe instead of corpus size.
+
+    Entries are keyed by the vector key. Adding a key that already exists replaces it, so
+    the index can be updated in place as objects are (re-)embedded without retraining, and
+    remove() drops the entries of deleted objects.
+    """
+
+    def __init__(self, centroids, codebooks):
+        self.centroids = centroids
+        self.codebooks = codebooks
+        self.codes = np.empty((0, len(codebooks)), dtype=np.uint8)
+        self.keys = []
+        self.versions = []
+        self.alive = np.empty(0, dtype=bool)
+        self.list_rows = [np.empty(0, dtype=np.int64) for _ in range(len(centroids))]
+        self.key_rows = {}
+
+    @property
+    def n_lists(self):
+        return len(self.centroids)
+
+    @property
+    def n_subvectors(self):
+        return len(self.codebooks)
+
+    def __len__(self):
+        return len(self.key_rows)
+
+    @classmethod
+    def train(cls, vectors, n_lists=256, n_subvectors=32, iterations=20, max_training_vectors=100000, seed=0):
+        """Learns coarse centroids and sub-vector codebooks from a sample of the vectors (nothing is added)."""
+        vectors = normalize(vectors)
+        dimension = vectors.shape[1]
+        if dimension % n_subvectors:
+            raise ValueError(f"Dimension {dimension} is not divisible by {n_subvectors} sub-vectors")
+        rng = np.random.default_rng(seed)
+        if len(vectors) > max_training_vectors:
+            vectors = vectors[rng.choice(len(vectors), max_training_vectors, replace=False)]
+
+        centroids = kmeans(vectors, n_lists, iterations, seed)
+        residuals = vectors - centroids[nearest_centroid(vectors, centroids)]
+        sub_dimension = dimension // n_subvectors
+        codebooks = np.stack([
+            cls._pad_codebook(kmeans(residuals[:, j * sub_dimension:(j + 1) * sub_dimension], CODES_PER_SUBSPACE, iterations, seed))
+            for j in range(n_subvectors)
+        ])
+        return cls(centroids.astype(np.float32), codebooks.astype(np.float32))
+
+    @staticmethod
+    def _pad_codebook(codebook):
+        # Small training sets give fewer than 256 codes; repeat the last one so codes stay one byte
+        if len(codebook) < CODES_PER_SUBSPACE:
+            codebook = np.concatenate([codebook, np.repeat(codebook[-1:], CODES_PER_SUBSPACE - len(codebook), axis=0)])
+        return codebook
+
+    def _encode(self, vectors, lists):
+        residuals = vectors - self.centroids[lists]
+        sub_dimension = residuals.shape[1] // self.n_subvectors
+        codes = np.empty((len(vectors), self.n_subvectors), dtype=np.uint8)
+        for j, codebook in enumerate(self.codebooks):
+            codes[:, j] = nearest_centroid(residuals[:, j * sub_dimension:(j + 1) * sub_dimension], codebook)
+        return codes
+
+    def add(self, vectors, keys, versions=None):
+        """Adds (or replaces) vectors under their keys. versions (e.g. ETags) are kept to detect changed vectors later."""
+        vectors = normalize(vectors)
+        versions = list(versions) if versions is not None else [''] * len(keys)
+        lists = nearest_centroid(vectors, self.centroids)
+        first_row = len(self.keys)
+
+        for key in keys:
+            if key in self.key_rows:
+                self.alive[self.key_rows[key]] = False
+        self.codes = np.concatenate([self.codes, self._encode(vectors, lists)])
+        self.alive = np.concatenate([self.alive, np.ones(len(keys), dtype=bool)])
+        self.keys.extend(keys)
+        self.versions.extend(versions)
+        for offset, key in enumerate(keys):
+            self.key_rows[key] = first_row + offset
+
+        rows = np.arange(first_row, first_row + len(keys))
+        for list_id in np.unique(lists):
+            self.list_rows[list_id] = np.concatenate([self.list_rows[list_id], rows[lists == list_id]])
+
+    def remove(self, keys):
+        """Drops the entries of the given keys (unknown keys are ignored)."""
+        for key in keys:
+            row = self.key_rows.pop(key, None)
+            if row is not None:
+                self.alive[row] = False
+
+    def search(self, queries, k=10, n_probe=16, exact_vectors=None, refine_factor=10):
+        """Returns, for each query, up to k (key, cosine score) pairs sorted by score.
+
+        PQ scores are approximate. With exact_vectors (a function mapping a list of keys to
+        their full vectors, e.g. LocalVectorIndex.vectors_for), the best k * refine_factor
+        candidates are re-scored exactly, which recovers most of the recall lost to quantisation.
+        Candidates it returns an all-zero vector for (keys it does not know) are left out.
+        """
+        queries = normalize(queries)
+        sub_dimension = queries.shape[1] // self.n_subvectors
+        results = []
+        for query in queries:
+            coarse = self.centroids @ query
+            probe = np.argpartition(-coarse, min(n_probe, self.n_lists) - 1)[:n_probe]
+            rows = np.concatenate([self.list_rows[list_id] for list_id in probe])
+            list_scores = np.concatenate([np.full(len(self.list_rows[list_id]), coarse[list_id]) for list_id in probe])
+            keep = self.alive[rows]
+            rows, list_scores = rows[keep], list_scores[keep]
+            if not len(rows):
+                results.append([])
+                continue
+
+            # table[j, c] = query piece j . code c of sub-space j; a vector's score is its list's
+            # centroid score plus one table lookup per sub-space
+            table = np.einsum('jcd,jd->jc', self.codebooks, query.reshape(self.n_subvectors, sub_dimension))
+            scores = list_scores + table[np.arange(self.n_subvectors), self.codes[rows]].sum(axis=1)
+
+            candidates = k * refine_factor if exact_vectors is not None else k
+            top = np.argpartition(-scores, min(candidates, len(scores)) - 1)[:candidates]
+            candidate_keys = [self.keys[rows[i]] for i in top]
+            if exact_vectors is not None:
+                exact = exact_vectors(candidate_keys)
+                scores = normalize(exact) @ query
+                scores[~exact.any(axis=1)] = -np.inf
+            else:
+                scores = scores[top]
+            order = [i for i in np.argsort(-scores)[:k] if scores[i] > -np.inf]
+            results.append([(candidate_keys[i], float(scores[i])) for i in order])
+        return results
+
+    def save(self, path):
+        """Writes the index to one .npz file; replaced entries are dropped."""
+        live = np.flatnonzero(self.alive)
+        lists = np.empty(len(self.alive), dtype=np.int64)
+        for list_id, rows in enumerate(self.list_rows):
+            lists[rows] = list_id
+        np.savez(
+            path,
+            centroids=self.centroids,
+            codebooks=self.codebooks,
+            codes=self.codes[live],
+            lists=lists[live],
+            keys=np.array([self.keys[row] for row in live], dtype=str),
+            versions=np.array([self.versions[row] for row in live], dtype=str)
+        )
+
+    @classmethod
+    def load(cls, path):
+        data = np.load(path)
+        index = cls(data['centroids'], data['codebooks'])
+        index.codes = data['codes']
+        index.keys = data['keys'].tolist()
+        index.versions = data['versions'].tolist()
+        index.alive = np.ones(len(index.keys), dtype=bool)
+        index.key_rows = {key: row for row, key in enumerate(index.keys)}
+        lists = data['lists']
+        index.list_rows = [np.flatnonzero(lists == list_id) for list_id in range(index.n_lists)]
+        return index
+
+def changed_rows(ann, local_index):
+    """Rows of an exported index whose key is new to the ANN index or whose ETag changed."""
+    rows = []
+    for row, record in enumerate(local_index.records):
+        version = str(record['metadata'].get('etag', ''))
+        existing = ann.key_rows.get(record['key'])
+        if existing is None or ann.versions[existing] != version:
+            rows.append(row)
+    return rows
+
+def removed_keys(ann, local_index):
+    """Keys in the ANN index that are no longer in the exported index, e.g. vectors of deleted objects."""
+    exported = {record['key'] for record in local_index.records}
+    return [key for key in ann.key_rows if key not in exported]
+
+# --- Main Execution ---
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build or update the approximate index over the exported vectors in INDEX_DIR.")
+    parser.add_argument('command', choices=['build', 'update'])
+    parser.add_argument('--lists', type=int, default=256)
+    parser.add_argument('--subvectors', type=int, default=32)
+    args = parser.parse_args()
+
+    local_index = LocalVectorIndex.open(INDEX_DIR)
+    ann_path = os.path.join(INDEX_DIR, ANN_FILE)
+    if args.command == 'build':
+        ann = IVFPQIndex.train(np.asarray(local_index.vectors), n_lists=args.lists, n_subvectors=args.subvectors)
+        rows = list(range(len(local_index)))
+    else:
+        # Only new or re-embedded vectors are encoded; the trained centroids and codebooks are reused
+        ann = IVFPQIndex.load(ann_path)
+        rows = changed_rows(ann, local_index)
+        removed = removed_keys(ann, local_index)
+        ann.remove(removed)
+        print(f"update: removed {len(removed)} vectors that are no longer in the export")
+    if rows:
+        ann.add(
+            np.asarray(local_index.vectors[rows]),
+            [local_index.records[row]['key'] for row in rows],
+            [str(local_index.records[row]['metadata'].get('etag', '')) for row in rows]
+        )
+    ann.save(ann_path)
+    print(f"{args.command}: encoded {len(rows)} vectors, index holds {len(ann)} vectors in {ann_path}")
@@ -0,0 +1,98 @@
+import argparse
+import os
+import tempfile
+import time
+import numpy as np
+
+from ann_index import IVFPQIndex, normalize
+from query_engine import LocalVectorIndex
+
+def synthetic_vectors(n_vectors, dimension, n_clusters=64, spread=0.35, seed=0):
+    """Clustered unit vectors, roughly what embeddings of a mixed media corpus look like."""
+    rng = np.random.default_rng(seed)
+    centers = normalize(rng.standard_normal((n_clusters, dimension)))
+    assignment = rng.integers(0, n_clusters, n_vectors)
+    noise = rng.standard_normal((n_vectors, dimension)).astype(np.float32) * spread / np.sqrt(dimension)
+    return normalize(centers[assignment] + noise)
+
+def percentiles_ms(latencies):
+    return np.percentile(latencies, 50) * 1000, np.percentile(latencies, 99) * 1000
+
+def run_benchmark(n_vectors, dimension, n_queries, k, n_lists, n_subvectors, probes, refine_factor=10, update_fraction=0.1, seed=0):
+    """Builds an index from synthetic vectors, updates it incrementally, and measures it against exact search.
+
+    Returns one report per n_probe value, for PQ scores alone and with exact re-ranking.
+    """
+    vectors = synthetic_vectors(n_vectors + n_queries, dimension, seed=seed)
+    queries, vectors = vectors[:n_queries], vectors[n_queries:]
+    keys = [f"object-{i}" for i in range(n_vectors)]
+
+    # Build from most of the corpus, then add the rest the way new objects arrive
+    initial = int(n_vectors * (1 - update_fraction))
+    start = time.perf_counter()
+    ann = IVFPQIndex.train(vectors[:initial], n_lists=n_lists, n_subvectors=n_subvectors, seed=seed)
+    ann.add(vectors[:initial], keys[:initial])
+    build_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    ann.add(vectors[initial:], keys[initial:])
+    update_seconds = time.perf_counter() - start
+
+    # Round-trip through disk so the numbers are for a loaded index
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'ivfpq.npz')
+        ann.save(path)
+        index_bytes = os.path.getsize(path)
+        ann = IVFPQIndex.load(path)
+
+    exact = LocalVectorIndex(vectors, [{'key': key, 'metadata': {}} for key in keys])
+    truths, exact_latencies = [], []
+    for query in queries:
+        start = time.perf_counter()
+        truths.append({match['key'] for match in exact.search(query, k=k)[0]})
+        exact_latencies.append(time.perf_counter() - start)
+
+    reports = []
+    for n_probe in probes:
+        for refine in (None, exact.vectors_for):
+            ann_latencies, recalls = [], []
+            for query, truth in zip(queries, truths):
+                start = time.perf_counter()
+                matches = ann.search(query, k=k, n_probe=n_probe, exact_vectors=refine, refine_factor=refine_factor)[0]
+                ann_latencies.append(time.perf_counter() - start)
+                recalls.append(len(truth & {key for key, _ in matches}) / k)
+
+            reports.append({
+                'n_probe': n_probe,
+                'rerank': refine is not None,
+                f'recall@{k}': float(np.mean(recalls)),
+                'ann_p50_ms': percentiles_ms(ann_latencies)[0],
+                'ann_p99_ms': percentiles_ms(ann_latencies)[1],
+                'exact_p50_ms': percentiles_ms(exact_latencies)[0],
+                'exact_p99_ms': percentiles_ms(exact_latencies)[1],
+                'build_seconds': build_seconds,
+                'update_seconds': update_seconds,
+                'index_mb': index_bytes / 1024 / 1024,
+                'raw_mb': vectors.nbytes / 1024 / 1024,
+            })
+    return reports
+
+# --- Main Execution ---
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Offline recall/latency benchmark of IVFPQIndex against exact search.")
+    parser.add_argument('--vectors', type=int, default=50000)
+    parser.add_argument('--dimension', type=int, default=int(os.environ.get('EMBEDDING_DIMENSION', '256')))
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('--k', type=int, default=10)
+    parser.add_argument('--lists', type=int, default=256)
+    parser.add_argument('--subvectors', type=int, default=32)
+    parser.add_argument('--probe', type=int, nargs='+', default=[4, 16, 64])
+    parser.add_argument('--refine-factor', type=int, default=10)
+    args = parser.parse_args()
+
+    print(f"{args.vectors} synthetic vectors, dimension {args.dimension}, {args.queries} queries, "
+          f"{args.lists} lists, {args.subvectors} sub-vectors")
+    reports = run_benchmark(args.vectors, args.dimension, args.queries, args.k, args.lists, args.subvectors, args.probe, args.refine_factor)
+    for report in reports:
+        print(", ".join(
+            f"{name}={value:.3f}" if isinstance(value, float) else f"{name}={value}" for name, value in report.items()
+        ))
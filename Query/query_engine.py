@@ -0,0 +1,194 @@
+import argparse
+import boto3
+import json
+import os
+import sys
+import numpy as np
+
+# Query requests are built by the Lambda's own builder, so they keep the shape the index was built with
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Lambda'))
+from payload import nova_request
+
+# Environment variables (same names as the Lambda and CodeBuild scripts)
+VECTOR_BUCKET = os.environ.get('VECTOR_BUCKET')
+VECTOR_INDEX = os.environ.get('VECTOR_INDEX')
+S3_REGION = os.environ.get('S3_REGION', 'us-east-1')
+BEDROCK_MODEL_ID = os.environ.get('BEDROCK_MODEL_ID')
+# Local copy of the index used for querying
+INDEX_DIR = os.environ.get('INDEX_DIR', 'vector-index')
+
+VECTORS_FILE = 'vectors.f32'
+METADATA_FILE = 'metadata.jsonl'
+HEADER_FILE = 'index.json'
+# Rows scored at a time, so searching a memory-mapped matrix never loads it all at once
+SEARCH_BLOCK_ROWS = 65536
+
+def export_index(s3vectors_client, vector_bucket, index_name, output_dir):
+    """Mirrors an S3 Vectors index into output_dir. Returns the number of vectors exported.
+
+    Vectors are L2-normalised and appended to a raw float32 file, so cosine similarity
+    becomes a plain dot product. Each vector's key and metadata go to a JSON-lines sidecar
+    in the same row order.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    count = 0
+    dimension = None
+    next_token = None
+    with open(os.path.join(output_dir, VECTORS_FILE), 'wb') as vectors_file, \
+            open(os.path.join(output_dir, METADATA_FILE), 'w') as metadata_file:
+        while True:
+            request = {
+                'vectorBucketName': vector_bucket,
+                'indexName': index_name,
+                'returnData': True,
+                'returnMetadata': True
+            }
+            if next_token:
+                request['nextToken'] = next_token
+            response = s3vectors_client.list_vectors(**request)
+
+            for vector in response.get('vectors', []):
+                data = np.asarray(vector['data']['float32'], dtype=np.float32)
+                if dimension is None:
+                    dimension = len(data)
+                elif len(data) != dimension:
+                    raise ValueError(f"Vector {vector['key']} has {len(data)} dimensions, expected {dimension}")
+                norm = np.linalg.norm(data)
+                vectors_file.write((data / norm if norm else data).tobytes())
+                metadata_file.write(json.dumps({'key': vector['key'], 'metadata': vector.get('metadata') or {}}) + '\n')
+                count += 1
+
+            next_token = response.get('nextToken')
+            if not next_token:
+                break
+
+    with open(os.path.join(output_dir, HEADER_FILE), 'w') as f:
+        json.dump({'count': count, 'dimension': dimension or 0, 'normalized': True}, f)
+    print(f"Exported {count} vectors from {vector_bucket}/{index_name} to {output_dir}")
+    return count
+
+def embed_query_text(bedrock_client, model_id, text, purpose='GENERIC_RETRIEVAL'):
+    """Embeds query text with the same model as the index, using a retrieval purpose."""
+    response = bedrock_client.invoke_model(
+        modelId=model_id,
+        body=json.dumps(nova_request('text', 'utf8', text, purpose)),
+        contentType='application/json',
+        accept='application/json'
+    )
+    return json.loads(response['body'].read())["embeddings"][0]["embedding"]
+
+class LocalVectorIndex:
+    """Exact top-k cosine search over an exported index.
+
+    The vectors are memory-mapped, so opening even a large index is cheap and the OS pages
+    rows in as blocks are scored. Metadata filters (e.g. {'mime_type': 'image/jpeg'}) are
+    applied as a boolean mask before ranking.
+    """
+
+    def __init__(self, vectors, records):
+        self.vectors = vectors
+        self.records = records
+        self._columns = {}
+
+    @classmethod
+    def open(cls, directory):
+        with open(os.path.join(directory, HEADER_FILE)) as f:
+            header = json.load(f)
+        if header['count']:
+            vectors = np.memmap(
+                os.path.join(directory, VECTORS_FILE), dtype=np.float32, mode='r',
+                shape=(header['count'], header['dimension'])
+            )
+        else:
+            vectors = np.zeros((0, header['dimension']), dtype=np.float32)
+        with open(os.path.join(directory, METADATA_FILE)) as f:
+            records = [json.loads(line) for line in f]
+        return cls(vectors, records)
+
+    def __len__(self):
+        return len(self.records)
+
+    def vectors_for(self, keys):
+        """Stored (normalised) vectors for the given keys, in the same order; all zeros for unknown keys."""
+        if 'row_of' not in self._columns:
+            self._columns['row_of'] = {record['key']: row for row, record in enumerate(self.records)}
+        row_of = self._columns['row_of']
+        vectors = np.zeros((len(keys), self.vectors.shape[1]), dtype=np.float32)
+        known = [i for i, key in enumerate(keys) if key in row_of]
+        if known:
+            vectors[known] = self.vectors[[row_of[keys[i]] for i in known]]
+        return vectors
+
+    def _column(self, field):
+        """Values of one metadata field (or 'key') for every row, cached for repeated filtering."""
+        if field not in self._columns:
+            if field == 'key':
+                values = [record['key'] for record in self.records]
+            else:
+                values = [str(record['metadata'].get(field, '')) for record in self.records]
+            self._columns[field] = np.array(values, dtype=str)
+        return self._columns[field]
+
+    def _mask(self, where):
+        if not where:
+            return None
+        mask = np.ones(len(self.records), dtype=bool)
+        for field, allowed in where.items():
+            allowed = allowed if isinstance(allowed, (list, tuple, set)) else [allowed]
+            mask &= np.isin(self._column(field), [str(value) for value in allowed])
+        return mask
+
+    def search(self, queries, k=10, where=None):
+        """Returns, for each query vector, up to k matches as {'key', 'score', 'metadata'} sorted by score."""
+        queries = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+        norms = np.linalg.norm(queries, axis=1, keepdims=True)
+        queries = queries / np.where(norms == 0, 1, norms)
+        mask = self._mask(where)
+
+        best_scores = np.empty((len(queries), 0), dtype=np.float32)
+        best_rows = np.empty((len(queries), 0), dtype=np.int64)
+        for start in range(0, len(self.records), SEARCH_BLOCK_ROWS):
+            end = min(start + SEARCH_BLOCK_ROWS, len(self.records))
+            scores = queries @ np.asarray(self.vectors[start:end]).T
+            if mask is not None:
+                scores[:, ~mask[start:end]] = -np.inf
+            rows = np.broadcast_to(np.arange(start, end), scores.shape)
+
+            # Keep the running top-k of everything scored so far
+            scores = np.concatenate([best_scores, scores], axis=1)
+            rows = np.concatenate([best_rows, rows], axis=1)
+            if scores.shape[1] > k:
+                top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+                scores = np.take_along_axis(scores, top, axis=1)
+                rows = np.take_along_axis(rows, top, axis=1)
+            best_scores, best_rows = scores, rows
+
+        results = []
+        for scores, rows in zip(best_scores, best_rows):
+            order = np.argsort(-scores)
+            results.append([
+                {'key': self.records[row]['key'], 'score': float(score), 'metadata': self.records[row]['metadata']}
+                for score, row in zip(scores[order], rows[order]) if np.isfinite(score)
+            ])
+        return results
+
+# --- Main Execution ---
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export the S3 Vectors index and query it locally.")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    subparsers.add_parser('export', help=f"Mirror {VECTOR_BUCKET}/{VECTOR_INDEX} into INDEX_DIR")
+    search_parser = subparsers.add_parser('search', help="Embed a text query and search the local index")
+    search_parser.add_argument('text')
+    search_parser.add_argument('--k', type=int, default=10)
+    search_parser.add_argument('--mime-type', action='append', help="Only return vectors with this mime_type (repeatable)")
+    args = parser.parse_args()
+
+    if args.command == 'export':
+        export_index(boto3.client('s3vectors', region_name=S3_REGION), VECTOR_BUCKET, VECTOR_INDEX, INDEX_DIR)
+    else:
+        index = LocalVectorIndex.open(INDEX_DIR)
+        bedrock_runtime = boto3.client('bedrock-runtime', region_name=S3_REGION)
+        query = embed_query_text(bedrock_runtime, BEDROCK_MODEL_ID, args.text)
+        where = {'mime_type': args.mime_type} if args.mime_type else None
+        for match in index.search(query, k=args.k, where=where)[0]:
+            print(f"{match['score']:.4f}  {match['key']}  ({match['metadata'].get('mime_type')})")
@@ -0,0 +1,65 @@
+import unittest
+import os
+import tempfile
+
+from ann_index import IVFPQIndex, changed_rows, removed_keys
+from bench_ann import synthetic_vectors
+from query_engine import LocalVectorIndex
+
+class TestIVFPQIndex(unittest.TestCase):
+
+    def setUp(self):
+        vectors = synthetic_vectors(2050, 32, n_clusters=16, spread=1.0)
+        self.queries, self.vectors = vectors[:50], vectors[50:]
+        self.keys = [f"object-{i}" for i in range(len(self.vectors))]
+        self.exact = LocalVectorIndex(self.vectors, [{'key': key, 'metadata': {'etag': 'v1'}} for key in self.keys])
+
+        self.ann = IVFPQIndex.train(self.vectors, n_lists=16, n_subvectors=8, iterations=10)
+        self.ann.add(self.vectors, self.keys, ['v1'] * len(self.keys))
+
+    def recall(self, ann, k=10, **kwargs):
+        hits = 0
+        for query in self.queries:
+            truth = {match['key'] for match in self.exact.search(query, k=k)[0]}
+            hits += len(truth & {key for key, _ in ann.search(query, k=k, **kwargs)[0]})
+        return hits / (k * len(self.queries))
+
+    def test_recall_against_exact_search(self):
+
+        # Probing every list with exact re-ranking finds (almost) exactly what brute force finds
+        self.assertGreater(self.recall(self.ann, n_probe=16, exact_vectors=self.exact.vectors_for), 0.95)
+        # Fewer probes trade recall for speed but stay useful
+        self.assertGreater(self.recall(self.ann, n_probe=4, exact_vectors=self.exact.vectors_for), 0.7)
+
+    def test_save_load_and_incremental_update(self):
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'ivfpq.npz')
+            self.ann.save(path)
+            loaded = IVFPQIndex.load(path)
+
+        self.assertEqual(len(loaded), len(self.keys))
+        self.assertEqual(loaded.search(self.queries[0], k=5), self.ann.search(self.queries[0], k=5))
+
+        # Re-embedding an object replaces its entry instead of adding a second one
+        loaded.add(self.queries[:1], ['object-0'], ['v2'])
+        loaded.add(self.queries[1:2], ['new-object'], ['v1'])
+        self.assertEqual(len(loaded), len(self.keys) + 1)
+        self.assertEqual(loaded.search(self.queries[0], k=1, n_probe=16)[0][0][0], 'object-0')
+
+        # Only the new key and the key whose ETag changed need encoding on the next update
+        self.exact.records[5]['metadata']['etag'] = 'v2'
+        self.assertEqual(changed_rows(loaded, self.exact), [0, 5])
+
+        # Keys that left the export are dropped, and re-ranking skips keys it cannot find
+        self.assertEqual(removed_keys(loaded, self.exact), ['new-object'])
+        exact = LocalVectorIndex(self.vectors[1:], self.exact.records[1:])
+        self.assertEqual(removed_keys(loaded, exact), ['object-0', 'new-object'])
+        found = loaded.search(self.queries[0], k=5, exact_vectors=exact.vectors_for)[0]
+        self.assertNotIn('object-0', [key for key, _ in found])
+        loaded.remove(removed_keys(loaded, exact))
+        self.assertEqual(len(loaded), len(self.keys) - 1)
+        self.assertNotIn('object-0', [key for key, _ in loaded.search(self.queries[0], k=5)[0]])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,88 @@
+import unittest
+import json
+import shutil
+import tempfile
+import numpy as np
+from unittest.mock import MagicMock
+
+from query_engine import export_index, embed_query_text, LocalVectorIndex
+
+MOCK_VECTOR_BUCKET = 'test-vector-bucket'
+MOCK_VECTOR_INDEX = 'test-index'
+MOCK_BEDROCK_MODEL_ID = 'amazon.nova-multimodal-embeddings-v1:0'
+
+class TestQueryEngine(unittest.TestCase):
+
+    def setUp(self):
+        self.index_dir = tempfile.mkdtemp()
+
+        # Two list_vectors pages, shaped like the vectors the Lambda stores
+        self.pages = [
+            {
+                'vectors': [
+                    {'key': 'ASUCampus.jpeg', 'data': {'float32': [1.0, 0.0, 0.0]},
+                     'metadata': {'source_bucket': 'source-bucket-1', 'mime_type': 'image/jpeg'}},
+                    {'key': 'skysong.jpg', 'data': {'float32': [0.8, 0.6, 0.0]},
+                     'metadata': {'source_bucket': 'source-bucket-1', 'mime_type': 'image/jpeg'}},
+                ],
+                'nextToken': 'page-2'
+            },
+            {
+                'vectors': [
+                    {'key': 'sample.pdf', 'data': {'float32': [0.9, 0.0, 0.1]},
+                     'metadata': {'source_bucket': 'source-bucket-1', 'mime_type': 'application/pdf'}},
+                    {'key': 'french.mp3', 'data': {'float32': [0.0, 0.0, 5.0]},
+                     'metadata': {'source_bucket': 'source-bucket-1', 'mime_type': 'audio/mpeg'}},
+                ]
+            },
+        ]
+        self.mock_s3vectors = MagicMock()
+        self.mock_s3vectors.list_vectors.side_effect = self.pages
+
+    def tearDown(self):
+        shutil.rmtree(self.index_dir)
+
+    def test_export_and_search(self):
+
+        count = export_index(self.mock_s3vectors, MOCK_VECTOR_BUCKET, MOCK_VECTOR_INDEX, self.index_dir)
+        self.assertEqual(count, 4)
+        self.assertEqual(self.mock_s3vectors.list_vectors.call_args_list[1][1]['nextToken'], 'page-2')
+
+        index = LocalVectorIndex.open(self.index_dir)
+        self.assertEqual(len(index), 4)
+        # Stored normalised, so cosine similarity is a dot product
+        np.testing.assert_allclose(np.linalg.norm(index.vectors, axis=1), 1.0, rtol=1e-6)
+
+        matches = index.search([1.0, 0.0, 0.0], k=2)[0]
+        self.assertEqual([m['key'] for m in matches], ['ASUCampus.jpeg', 'sample.pdf'])
+        self.assertAlmostEqual(matches[0]['score'], 1.0, places=5)
+        self.assertEqual(matches[0]['metadata']['mime_type'], 'image/jpeg')
+
+    def test_batch_search_with_metadata_filter(self):
+
+        export_index(self.mock_s3vectors, MOCK_VECTOR_BUCKET, MOCK_VECTOR_INDEX, self.index_dir)
+        index = LocalVectorIndex.open(self.index_dir)
+
+        results = index.search([[1.0, 0.0, 0.0], [0.0, 0.0, 1.0]], k=3, where={'mime_type': 'image/jpeg'})
+
+        # Only images are eligible, and there are only two of them
+        self.assertEqual([m['key'] for m in results[0]], ['ASUCampus.jpeg', 'skysong.jpg'])
+        self.assertEqual({m['metadata']['mime_type'] for m in results[1]}, {'image/jpeg'})
+        self.assertEqual(len(results[1]), 2)
+
+    def test_query_text_uses_retrieval_purpose(self):
+
+        mock_bedrock = MagicMock()
+        mock_bedrock.invoke_model.return_value = {
+            'body': MagicMock(read=lambda: json.dumps({'embeddings': [{'embedding': [0.1, 0.2, 0.3]}]}).encode('utf-8'))
+        }
+
+        embedding = embed_query_text(mock_bedrock, MOCK_BEDROCK_MODEL_ID, 'a university campus')
+
+        self.assertEqual(embedding, [0.1, 0.2, 0.3])
+        request_body = json.loads(mock_bedrock.invoke_model.call_args[1]['body'])
+        self.assertEqual(request_body['input'], {'mediaType': 'text', 'encoding': 'utf8', 'data': 'a university campus'})
+        self.assertEqual(request_body['config']['embeddingPurpose'], 'GENERIC_RETRIEVAL')
+
+if __name__ == '__main__':
+    unittest.main()